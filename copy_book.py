@@ -1,5 +1,6 @@
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # 定义源目录和目标目录
 source_dir = '/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/md_processed2'
@@ -26,18 +27,41 @@ files_to_copy = [
 if not os.path.exists(target_dir):
     os.makedirs(target_dir)
 
-# 复制文件
-for filename in files_to_copy:
+def copy_file(filename):
+    """复制单个文件，优先使用内核态的 copy_file_range，不支持时退回 shutil.copyfile"""
     source_path = os.path.join(source_dir, filename)
     target_path = os.path.join(target_dir, filename)
     
     try:
-        if os.path.exists(source_path):
-            shutil.copy2(source_path, target_path)
-            print(f"成功复制: {filename}")
-        else:
+        if not os.path.exists(source_path):
             print(f"文件不存在: {filename}")
+            return
+        
+        if hasattr(os, 'copy_file_range'):
+            try:
+                with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+                    remaining = os.fstat(src.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                if remaining > 0:
+                    raise OSError("copy_file_range 未复制完整")
+            except OSError:
+                # 跨文件系统等情况下不支持 copy_file_range
+                shutil.copyfile(source_path, target_path)
+        else:
+            shutil.copyfile(source_path, target_path)
+        
+        # 保留原有的时间戳等元数据
+        shutil.copystat(source_path, target_path)
+        print(f"成功复制: {filename}")
     except Exception as e:
         print(f"复制 {filename} 时出错: {str(e)}")
 
+# 并行复制文件
+with ThreadPoolExecutor(max_workers=8) as executor:
+    list(executor.map(copy_file, files_to_copy))
+
 print("复制完成！")
\ No newline at end of file
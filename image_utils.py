@@ -1,16 +1,62 @@
 import os
 import json
-from openai import OpenAI
+import asyncio
+import httpx
+from openai import AsyncOpenAI
 from pathlib import Path
 import logging
-from typing import Dict, List, Optional
-import time
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 import base64
+import hashlib
 from config.config import settings
 
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+WRITE_BUFFER_SIZE = 1 << 20  # 写入大JSON文件时使用的缓冲区大小
+SUPPORTED_FORMATS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp'})
+MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp'
+}
+
+def load_json_file(file_path: str):
+    """
+    读取JSON文件，优先使用 orjson 解析
+    
+    Args:
+        file_path (str): JSON文件路径
+    """
+    if orjson is not None:
+        with open(file_path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_json_file(data, file_path: str):
+    """
+    以紧凑格式写入JSON文件，优先使用 orjson 序列化
+    
+    Args:
+        data: 要保存的数据
+        file_path (str): JSON文件路径
+    """
+    # 使用1MB写缓冲，减少大文件写入时的系统调用
+    if orjson is not None:
+        with open(file_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(orjson.dumps(data))
+        return
+    with open(file_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
 class ImageDescriptionGenerator:
-    def __init__(self, api_key: str, image_dir: str, output_file: str):
+    def __init__(self, api_key: str, image_dir: str, output_file: str, max_concurrent: int = 50):
         """
         初始化图片描述生成器
         
@@ -18,11 +64,26 @@ class ImageDescriptionGenerator:
             api_key (str): OpenAI API密钥
             image_dir (str): 图片目录路径
             output_file (str): 输出JSON文件路径
+            max_concurrent (int): 最大并发请求数
         """
-        self.client = OpenAI(api_key=api_key)
+        # 连接池大小与并发数一致，所有请求复用同一组连接
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_concurrent,
+                    max_keepalive_connections=max_concurrent
+                )
+            )
+        )
         self.image_dir = Path(image_dir)
         self.output_file = output_file
-        self.supported_formats = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+        self.progress_file = output_file + ".jsonl"  # 处理过程中逐条追加的进度文件
+        # 按图片内容哈希缓存描述，重命名或跨目录重复的图片无需再次调用API
+        self.hash_cache_file = output_file + ".by_hash.json"
+        self.path_hash_file = output_file + ".by_path.json"
+        self.max_concurrent = max_concurrent
+        self.supported_formats = SUPPORTED_FORMATS
         
         # 设置日志
         self._setup_logging()
@@ -95,60 +156,134 @@ class ImageDescriptionGenerator:
 
 请根据以上要求，为文件名为 {image_name} 的生物学示意图提供详细描述。确保描述准确、专业、系统，并突出教学价值。"""
 
-    def _get_image_description(self, image_path: str, max_retries: int = 3) -> Optional[str]:
+    def _encode_image(self, image_name: str, image_bytes: bytes) -> str:
+        """
+        将图片内容编码为 data URL，MIME 类型根据扩展名确定
+        
+        Args:
+            image_name (str): 图片文件名
+            image_bytes (bytes): 图片内容
+        
+        Returns:
+            str: base64 编码的 data URL
+        """
+        mime_type = MIME_TYPES.get(os.path.splitext(image_name)[1].lower(), 'image/jpeg')
+        return f"data:{mime_type};base64,{base64.b64encode(memoryview(image_bytes)).decode('ascii')}"
+
+    def _build_messages(self, image_name: str, image_bytes: bytes) -> List[Dict]:
+        """
+        构建发送给模型的消息
+        
+        Args:
+            image_name (str): 图片文件名
+            image_bytes (bytes): 图片内容
+        
+        Returns:
+            List[Dict]: chat.completions 的 messages 参数
+        """
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": self._create_detailed_prompt(image_name)
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": self._encode_image(image_name, image_bytes)
+                        }
+                    }
+                ]
+            }
+        ]
+
+    async def _read_image(self, image_path: str) -> Optional[bytes]:
+        """
+        读取图片内容
+        
+        Args:
+            image_path (str): 图片路径
+        
+        Returns:
+            Optional[bytes]: 图片内容或None（如果读取失败）
+        """
+        try:
+            # 单次读取直接放到线程中完成，不需要aiofiles逐次调用的线程切换
+            return await asyncio.to_thread(Path(image_path).read_bytes)
+        except OSError as e:
+            self.logger.error(f"Failed to read {image_path}: {str(e)}")
+            return None
+
+    @staticmethod
+    def _hash_image(image_bytes: bytes) -> str:
+        """
+        计算图片内容的哈希值，作为描述缓存的键
+        
+        Args:
+            image_bytes (bytes): 图片内容
+        
+        Returns:
+            str: 十六进制哈希值
+        """
+        return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+    async def _get_image_description(self, image_path: str, image_bytes: bytes, max_retries: int = 3) -> Optional[str]:
         """
-        使用 gpt 4o mini 生成图片描述
+        使用 gpt 4o mini 异步生成图片描述
         
         Args:
             image_path (str): 图片路径
+            image_bytes (bytes): 图片内容
             max_retries (int): 最大重试次数
         
         Returns:
             Optional[str]: 生成的描述或None（如果失败）
         """
+        # 编码图片只做一次，重试时只重复网络请求
+        messages = self._build_messages(os.path.basename(image_path), image_bytes)
+        
         for attempt in range(max_retries):
             try:
-                with open(image_path, "rb") as image_file:
-                    response = self.client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": self._create_detailed_prompt(Path(image_path).name)
-                                    },
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{base64.b64encode(image_file.read()).decode()}"
-                                        }
-                                    }
-                                ]
-                            }
-                        ],
-                        max_tokens=500
-                    )
-                    return response.choices[0].message.content
+                response = await self.client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    max_tokens=500
+                )
+                return response.choices[0].message.content
             except Exception as e:
                 self.logger.error(f"Attempt {attempt + 1} failed for {image_path}: {str(e)}")
                 if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)  # 指数退避
+                    await asyncio.sleep(2 ** attempt)  # 指数退避
                 continue
         return None
 
-    def _get_image_files(self) -> List[Path]:
+    def _get_image_files(self) -> List[Tuple[str, str]]:
         """
         获取目录中的所有支持的图片文件
+        使用 os.scandir 迭代遍历，避免为每个目录项构造 Path 对象
+        相对路径直接按根目录前缀长度切片得到，不再调用 relpath
         
         Returns:
-            List[Path]: 图片文件路径列表
+            List[Tuple[str, str]]: (图片绝对路径, 相对 image_dir 的路径) 列表
         """
         image_files = []
-        for file_path in self.image_dir.rglob("*"):
-            if file_path.suffix.lower() in self.supported_formats:
-                image_files.append(file_path)
+        root = str(self.image_dir)
+        prefix_len = len(root.rstrip(os.sep)) + 1
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    name = entry.name
+                    dot = name.rfind('.')
+                    if dot >= 0 and name[dot:].lower() in self.supported_formats:
+                        path = entry.path
+                        image_files.append((path, path[prefix_len:]))
         return image_files
 
     def _load_existing_descriptions(self) -> Dict[str, str]:
@@ -158,63 +293,270 @@ class ImageDescriptionGenerator:
         Returns:
             Dict[str, str]: 现有的图片描述字典
         """
+        descriptions = {}
         if os.path.exists(self.output_file):
             try:
-                with open(self.output_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                descriptions = load_json_file(self.output_file)
             except json.JSONDecodeError:
                 self.logger.warning(f"Error reading {self.output_file}, starting fresh")
-        return {}
+        
+        # 合并上次中断时追加的进度记录
+        if os.path.exists(self.progress_file):
+            with open(self.progress_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 中断时可能留下不完整的最后一行
+                    descriptions[record["k"]] = record["v"]
+        return descriptions
+
+    def _load_hash_cache(self) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """
+        加载按内容哈希缓存的描述
+        
+        Returns:
+            Tuple[Dict[str, str], Dict[str, str]]: (哈希 -> 描述, 相对路径 -> 哈希)
+        """
+        caches = []
+        for cache_file in (self.hash_cache_file, self.path_hash_file):
+            cache = {}
+            if os.path.exists(cache_file):
+                try:
+                    cache = load_json_file(cache_file)
+                except json.JSONDecodeError:
+                    self.logger.warning(f"Error reading {cache_file}, starting fresh")
+            caches.append(cache)
+        by_hash, by_path = caches
+        
+        # 合并上次中断时追加的进度记录
+        if os.path.exists(self.progress_file):
+            with open(self.progress_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if "h" in record:
+                        by_hash[record["h"]] = record["v"]
+                        by_path[record["k"]] = record["h"]
+        return by_hash, by_path
+
+    def _save_hash_cache(self, by_hash: Dict[str, str], by_path: Dict[str, str]):
+        """
+        保存按内容哈希缓存的描述
+        
+        Args:
+            by_hash (Dict[str, str]): 哈希 -> 描述
+            by_path (Dict[str, str]): 相对路径 -> 哈希
+        """
+        for cache_file, cache in ((self.hash_cache_file, by_hash), (self.path_hash_file, by_path)):
+            save_json_file(cache, cache_file)
+
+    async def _write_progress(self, queue: asyncio.Queue, batch_size: int = 50):
+        """
+        后台写入任务：把队列中的描述记录批量追加到进度文件
+        每次取出队列中已有的全部记录（最多batch_size条），合并为一次写入；收到None时结束
+        
+        Args:
+            queue (asyncio.Queue): 描述记录队列
+            batch_size (int): 单次写入的最大记录数
+        """
+        fd = os.open(self.progress_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            done = False
+            while not done:
+                records = []
+                record = await queue.get()
+                while True:
+                    if record is None:
+                        done = True
+                        break
+                    records.append(record)
+                    if len(records) >= batch_size or queue.empty():
+                        break
+                    record = queue.get_nowait()
+                
+                if records:
+                    data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+                    await asyncio.to_thread(os.write, fd, data)
+        finally:
+            os.close(fd)
 
     def _save_descriptions(self, descriptions: Dict[str, str]):
         """
-        保存描述到JSON文件
+        保存描述到JSON文件，保存成功后进度文件中的记录已全部合并，可以删除
         
         Args:
             descriptions (Dict[str, str]): 图片描述字典
         """
-        with open(self.output_file, 'w', encoding='utf-8') as f:
-            json.dump(descriptions, f, ensure_ascii=False, indent=4)
+        save_json_file(descriptions, self.output_file)
+        if os.path.exists(self.progress_file):
+            os.remove(self.progress_file)
 
-    def generate_descriptions(self):
+    async def generate_descriptions(self):
         """
-        为所有图片生成描述并保存
+        为所有图片并发生成描述并保存，最多同时处理 max_concurrent 张图片
         """
         self.logger.info("Starting description generation process")
         
         # 加载现有描述
         descriptions = self._load_existing_descriptions()
+        by_hash, by_path = self._load_hash_cache()
         image_files = self._get_image_files()
         
         self.logger.info(f"Found {len(image_files)} image files")
         
-        # 处理每个图片
-        for image_path in image_files:
-            relative_path = str(image_path.relative_to(self.image_dir))
-            
-            # 跳过已处理的图片
+        # 跳过已处理的图片
+        pending = []
+        for image_path, relative_path in image_files:
             if relative_path in descriptions:
                 self.logger.info(f"Skipping already processed image: {relative_path}")
                 continue
+            pending.append((image_path, relative_path))
+        
+        # 创建信号量来限制并发数
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        
+        async def process_with_semaphore(image_path: str, relative_path: str):
+            async with semaphore:
+                image_bytes = await self._read_image(image_path)
+                if image_bytes is None:
+                    return
                 
-            self.logger.info(f"Processing image: {relative_path}")
-            
-            # 获取描述
-            description = self._get_image_description(str(image_path))
+                # 内容相同的图片直接使用缓存的描述
+                image_hash = self._hash_image(image_bytes)
+                if image_hash in by_hash:
+                    descriptions[relative_path] = by_hash[image_hash]
+                    by_path[relative_path] = image_hash
+                    self.logger.info(f"Reusing cached description for {relative_path}")
+                    return
+                
+                self.logger.info(f"Processing image: {relative_path}")
+                description = await self._get_image_description(image_path, image_bytes)
             
             if description:
                 descriptions[relative_path] = description
+                by_hash[image_hash] = description
+                by_path[relative_path] = image_hash
                 self.logger.info(f"Successfully generated description for {relative_path}")
                 
-                # 定期保存结果
-                self._save_descriptions(descriptions)
+                # 交给后台任务追加到进度文件，避免每张图片都重写整个JSON
+                progress_queue.put_nowait({"k": relative_path, "v": description, "h": image_hash})
             else:
                 self.logger.error(f"Failed to generate description for {relative_path}")
         
+        progress_queue = asyncio.Queue()
+        writer = asyncio.create_task(self._write_progress(progress_queue))
+        
+        tasks = [process_with_semaphore(image_path, relative_path) for image_path, relative_path in pending]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        # 通知后台写入任务结束并等待剩余记录写完
+        progress_queue.put_nowait(None)
+        await writer
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error(f"任务执行失败: {str(result)}")
+        
         # 最终保存
+        self._save_hash_cache(by_hash, by_path)
         self._save_descriptions(descriptions)
         self.logger.info("Description generation process completed")
 
+    async def generate_descriptions_batch(self, poll_interval: int = 60):
+        """
+        使用 OpenAI Batch API 为大量图片生成描述并保存
+        Batch API 在24小时窗口内完成，费用为同步调用的一半，适合积压较多的图片
+        
+        Args:
+            poll_interval (int): 轮询批任务状态的间隔（秒）
+        """
+        self.logger.info("Starting batch description generation process")
+        
+        descriptions = self._load_existing_descriptions()
+        by_hash, by_path = self._load_hash_cache()
+        image_files = self._get_image_files()
+        
+        # 组装 JSONL 请求文件，custom_id 为图片相对路径
+        lines = []
+        submitted_hashes = set()
+        for image_path, relative_path in image_files:
+            if relative_path in descriptions:
+                continue
+            image_bytes = await self._read_image(image_path)
+            if image_bytes is None:
+                continue
+            image_hash = self._hash_image(image_bytes)
+            by_path[relative_path] = image_hash
+            if image_hash in by_hash:
+                descriptions[relative_path] = by_hash[image_hash]
+                continue
+            # 同一批次中内容相同的图片只提交一次
+            if image_hash in submitted_hashes:
+                continue
+            submitted_hashes.add(image_hash)
+            lines.append(json.dumps({
+                "custom_id": relative_path,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-4o-mini",
+                    "messages": self._build_messages(os.path.basename(image_path), image_bytes),
+                    "max_tokens": 500
+                }
+            }, ensure_ascii=False))
+        
+        if not lines:
+            self.logger.info("No new images to process")
+            self._save_hash_cache(by_hash, by_path)
+            self._save_descriptions(descriptions)
+            return
+        
+        self.logger.info(f"Submitting {len(lines)} images to Batch API")
+        batch_input = await self.client.files.create(
+            file=("batch_input.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        
+        # 轮询直到批任务结束
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            self.logger.info(f"Batch {batch.id} status: {batch.status}")
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            self.logger.error(f"Batch {batch.id} ended with status: {batch.status}")
+            return
+        
+        # 按 custom_id 解析每一行结果
+        output = await self.client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            relative_path = result["custom_id"]
+            try:
+                description = result["response"]["body"]["choices"][0]["message"]["content"]
+                descriptions[relative_path] = description
+                by_hash[by_path[relative_path]] = description
+            except (KeyError, IndexError, TypeError):
+                self.logger.error(f"Failed to generate description for {relative_path}: {result.get('error')}")
+        
+        # 为同批次中内容重复、未单独提交的图片补上描述
+        for relative_path, image_hash in by_path.items():
+            if relative_path not in descriptions and image_hash in by_hash:
+                descriptions[relative_path] = by_hash[image_hash]
+        
+        self._save_hash_cache(by_hash, by_path)
+        self._save_descriptions(descriptions)
+        self.logger.info("Batch description generation process completed")
+
 def main():
     """
     主函数
@@ -228,7 +570,7 @@ def main():
     generator = ImageDescriptionGenerator(api_key, image_dir, output_file)
     
     # 生成描述
-    generator.generate_descriptions()
+    asyncio.run(generator.generate_descriptions())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -4,71 +4,90 @@ JSON文件只需要更新chapter和section两个部分即可
 """
 import json
 
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library when orjson is not installed
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # Fall back to loading the whole file when ijson is not installed
+    ijson = None
+
+def load_json_file(path):
+    """Load a JSON file, using orjson when available"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def iter_content_entries(path):
+    """Yield the content entries one at a time, streaming with ijson when available"""
+    if ijson is not None:
+        with open(path, 'rb') as f:
+            yield from ijson.items(f, 'item', use_float=True)
+    else:
+        yield from load_json_file(path)
+
+def dump_entry(entry):
+    """Serialize one merged entry to compact UTF-8 JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(entry)
+    return json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
 # Load the JSON data from the files with error handling
 try:
-    with open('md_processing/github_code/CrossModalRetrieval-RAG/all_books/toc_json/processed_20241210_131731_1 普通生物学（5）.json', 'r', encoding='utf-8') as file1:
-        toc_data = json.load(file1)
+    toc_data = load_json_file('md_processing/github_code/CrossModalRetrieval-RAG/all_books/toc_json/processed_20241210_131731_1 普通生物学（5）.json')
 except FileNotFoundError:
     raise FileNotFoundError("The file for toc_data was not found. Please check the file path.")
 except json.JSONDecodeError:
     raise ValueError("The file for toc_data does not contain valid JSON.")
 
-with open('md_processing/github_code/CrossModalRetrieval-RAG/all_books/JSON_book/chinese_book/1 普通生物学（5）.json', 'r', encoding='utf-8') as file2:
-    content_data = json.load(file2)
-
 # Check if toc_data is a list and not empty
 if not isinstance(toc_data, list) or not toc_data:
     raise ValueError("toc_data is not a list or is empty")
 
-# Initialize the merged data list
-merged_data = []
+# Build a hash index of the TOC once: (Chapter, Section) -> position in toc_data
+toc_index = {}
+for position, toc_entry in enumerate(toc_data):
+    toc_index.setdefault((toc_entry['Chapter'], toc_entry['Section']), position)
 
-# Initialize indices for both lists
-toc_index = 0
-content_index = 0
+content_path = 'md_processing/github_code/CrossModalRetrieval-RAG/all_books/JSON_book/chinese_book/1 普通生物学（5）.json'
+output_path = '/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/json_refine/merged_data.json'
 
-# Iterate through both lists
-while toc_index < len(toc_data) and content_index < len(content_data):
-    toc_entry = toc_data[toc_index]
-    content_entry = content_data[content_index]
+# Position of the next TOC entry expected after the last match
+next_toc_position = 0
+last_toc_position = len(toc_data) - 1
 
-    # Check if the chapter and section match
-    if toc_entry['Chapter'] == content_entry['Chapter'] and toc_entry['Section'] == content_entry['Section']:
-        # If they match, merge the entries
-        merged_entry = {
-            "Chapter": toc_entry['Chapter'],
-            "Section": toc_entry['Section'],
-            "Subsection": content_entry['Subsection'],
-            "Content": content_entry['Content']
-        }
-        merged_data.append(merged_entry)
-        # Move to the next entries in both lists
-        toc_index += 1
-        content_index += 1
-    else:
-        # If they don't match, decide based on the rules
-        # Here, we assume content belongs to the last matched chapter/section
-        if content_entry['Chapter'] is None:
-            content_entry['Chapter'] = toc_entry['Chapter']
-        if content_entry['Section'] is None:
-            content_entry['Section'] = toc_entry['Section']
-        
-        # Add the content entry to the merged data
-        merged_data.append(content_entry)
-        # Move to the next content entry
-        content_index += 1
+# Single streaming pass over the content data; each merged entry is written as soon as it is built,
+# Use a 1MB write buffer to cut down on system calls when writing large files
+# 使用1MB写缓冲，减少大文件写入时的系统调用
+with open(output_path, 'wb', buffering=1 << 20) as outfile:
+    outfile.write(b'[')
+    for content_position, content_entry in enumerate(iter_content_entries(content_path)):
+        matched_position = toc_index.get((content_entry['Chapter'], content_entry['Section']))
 
-# Handle any remaining entries in the content data
-while content_index < len(content_data):
-    content_entry = content_data[content_index]
-    if content_entry['Chapter'] is None:
-        content_entry['Chapter'] = toc_data[-1]['Chapter']
-    if content_entry['Section'] is None:
-        content_entry['Section'] = toc_data[-1]['Section']
-    merged_data.append(content_entry)
-    content_index += 1
+        if matched_position is not None:
+            # If they match, merge the entries
+            toc_entry = toc_data[matched_position]
+            merged_entry = {
+                "Chapter": toc_entry['Chapter'],
+                "Section": toc_entry['Section'],
+                "Subsection": content_entry['Subsection'],
+                "Content": content_entry['Content']
+            }
+            next_toc_position = matched_position + 1
+        else:
+            # If they don't match, the content belongs to the TOC entry following the last match
+            toc_entry = toc_data[min(next_toc_position, last_toc_position)]
+            if content_entry['Chapter'] is None:
+                content_entry['Chapter'] = toc_entry['Chapter']
+            if content_entry['Section'] is None:
+                content_entry['Section'] = toc_entry['Section']
+            merged_entry = content_entry
 
-# Save the merged data to a new JSON file
-output_path = '/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/json_refine/merged_data.json'
-with open(output_path, 'w', encoding='utf-8') as outfile:
-    json.dump(merged_data, outfile, ensure_ascii=False, indent=4)
\ No newline at end of file
+        if content_position:
+            outfile.write(b',')
+        outfile.write(dump_entry(merged_entry))
+    outfile.write(b']')
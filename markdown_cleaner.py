@@ -2,16 +2,166 @@ import os
 import logging
 import asyncio
 import aiohttp
+import httpx
+import importlib.util
 from openai import AsyncOpenAI
 from datetime import datetime
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Sequence, Tuple
 import glob
-import aiofiles
+import mmap
+import re
+import bisect
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:  # 未安装tiktoken时跳过token数检查
+    tiktoken = None
+
+NEWLINE_PATTERN = re.compile('\n')
+# 每块的字符上限，按gpt-4o-mini的上下文窗口设置，减少API往返次数和提示词的重复发送
+CHUNK_CHARS = 48000
+# 每块的token上限：清理/重排的输出长度与输入相当，需留在16000的回复上限以内
+MAX_CHUNK_TOKENS = 12000
+# 回复的最大token数
+MAX_REPLY_TOKENS = 16000
+# 跨书籍复用的清理结果最多保留的块数，超过时淘汰最久未用的块
+CHUNK_CACHE_SIZE = 256
+
+CLEAN_PROMPT = """You are a professional document processing assistant. Please process the text according to the following rules and return only the processed text without any explanations:
+
+1. Remove the following content:
+   - All images and image descriptions (lines containing ![])
+   - Acknowledgments section
+   - Preface/Foreword
+   - References/Bibliography section
+   - Review questions， exercises, concept check questions
+   - All content before the table of contents
+   - Content outside the main text (e.g., appendices, indices)
+   - Further reading sections
+   - Headers without accompanying text
+   - Table of contents
+
+2. Retain the following content:
+   - All chapter and section headings (in markdown format)
+   - Main body text
+   - Mathematical equations
+   - Code blocks
+   - Essential tables and figures
+
+3. Processing rules:
+   - Maintain the hierarchical structure of headings
+   - Preserve the original formatting of the main text
+   - Remove excessive blank lines (keep maximum one blank line)
+   - Ensure textual coherence and flow
+   - Maintain academic writing style and terminology
+
+Please process the following text:
+
+"""
+
+def chunk_bounds(newlines: List[int], length: int, limit: int) -> List[Tuple[int, int]]:
+    """
+    根据已排好序的换行位置，用二分查找计算每个块的起止下标
+    每个块不超过limit，只在换行处切分；单行超过limit时整行作为一个块
+    """
+    bounds = []
+    start = 0
+    while start < length:
+        end = start + limit
+        if end >= length:
+            end = length
+        else:
+            # 最后一个不超过end的换行位置
+            idx = bisect.bisect_right(newlines, end) - 1
+            if idx >= 0 and newlines[idx] >= start:
+                end = newlines[idx]
+            else:
+                idx = bisect.bisect_left(newlines, end)
+                end = newlines[idx] if idx < len(newlines) else length
+        bounds.append((start, end))
+        # end < length 时 end 一定是换行位置，跳过它，合并时用'\n'连接即可还原
+        start = end + 1 if end < length else end
+    return bounds
+
+def split_into_chunks(content: str, limit: int = CHUNK_CHARS) -> Tuple[str, ...]:
+    """
+    按字符数将文本切分为不超过limit的块，只在换行处切分
+    一次性找出所有换行位置，再用二分查找确定切分点
+    """
+    newlines = [match.start() for match in NEWLINE_PATTERN.finditer(content)]
+    return tuple(content[start:end] for start, end in chunk_bounds(newlines, len(content), limit))
+
+def limit_chunk_tokens(chunks: Sequence[str], max_tokens: int = MAX_CHUNK_TOKENS) -> Tuple[str, ...]:
+    """
+    token数二次检查：超过max_tokens的块按一半长度在换行处继续切分，直到满足限制
+    未安装tiktoken时直接返回原块
+    """
+    if tiktoken is None:
+        return tuple(chunks)
+    enc = tiktoken.encoding_for_model("gpt-4o-mini")
+    result = []
+    stack = list(reversed(chunks))
+    while stack:
+        chunk = stack.pop()
+        if len(enc.encode_ordinary(chunk)) > max_tokens:
+            parts = split_into_chunks(chunk, max(len(chunk) // 2, 1))
+            if len(parts) > 1:  # 单行无法再切分时保留原块
+                stack.extend(reversed(parts))
+                continue
+        result.append(chunk)
+    return tuple(result)
+
+def read_chunks_mmap(file_path: str, limit: int = CHUNK_CHARS) -> Tuple[str, ...]:
+    """
+    通过mmap读取文件，在换行处切分，只解码每个块对应的字节
+    避免先把整个文件解码为一个大字符串再切分
+    按字符数计算切分点，切出的块与split_into_chunks相同，中文书的块不会因每字3字节而变小
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # 用NumPy一次性找出所有换行符的字节偏移
+            data = np.frombuffer(mm, dtype=np.uint8)
+            newline_bytes = np.flatnonzero(data == 0x0A)
+            # UTF-8的后续字节（10xxxxxx）不单独算一个字符：字符偏移 = 字节偏移 - 之前的后续字节数
+            continuation = (data & 0xC0) == 0x80
+            char_length = len(mm) - int(np.count_nonzero(continuation))
+            if len(newline_bytes):
+                # 相邻换行之间的后续字节数，累加得到每个换行之前的后续字节数
+                segment_starts = np.concatenate(([0], newline_bytes))
+                continuation_before = np.cumsum(np.add.reduceat(continuation, segment_starts, dtype=np.int64)[:len(newline_bytes)])
+                newline_chars = (newline_bytes - continuation_before).tolist()
+            else:
+                newline_chars = []
+            del data, continuation  # 释放对mmap缓冲区的引用，否则无法关闭mmap
+            # 块的起止都在换行处或文件首尾，把字符偏移换回字节偏移；在换行处切分不会截断UTF-8多字节字符
+            byte_offsets = dict(zip(newline_chars, newline_bytes.tolist()))
+            byte_offsets[char_length] = len(mm)
+            return tuple(
+                mm[byte_offsets[start - 1] + 1 if start else 0:byte_offsets[end]].decode('utf-8')
+                for start, end in chunk_bounds(newline_chars, char_length, limit)
+            )
 
 class MarkdownCleaner:
-    def __init__(self, api_key: str):
-        self.client = AsyncOpenAI(api_key=api_key)
+    def __init__(self, api_key: str, max_connections: int = 200):
+        # 所有书籍共用一个客户端和连接池，复用TLS连接
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=importlib.util.find_spec("h2") is not None,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections // 2
+                )
+            )
+        )
+        # 按块内容哈希缓存清理结果，跨书籍复用（同一系列书籍中重复块很常见），最多保留CHUNK_CACHE_SIZE个块
+        self.chunk_cache = OrderedDict()
         self.setup_logging()
         
     def setup_logging(self):
@@ -33,6 +183,7 @@ class MarkdownCleaner:
                 model="gpt-4o-mini",     
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.3,
+                max_tokens=MAX_REPLY_TOKENS,
                 top_p=1.0,
                 frequency_penalty=0.0,
                 presence_penalty=0.0
@@ -41,82 +192,62 @@ class MarkdownCleaner:
         except Exception as e:
             raise Exception(f"API调用失败: {str(e)}")
 
-    async def clean_markdown(self, content: str) -> str:
-        """异步清理Markdown文档，对每本书的chunks按顺序处理"""
+    async def clean_markdown(self, content: str, max_concurrent_chunks: int = 8) -> str:
+        """异步清理Markdown文档，每本书的chunks并发处理，结果按原顺序拼接"""
         # 将内容分成较小的块进行处理
-        chunks = []
-        current_chunk = []
-        current_length = 0
+        chunks = limit_chunk_tokens(split_into_chunks(content))
+        return await self.clean_chunks(chunks, max_concurrent_chunks)
+
+    async def clean_chunks(self, chunks: Sequence[str], max_concurrent_chunks: int = 8) -> str:
+        """异步清理已切分好的文本块，相同内容的块只调用一次API，结果按原顺序拼接"""
+        # 按内容哈希去重，缓存中已有的块不再请求
+        keys = [hashlib.blake2b(chunk.encode('utf-8'), digest_size=16).digest() for chunk in chunks]
+        # 本书各块的清理结果，拼接前缓存中的条目被其他书淘汰也不受影响
+        cleaned = {}
+        for key in keys:
+            if key in self.chunk_cache:
+                cleaned[key] = self.chunk_cache[key]
+                self.chunk_cache.move_to_end(key)
+        unique = {key: chunk for key, chunk in zip(keys, chunks) if key not in cleaned}
+        if len(unique) < len(chunks):
+            self.logger.info(f"共 {len(chunks)} 个文本块，需请求 {len(unique)} 个，其余复用缓存或重复块结果")
         
-        for line in content.split('\n'):
-            line_length = len(line)
-            if current_length + line_length > 4000:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = []
-                current_length = 0
-            current_chunk.append(line)
-            current_length += line_length
+        # 并发处理每个块，同一本书内最多同时处理max_concurrent_chunks个块
+        semaphore = asyncio.Semaphore(max_concurrent_chunks)
         
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
+        async def process_chunk(i: int, chunk: str) -> str:
+            async with semaphore:
+                self.logger.info(f"正在处理第 {i+1}/{len(unique)} 个文本块")
+                return await self.generate_response(CLEAN_PROMPT + chunk)
         
-        # 顺序处理每个块
-        processed_chunks = []
-        for i, chunk in enumerate(chunks):
-            prompt = """You are a professional document processing assistant. Please process the text according to the following rules and return only the processed text without any explanations:
-
-1. Remove the following content:
-   - All images and image descriptions (lines containing ![])
-   - Acknowledgments section
-   - Preface/Foreword
-   - References/Bibliography section
-   - Review questions， exercises, concept check questions
-   - All content before the table of contents
-   - Content outside the main text (e.g., appendices, indices)
-   - Further reading sections
-   - Headers without accompanying text
-   - Table of contents
-
-2. Retain the following content:
-   - All chapter and section headings (in markdown format)
-   - Main body text
-   - Mathematical equations
-   - Code blocks
-   - Essential tables and figures
-
-3. Processing rules:
-   - Maintain the hierarchical structure of headings
-   - Preserve the original formatting of the main text
-   - Remove excessive blank lines (keep maximum one blank line)
-   - Ensure textual coherence and flow
-   - Maintain academic writing style and terminology
-
-Please process the following text:
-
-"""
-            prompt += chunk
-            
-            try:
-                self.logger.info(f"正在处理第 {i+1}/{len(chunks)} 个文本块")
-                response = await self.generate_response(prompt)
-                processed_chunks.append(response.strip())
-            except Exception as e:
-                self.logger.error(f"处理第 {i+1} 个文本块时失败: {str(e)}")
-                processed_chunks.append(chunk)  # 如果处理失败，保留原文
+        results = await asyncio.gather(
+            *(process_chunk(i, chunk) for i, chunk in enumerate(unique.values())),
+            return_exceptions=True
+        )
+        
+        # 只缓存成功的结果，失败的块下次仍会重试
+        for key, result in zip(unique, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"处理文本块时失败: {str(result)}")
+            else:
+                cleaned[key] = self.chunk_cache[key] = result.strip()
+        while len(self.chunk_cache) > CHUNK_CACHE_SIZE:
+            self.chunk_cache.popitem(last=False)
+        
+        # 按原顺序拼接结果，如果处理失败，保留原文
+        processed_chunks = [cleaned.get(key, chunk) for key, chunk in zip(keys, chunks)]
         
         return '\n'.join(processed_chunks)
 
-async def clean_markdown_file(input_path: str, output_dir: str, api_key: str) -> bool:
+async def clean_markdown_file(input_path: str, output_dir: str, cleaner: MarkdownCleaner) -> bool:
     """异步处理单个Markdown文件"""
     try:
-        cleaner = MarkdownCleaner(api_key)
-        
-        # 异步读取输入文件
-        async with aiofiles.open(input_path, 'r', encoding='utf-8') as f:
-            content = await f.read()
+        # 通过mmap读取输入文件并直接按字节切分成块，放到线程中执行避免阻塞事件循环
+        chunks = await asyncio.to_thread(read_chunks_mmap, input_path)
+        chunks = await asyncio.to_thread(limit_chunk_tokens, chunks)
         
         # 清理文档
-        cleaned_content = await cleaner.clean_markdown(content)
+        cleaned_content = await cleaner.clean_chunks(chunks)
         
         # 保存处理后的文件
         os.makedirs(output_dir, exist_ok=True)
@@ -126,9 +257,8 @@ async def clean_markdown_file(input_path: str, output_dir: str, api_key: str) ->
             f'cleaned_{timestamp}_{os.path.basename(input_path)}'
         )
         
-        # 异步写入文件
-        async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
-            await f.write(cleaned_content)
+        # 单次写入直接放到线程中完成
+        await asyncio.to_thread(Path(output_path).write_text, cleaned_content, encoding='utf-8')
         
         cleaner.logger.info(f"文件已清理并保存到: {output_path}")
         return True
@@ -137,10 +267,10 @@ async def clean_markdown_file(input_path: str, output_dir: str, api_key: str) ->
         logging.error(f"处理文件时发生错误: {str(e)}")
         return False
 
-async def process_book(input_path: str, output_dir: str, api_key: str) -> Tuple[str, bool]:
+async def process_book(input_path: str, output_dir: str, cleaner: MarkdownCleaner) -> Tuple[str, bool]:
     """异步处理单本书籍"""
     try:
-        success = await clean_markdown_file(input_path, output_dir, api_key)
+        success = await clean_markdown_file(input_path, output_dir, cleaner)
         return input_path, success
     except Exception as e:
         logging.error(f"处理文件 {input_path} 时出错: {str(e)}")
@@ -171,12 +301,15 @@ async def process_books_directory(
         logging.warning(f"在目录 {input_dir} 中未找到Markdown文件")
         return
     
+    # 所有书籍共用一个清理器（及其连接池）
+    cleaner = MarkdownCleaner(api_key)
+    
     # 创建信号量来限制并发书籍数
     semaphore = asyncio.Semaphore(max_concurrent)
     
     async def process_with_semaphore(file_path: str) -> Tuple[str, bool]:
         async with semaphore:
-            return await process_book(file_path, output_dir, api_key)
+            return await process_book(file_path, output_dir, cleaner)
     
     # 创建所有任务
     tasks = [process_with_semaphore(file_path) for file_path in md_files]
@@ -17,6 +17,195 @@ from openai import OpenAI
 from dotenv import load_dotenv
 from datetime import datetime
 import json
+import re
+import bisect
+from typing import List, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tiktoken
+except ImportError:  # 未安装tiktoken时跳过token数检查
+    tiktoken = None
+
+NEWLINE_PATTERN = re.compile('\n')
+# 每块的字符上限，按gpt-4o-mini的上下文窗口设置，减少API往返次数和提示词的重复发送
+CHUNK_CHARS = 48000
+# 每块的token上限：清理/重排的输出长度与输入相当，需留在16000的回复上限以内
+MAX_CHUNK_TOKENS = 12000
+# 回复的最大token数
+MAX_REPLY_TOKENS = 16000
+
+# 提示词的静态部分只构造一次，循环中只拼接可变内容
+TOC_PROMPT = """
+            你是一个文本处理专家，我将分段给你输入一本书的内容，从以下文本中识别目录部分，并将其转换为Markdown格式（用#表示层级）的目录。
+            你只是处理文本，不要做任何评价或者描述。
+            因为输入长度限制，目录可能分布在两次或者多次相邻输入的分段中，请记住上一段的处理方式，保持一致，不要偷懒！！！
+
+            规则：
+            1. 目录识别特征：
+               - 标题编号密集出现的段落
+               - 连续多个X章,X节,或者数字编号12345一二三四五的短文本
+               - 每行都是类似标题的短文本或者连续多个短文本
+               - 句子中可能带有页码（需要删除）
+            
+            2. 标题层级判断规则：
+               目录部分相邻多个具有并列层级结构的内容需要被识别为同一层级：
+               文字前用于表示章节限定的数字（如1，1.1，1.1.1）或者符号（a,b,c）越多，则标题的级别越低。
+               举例：
+               第一级：
+               - 第X章
+               - 第X部分
+               
+               第二级：
+               - 第X节
+               - X.X（如1.1、2.1等）
+               
+               第三级：
+               - X.X.X（如1.1.1、2.1.1等）
+               - 一、二、三等中文数字编号
+               - 1、2、3等阿拉伯数字编号
+               
+               第四级：
+               - (一)、(二)、(三)等带括号的中文数字
+               - (1)、(2)、(3)等带括号的阿拉伯数字
+               - A、B、C等字母编号
+               
+               第五级：
+               - a)、b)、c)等小写字母编号
+               - 1)、2)、3)等带括号的数字
+               
+               特殊规则：
+               - 删除Box、图、表、注解等特殊内容
+               - 保持章节的连续性和层级关系
+               - 确保每个标题都有对应的层级标记
+            
+            3. 输出要求：
+               - 只输出Markdown格式的目录（只用#的多少来标注层级）
+               - 保持原有的层级关系
+               - 删除包含"思考题"、"参考文献"、"练习题"和"附录"的部分
+               - 删除所有页码
+               - 确保每一行都有标题层级标记
+               - 标题之间用换行分隔
+            
+            4. 输出的示例
+                # 第一篇 结构生物化学
+                ## 第一章 绪论
+                ### 第一节 生物化学发展简史
+                ### 第二节 生物化学的主要内容及其应用
+                ### 第三节 生物化学学习方法
+
+                ## 第二章 蛋白质的结构与功能
+                ### 第一节 氨基酸
+                #### 一 氨基酸的结构和分类
+                #### 二 氨基酸的性质
+                #### 三 氨基酸的功能
+            以下是要处理的文本内容：
+            """
+
+REARRANGE_PROMPT_HEAD = """系统：你是一个专业的文档处理助手。我在prompt中给出了一本书的目录结构，请参考目录结构按照以下规则处理这本书中的文本，只返回处理后的文本内容，不要添加任何解释或总结。
+这本书很长，因此我拆分成多段提供给你。在处理不同段的时候，你的处理逻辑是不变的。
+
+以下是目录结构：
+"""
+REARRANGE_PROMPT_MID = """
+以上是目录结构：
+
+处理规则：
+1. 标题层级规则：
+   - 仔细分析目录中的标题格式和层级关系，整本书的目录格式是一致的，请保持一致。
+   - 例如：如果目录中"第X章"使用一级标题(#)，那么正文中所有"第X章"也应使用一级标题
+   - 例如：如果目录中"X.X节"使用二级标题(##)，那么正文中所有"X.X节"也应使用二级标题
+   - 保持与目录中相同标题格式的一致性
+   - 标题的限定越多，层级越低。比如：2.2是二级标题，那么2.2.1应使用三级标题。
+
+2. 未出现在目录中的标题处理：
+   - 识别目录中最低层级的标题格式
+   - 将未在目录中出现的标题设置为比目录最低层级更低一级
+   - 相似格式的未知标题应保持相同的层级
+   - 例如：如果目录最低层级是四级标题(####)，则未知标题应使用五级标题(#####)
+
+3. 标题格式识别规则：
+   - 数字编号：1、2、3等
+   - 中文数字：一、二、三等
+   - 字母编号：A、B、C或a、b、c等
+   - 组合编号：1.1、1.2或(1)、(2)等
+   - 特殊标记：第X章、第X节等
+
+4. 删除内容（保持不变）：
+   - 所有图片及图片描述（包含![]的行）
+   - 致谢/acknowledgments部分
+   - 前言
+   - 参考文献/references
+   - 思考题以及课后习题
+   - 网络资源
+   - 连续多个没有文字描述的标题
+
+5. 保持其他内容不变：
+   - 正文内容
+   - 数学公式
+   - 表格
+   - 代码块
+
+以下是需要处理的文本内容：
+
+"""
+REARRANGE_PROMPT_TAIL = """
+
+以上是需要处理的文本内容：
+"""
+
+
+def chunk_bounds(newlines: List[int], length: int, limit: int) -> List[Tuple[int, int]]:
+    """
+    根据已排好序的换行位置，用二分查找计算每个块的起止下标
+    每个块不超过limit，只在换行处切分；单行超过limit时整行作为一个块
+    """
+    bounds = []
+    start = 0
+    while start < length:
+        end = start + limit
+        if end >= length:
+            end = length
+        else:
+            # 最后一个不超过end的换行位置
+            idx = bisect.bisect_right(newlines, end) - 1
+            if idx >= 0 and newlines[idx] >= start:
+                end = newlines[idx]
+            else:
+                idx = bisect.bisect_left(newlines, end)
+                end = newlines[idx] if idx < len(newlines) else length
+        bounds.append((start, end))
+        # end < length 时 end 一定是换行位置，跳过它，合并时用'\n'连接即可还原
+        start = end + 1 if end < length else end
+    return bounds
+
+def split_into_chunks(content: str, limit: int = CHUNK_CHARS) -> Tuple[str, ...]:
+    """
+    按字符数将文本切分为不超过limit的块，只在换行处切分
+    一次性找出所有换行位置，再用二分查找确定切分点
+    """
+    newlines = [match.start() for match in NEWLINE_PATTERN.finditer(content)]
+    return tuple(content[start:end] for start, end in chunk_bounds(newlines, len(content), limit))
+
+def limit_chunk_tokens(chunks: Sequence[str], max_tokens: int = MAX_CHUNK_TOKENS) -> Tuple[str, ...]:
+    """
+    token数二次检查：超过max_tokens的块按一半长度在换行处继续切分，直到满足限制
+    未安装tiktoken时直接返回原块
+    """
+    if tiktoken is None:
+        return tuple(chunks)
+    enc = tiktoken.encoding_for_model("gpt-4o-mini")
+    result = []
+    stack = list(reversed(chunks))
+    while stack:
+        chunk = stack.pop()
+        if len(enc.encode_ordinary(chunk)) > max_tokens:
+            parts = split_into_chunks(chunk, max(len(chunk) // 2, 1))
+            if len(parts) > 1:  # 单行无法再切分时保留原块
+                stack.extend(reversed(parts))
+                continue
+        result.append(chunk)
+    return tuple(result)
 
 class TOCExtractor:
     def __init__(self, input_path, output_dir, api_key):
@@ -70,6 +259,7 @@ class TOCExtractor:
                 model="gpt-4o-mini",     
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.3,
+                max_tokens=MAX_REPLY_TOKENS,
                 top_p=1.0,
                 frequency_penalty=0.0,
                 presence_penalty=0.0
@@ -87,72 +277,7 @@ class TOCExtractor:
         # 按字符长度分割
         for i in range(0, len(content), chunk_size):
             chunk = content[i:i + chunk_size]
-            prompt = """
-            你是一个文本处理专家，我将分段给你输入一本书的内容，从以下文本中识别目录部分，并将其转换为Markdown格式（用#表示层级）的目录。
-            你只是处理文本，不要做任何评价或者描述。
-            因为输入长度限制，目录可能分布在两次或者多次相邻输入的分段中，请记住上一段的处理方式，保持一致，不要偷懒！！！
-
-            规则：
-            1. 目录识别特征：
-               - 标题编号密集出现的段落
-               - 连续多个X章,X节,或者数字编号12345一二三四五的短文本
-               - 每行都是类似标题的短文本或者连续多个短文本
-               - 句子中可能带有页码（需要删除）
-            
-            2. 标题层级判断规则：
-               目录部分相邻多个具有并列层级结构的内容需要被识别为同一层级：
-               文字前用于表示章节限定的数字（如1，1.1，1.1.1）或者符号（a,b,c）越多，则标题的级别越低。
-               举例：
-               第一级：
-               - 第X章
-               - 第X部分
-               
-               第二级：
-               - 第X节
-               - X.X（如1.1、2.1等）
-               
-               第三级：
-               - X.X.X（如1.1.1、2.1.1等）
-               - 一、二、三等中文数字编号
-               - 1、2、3等阿拉伯数字编号
-               
-               第四级：
-               - (一)、(二)、(三)等带括号的中文数字
-               - (1)、(2)、(3)等带括号的阿拉伯数字
-               - A、B、C等字母编号
-               
-               第五级：
-               - a)、b)、c)等小写字母编号
-               - 1)、2)、3)等带括号的数字
-               
-               特殊规则：
-               - 删除Box、图、表、注解等特殊内容
-               - 保持章节的连续性和层级关系
-               - 确保每个标题都有对应的层级标记
-            
-            3. 输出要求：
-               - 只输出Markdown格式的目录（只用#的多少来标注层级）
-               - 保持原有的层级关系
-               - 删除包含"思考题"、"参考文献"、"练习题"和"附录"的部分
-               - 删除所有页码
-               - 确保每一行都有标题层级标记
-               - 标题之间用换行分隔
-            
-            4. 输出的示例
-                # 第一篇 结构生物化学
-                ## 第一章 绪论
-                ### 第一节 生物化学发展简史
-                ### 第二节 生物化学的主要内容及其应用
-                ### 第三节 生物化学学习方法
-
-                ## 第二章 蛋白质的结构与功能
-                ### 第一节 氨基酸
-                #### 一 氨基酸的结构和分类
-                #### 二 氨基酸的性质
-                #### 三 氨基酸的功能
-            以下是要处理的文本内容：
-            """ + chunk
-            """以上是要处理的文本内容"""
+            prompt = TOC_PROMPT + chunk
             try:
                 response = self.generate_response(prompt)
                 toc_parts.append(response.strip())
@@ -164,13 +289,19 @@ class TOCExtractor:
         full_toc = '\n'.join(toc_parts)
         return full_toc
             
-    def toc_from_file(self):
-        """处理文件并保存目录"""
+    def toc_from_file(self, content=None):
+        """
+        处理文件并保存目录
+        :param content: 已读取的文件内容，为None时从input_path读取
+        """
+        toc = ""
         try:
             # 读取输入文件
-            self.logger.info(f"开始读取文件: {self.input_path}")
-            with open(self.input_path, 'r', encoding='utf-8') as f:
-                content = f.read()[:20000]  # 只处理前20000字符
+            if content is None:
+                self.logger.info(f"开始读取文件: {self.input_path}")
+                with open(self.input_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            content = content[:20000]  # 只处理前20000字符
             
             # 提取目录
             self.logger.info("开始提取目录")
@@ -202,12 +333,13 @@ class TOCExtractor:
 """
 
     
-def process_markdown_file(input_path, output_dir, api_key):
+def process_markdown_file(input_path, output_dir, api_key, max_workers=8):
     """
     处理Markdown文件：提取目录并重新排列标题层级
     :param input_path: 输入文件路径
     :param output_dir: 输出文件路径
     :param api_key: OpenAI API密钥
+    :param max_workers: 同时处理的文本块数量
     """
     try:
         # 创建提取器实例 - 只传入 api_key
@@ -217,88 +349,30 @@ def process_markdown_file(input_path, output_dir, api_key):
         with open(input_path, 'r', encoding='utf-8') as f:
             content = f.read()
         
-        # 首先提取目录结构
-        toc_content = extractor.toc_from_file()
+        # 首先提取目录结构，复用已读取的内容
+        toc_content = extractor.toc_from_file(content)
         extractor.logger.info("目录提取完成")
         
         # 将内容分成较小的块进行处理
-        lines = content.split('\n')
-        chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for line in lines:
-            line_length = len(line)
-            if current_length + line_length > 4000:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = []
-                current_length = 0
-            current_chunk.append(line)
-            current_length += line_length
+        chunks = limit_chunk_tokens(split_into_chunks(content))
         
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
+        # 目录在整本书中不变，提示词前缀只拼接一次
+        prompt_prefix = REARRANGE_PROMPT_HEAD + toc_content + REARRANGE_PROMPT_MID
         
-        # 处理每个文本块
-        processed_chunks = []
-        for i, chunk in enumerate(chunks):
-            prompt = f"""系统：你是一个专业的文档处理助手。我在prompt中给出了一本书的目录结构，请参考目录结构按照以下规则处理这本书中的文本，只返回处理后的文本内容，不要添加任何解释或总结。
-这本书很长，因此我拆分成多段提供给你。在处理不同段的时候，你的处理逻辑是不变的。
-
-以下是目录结构：
-{toc_content}
-以上是目录结构：
-
-处理规则：
-1. 标题层级规则：
-   - 仔细分析目录中的标题格式和层级关系，整本书的目录格式是一致的，请保持一致。
-   - 例如：如果目录中"第X章"使用一级标题(#)，那么正文中所有"第X章"也应使用一级标题
-   - 例如：如果目录中"X.X节"使用二级标题(##)，那么正文中所有"X.X节"也应使用二级标题
-   - 保持与目录中相同标题格式的一致性
-   - 标题的限定越多，层级越低。比如：2.2是二级标题，那么2.2.1应使用三级标题。
-
-2. 未出现在目录中的标题处理：
-   - 识别目录中最低层级的标题格式
-   - 将未在目录中出现的标题设置为比目录最低层级更低一级
-   - 相似格式的未知标题应保持相同的层级
-   - 例如：如果目录最低层级是四级标题(####)，则未知标题应使用五级标题(#####)
-
-3. 标题格式识别规则：
-   - 数字编号：1、2、3等
-   - 中文数字：一、二、三等
-   - 字母编号：A、B、C或a、b、c等
-   - 组合编号：1.1、1.2或(1)、(2)等
-   - 特殊标记：第X章、第X节等
-
-4. 删除内容（保持不变）：
-   - 所有图片及图片描述（包含![]的行）
-   - 致谢/acknowledgments部分
-   - 前言
-   - 参考文献/references
-   - 思考题以及课后习题
-   - 网络资源
-   - 连续多个没有文字描述的标题
-
-5. 保持其他内容不变：
-   - 正文内容
-   - 数学公式
-   - 表格
-   - 代码块
-
-以下是需要处理的文本内容：
-
-{chunk}
-
-以上是需要处理的文本内容：
-"""
-            
+        # 并发处理每个文本块，executor.map 保证结果按原顺序返回
+        def process_chunk(indexed_chunk):
+            i, chunk = indexed_chunk
+            prompt = prompt_prefix + chunk + REARRANGE_PROMPT_TAIL
             try:
                 extractor.logger.info(f"正在处理第 {i+1}/{len(chunks)} 个文本块")
                 response = extractor.generate_response2(prompt)
-                processed_chunks.append(response.strip())
+                return response.strip()
             except Exception as e:
                 extractor.logger.error(f"处理第 {i+1} 个文本块时失败: {str(e)}")
-                processed_chunks.append(chunk)  # 如果处理失败，保留原文
+                return chunk  # 如果处理失败，保留原文
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            processed_chunks = list(executor.map(process_chunk, enumerate(chunks)))
         
         # 合并处理后的文本块
         final_content = '\n'.join(processed_chunks)
@@ -5,17 +5,54 @@
 import re
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+# 分割内容的位置：一级到三级标题所在行的行首
+SECTION_BOUNDARY_PATTERN = re.compile(r'^#{1,3}\s', re.MULTILINE)
+# 每个分块开头的标题及其后的正文
+SECTION_HEADER_PATTERN = re.compile(r'^(#{1,3})\s+(.+?)\n([\s\S]*)')
+# 正文中需要移除的四级及以上标题
+STRIP_HEADER_MARK = '####'
+STRIP_HEADER_PATTERN = re.compile(r'^#{4,}\s+.*$', re.MULTILINE)
+# 估算分块大小时，JSON键名和标点占用的字符数
+SUBSECTION_OVERHEAD = 64
+
+def save_json_file(data, file_path):
+    """以2空格缩进写入JSON文件，优先使用 orjson 序列化（直接输出UTF-8字节），一次写入整个文件"""
+    if orjson is not None:
+        Path(file_path).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        return
+    Path(file_path).write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding='utf-8')
+
+def iter_sections(content):
+    """
+    按标题位置逐个切出分块，依次返回(标题级别, 标题, 正文)
+    用finditer找分割位置，不再先把所有分块存成列表
+    """
+    starts = [0] + [match.start() for match in SECTION_BOUNDARY_PATTERN.finditer(content)]
+    ends = starts[1:] + [len(content)]
+    for start, end in zip(starts, ends):
+        section = content[start:end].strip()
+        if not section:
+            continue
+        # 检查标题级别和内容
+        header_match = SECTION_HEADER_PATTERN.match(section)
+        if not header_match:
+            continue
+        yield len(header_match.group(1)), header_match.group(2).strip(), header_match.group(3)
 
 def split_and_parse_markdown(file_path, max_chars=100000):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    content = Path(file_path).read_text(encoding='utf-8')
     
     book_name = os.path.basename(file_path)
     
-    # 分割内容，保留标题层级信息
-    sections = re.split(r'(?=^#\s|^##\s|^###\s)', content, flags=re.MULTILINE)
-    sections = [s.strip() for s in sections if s.strip()]
-    
     current_chapter = None
     current_section = None
     current_part = 1
@@ -23,15 +60,11 @@ def split_and_parse_markdown(file_path, max_chars=100000):
     current_subsections = []
     all_json_structures = []
     
-    for section in sections:
-        # 检查标题级别和内容
-        header_match = re.match(r'^(#{1,3})\s+(.+?)\n([\s\S]*)', section)
-        if not header_match:
-            continue
-            
-        level = len(header_match.group(1))
-        title = header_match.group(2).strip()
-        content = re.sub(r'^#{4,}\s+.*$', '', header_match.group(3), flags=re.MULTILINE).strip()
+    for level, title, content in iter_sections(content):
+        # 大多数小节没有深层标题，先用子串查找判断，只有包含时才做正则替换
+        if STRIP_HEADER_MARK in content:
+            content = STRIP_HEADER_PATTERN.sub('', content)
+        content = content.strip()
         
         # 更新章节信息
         if level == 1:
@@ -51,8 +84,8 @@ def split_and_parse_markdown(file_path, max_chars=100000):
             }
         
             
-            # 检查是否需要创建新文件
-            section_chars = len(json.dumps(subsection, ensure_ascii=False))
+            # 检查是否需要创建新文件，按字段长度估算大小，不必为此序列化JSON
+            section_chars = sum(len(value) for value in subsection.values() if value) + SUBSECTION_OVERHEAD
             if current_chars + section_chars > max_chars and current_subsections:
                 # 保存当前部分
                 json_structure = {
@@ -80,86 +113,54 @@ def split_and_parse_markdown(file_path, max_chars=100000):
     
     return all_json_structures
 
-def save_split_json(json_structures, output_dir, original_filename):
-    base_name = os.path.splitext(original_filename)[0]
-    
-    for i, json_structure in enumerate(json_structures, 1):
-        output_filename = f"{base_name}_part{i}.json"
-        output_path = os.path.join(output_dir, output_filename)
-        
-        try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(json_structure, f, ensure_ascii=False, indent=2)
-            print(f"Successfully saved part {i} to {output_filename}")
-        except Exception as e:
-            print(f"Error saving {output_filename}: {str(e)}")
-
-def merge_json_parts(output_dir, base_filename):
+def save_merged_json(json_structures, output_dir, base_filename):
     """
-    合并同一个文件的所有部分为一个完整的JSON文件
+    将内存中各部分的小节合并为一个完整的JSON文件
     """
-    base_name = os.path.splitext(base_filename)[0]
-    merged_subsections = []
-    part_files = []
-    
-    # 收集所有相关的部分文件
-    for filename in os.listdir(output_dir):
-        if filename.startswith(base_name) and '_part' in filename:
-            part_files.append(filename)
-    
-    # 按照部分号排序
-    part_files.sort(key=lambda x: int(re.search(r'part(\d+)', x).group(1)))
-    
-    # 合并所有部分
-    for part_file in part_files:
-        part_path = os.path.join(output_dir, part_file)
-        try:
-            with open(part_path, 'r', encoding='utf-8') as f:
-                part_data = json.load(f)
-                merged_subsections.extend(part_data['Subsections'])
-            # 删除部分文件
-            os.remove(part_path)
-        except Exception as e:
-            print(f"Error processing part file {part_file}: {str(e)}")
-    
-    # 创建最终的合并文件
     merged_structure = {
         "Book": base_filename,
-        "Subsections": merged_subsections
+        "Subsections": [
+            subsection
+            for json_structure in json_structures
+            for subsection in json_structure['Subsections']
+        ]
     }
     
-    # 保存合并后的文件
     output_path = os.path.join(output_dir, base_filename.replace('.md', '.json'))
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(merged_structure, f, ensure_ascii=False, indent=2)
+        save_json_file(merged_structure, output_path)
         print(f"Successfully merged all parts into {output_path}")
     except Exception as e:
         print(f"Error saving merged file: {str(e)}")
 
-def process_directory(input_dir, output_dir):
+def process_file(input_path, output_dir):
+    """处理单个markdown文件（模块级函数，便于多进程调用）"""
+    filename = os.path.basename(input_path)
+    try:
+        print(f"Processing {filename}")
+        # 1. 首先分割处理
+        json_structures = split_and_parse_markdown(input_path)
+        print(f"Successfully processed {filename} into {len(json_structures)} parts")
+        # 2. 直接在内存中合并所有部分并写出，不再写入再读回部分文件
+        save_merged_json(json_structures, output_dir, filename)
+    except Exception as e:
+        print(f"Error processing {filename}: {str(e)}")
+
+def process_directory(input_dir, output_dir, max_workers=None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.md'):
-            input_path = os.path.join(input_dir, filename)
-            
-            try:
-                print(f"Processing {filename}")
-                # 1. 首先分割处理
-                json_structures = split_and_parse_markdown(input_path)
-                # 2. 保存各个部分
-                save_split_json(json_structures, output_dir, filename)
-                print(f"Successfully processed {filename} into {len(json_structures)} parts")
-                # 3. 合并所有部分
-                merge_json_parts(output_dir, filename)
-            except Exception as e:
-                print(f"Error processing {filename}: {str(e)}")
+    with os.scandir(input_dir) as entries:
+        md_files = [entry.path for entry in entries if entry.name.endswith('.md') and entry.is_file()]
+    
+    # 各文件相互独立，用多进程并行处理
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(process_file, md_files, repeat(output_dir)))
 
-# 设置输入输出目录
-input_directory = "/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/english_after_gpt"
-output_directory = "/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/english_book/books_json"
+if __name__ == "__main__":
+    # 设置输入输出目录
+    input_directory = "/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/english_after_gpt"
+    output_directory = "/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/english_book/books_json"
 
-# 处理整个目录
-process_directory(input_directory, output_directory)
\ No newline at end of file
+    # 处理整个目录
+    process_directory(input_directory, output_directory)
@@ -5,9 +5,81 @@
 """
 
 import re
+import string
 import logging
 import os
 from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+# 日志在模块加载时配置一次，所有MarkdownProcessor实例（包括子进程中的）共用
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# 所有标题识别用的正则在模块加载时编译一次，处理每一行时直接调用
+# 行首的#和去掉#及首尾空白后的内容，行首有空白时#保留在内容中
+HASH_HEADER_PATTERN = re.compile(r'^(#*)\s*(.*\S)?')
+# 可能是标题的行去掉首尾空白后的首字符（数字另用isdecimal判断，与正则中的\d一致）
+HEADER_FIRST_CHARS = frozenset('#第一二三四五六七八九十(' + string.ascii_uppercase)
+# 判断一行是否可能是标题
+HEADER_CANDIDATE_PATTERN = re.compile(r'^\s*(?:第[一二三四五六七八九十]+(?:章|节|部分)|[一二三四五六七八九十]+、|\d+\.|\d+、|\((?:\d+|[一二三四五六七八九十]+)\)|Chapter|Section|Part|\d+\.|[A-Z]\.)')
+
+# 需要跳过的章节（思考题、参考文献、文献导读、小结）的关键词，合并成一个正则只扫描一遍
+SKIP_SECTION_PATTERN = re.compile(r'思考题|Exercises|参考文献|References|文献导读|Literature Guide|小结|Summary')
+
+# 各级标题的正则按优先级排列，合并成一个带命名分组的正则，每行只匹配一次
+# Python的re按顺序尝试各分支，所以排在前面的分组优先
+# 能被排在前面的分支覆盖的模式已删去，包括带[^\n]*?惰性匹配、在不匹配的行上会反复回溯的括号注释模式
+HEADER_LEVEL_PATTERNS = (
+    # 一级标题: 中英文的完整"第X章"/"Chapter X"格式
+    ('h1', 1, (
+        r'^\s*第[一二三四五六七八九十百]+章(?:\s|$)',
+        r'(?i:^\s*CHAPTER\s+\d+(?:\s|$))',
+        r'^\s*\d+(?:\s|$)',
+    )),
+    # 二级标题: "第X节"、"Section X"、"Part X"等格式
+    ('h2', 2, (
+        r'^\s*第[一二三四五六七八九十百]+(?:节|部分)',
+        r'^\s*绪论',
+        r'^\s*\d+\.\d+(?![\.\d])',
+        r'(?i:^\s*SECTION\s+\d+(?:\s|$))',
+        r'(?i:^\s*PART\s+\d+(?:\s|$))',
+        r'^\s*\d+\.\d+\s*[^\.0-9]',
+    )),
+    # 二级标题: X.X格式（紧凑格式）
+    ('h2_compact', 2, (
+        r'^\s*\d+\.\d+(?![\s\.]*\d)\S',
+        r'^\s*\d+\.\d+(?![\s\.]*\d)',
+        r'^\s*\d+\.\d+[^\.]\S+',
+    )),
+    # 二级标题: X. X格式（带空格）
+    ('h2_spaced', 2, (
+        r'^\s*\d+\s*\.\s*\d+\s+\S',
+    )),
+    # 三级标题
+    ('h3', 3, (
+        r'^\s*[一二三四五六七八九十百]+、',
+        r'^\s*\d+\.\d+\.\d+(?![\.\d])',
+        r'^\s*\d+\.\d+\.\d+\s*[^\.0-9]',
+        r'^\s*\d+、\s*\S',
+    )),
+    # 四级标题: 带括号的数字、中文数字或X.X.X.X格式
+    ('h4', 4, (
+        r'^\s*[\(（]\s*(?:\d+|[一二三四五六七八九十百]+)\s*[\)）]',
+        r'^\s*\d+\.\d+\.\d+\.\d+',
+        r'^\s*\d+\.\d+\.\d+\.\d+\s+\S',
+        r'^\s*\d+\.\d+\.\d+\.\d+(?![\s\.]*\d)',
+        r'^\s*[（\(][一二三四五六七八九十百]+[）\)]\s*\S',
+        r'^\s*\d+[\.．]\s*\S',
+        r'^\s*\d+\s*\S',
+        r'^\s*[A-Z]\.\s+',
+    )),
+)
+HEADER_PATTERN = re.compile('|'.join(
+    f"(?P<{name}>{'|'.join(patterns)})" for name, _, patterns in HEADER_LEVEL_PATTERNS
+))
+# 分组名 -> 标题级别
+HEADER_LEVELS = {name: level for name, level, _ in HEADER_LEVEL_PATTERNS}
+LEVEL_NAMES = {2: '二', 3: '三', 4: '四'}
 
 class MarkdownProcessor:
     def __init__(self, input_path, output_path):
@@ -20,58 +92,33 @@ class MarkdownProcessor:
         self.input_path = input_path
         self.output_path = output_path
         
-        # 设置日志记录器
+        # 日志输出在模块加载时统一配置，这里只获取记录器
         self.logger = logging.getLogger('MarkdownProcessor')
         self.logger.setLevel(logging.INFO)
-        
-        if not self.logger.handlers:
-            handler = logging.StreamHandler()
-            formatter = logging.Formatter('%(message)s')
-            handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
 
-    def process_directory(self, input_dir, output_dir):
-        """处理整个文件夹的markdown文件"""
+    def process_directory(self, input_dir, output_dir, max_workers=None):
+        """处理整个文件夹的markdown文件，各文件相互独立，用多进程并行处理"""
         # 确保输出目录存在
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        # 获取所有markdown文件
-        md_files = [f for f in os.listdir(input_dir) if f.endswith('.md')]
+        # 获取所有markdown文件，scandir直接给出文件名和完整路径
+        with os.scandir(input_dir) as entries:
+            md_files = [entry for entry in entries if entry.name.endswith('.md') and entry.is_file()]
         
         self.logger.info(f"找到 {len(md_files)} 个markdown文件")
         
-        # 处理每个文件
-        for filename in md_files:
-            input_path = os.path.join(input_dir, filename)
-            output_path = os.path.join(output_dir, filename)
-            
-            self.logger.info(f"\n开始处理文件: {filename}")
-            try:
-                # 读取文件
-                with open(input_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # 处理内容
-                processed_content = self.process_markdown(content)
-                
-                # 写入新文件
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    f.write(processed_content)
-                
-                self.logger.info(f"成功处理文件: {filename}")
-                
-            except Exception as e:
-                self.logger.error(f"处理文件 {filename} 时发生错误: {str(e)}")
+        # 处理每个文件，子进程只接收路径字符串，不传递self
+        input_paths = [entry.path for entry in md_files]
+        output_paths = [os.path.join(output_dir, entry.name) for entry in md_files]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(process_single_file, input_paths, output_paths))
 
     def process_markdown(self, content):
         """Process markdown content"""
         self.logger.info("开始处理markdown文件 / Start processing markdown file")
         
         lines = content.split('\n')
-        processed_lines = []
-        skip_section = False
-        current_line_number = 0
         
         # Add table of contents collection list
         table_of_contents = []
@@ -83,188 +130,134 @@ class MarkdownProcessor:
             'converted_to_text': 0
         }
         
+        # 逐行处理的结果由生成器直接交给join，不再逐行append到中间列表
+        processed_content = '\n'.join(self.iter_processed_lines(lines, stats, table_of_contents))
+        
+        # Record statistics
+        self.logger.info("\n处理总结 / Processing Summary:")
+        self.logger.info(f"- 删除图片数量 / Removed images: {stats['removed_images']}")
+        self.logger.info(f"- 删除章节数量 / Removed sections: {stats['removed_sections']}")
+        self.logger.info(f"- 修改标题数量 / Modified headers: {stats['modified_headers']}")
+        self.logger.info(f"- 转换为正文数量 / Converted to text: {stats['converted_to_text']}")
+        
+        # Generate table of contents
+        # 整个目录拼成一条日志输出，不再每个标题调用一次logger.info
+        if self.logger.isEnabledFor(logging.INFO):
+            toc_lines = ["\n文档目录结构 / Document Structure:"]
+            toc_lines.extend(f"{'  ' * (level - 1)}{title}" for level, title in table_of_contents)
+            self.logger.info('\n'.join(toc_lines))
+        
+        return processed_content
+
+    def iter_processed_lines(self, lines, stats, table_of_contents):
+        """
+        逐行处理markdown内容，依次返回保留下来的行
+        统计信息和识别出的目录直接写入传入的stats和table_of_contents
+        """
+        skip_section = False
+        current_line_number = 0
+        
+        # 日志级别在循环外判断一次，级别未开启时不再为每行格式化日志字符串
+        log_info = self.logger.isEnabledFor(logging.INFO)
+        log_debug = self.logger.isEnabledFor(logging.DEBUG)
+        
+        # 上一个空行之后是否出现过图片标记，正向遍历时维护，不再逐行向上回溯
+        after_image = False
+        
         for i, line in enumerate(lines):
             current_line_number += 1
+            # 每行只strip一次，后面的判断和日志都复用
+            stripped = line.strip()
+            
+            # 当前行之前（到最近的空行为止）有图片标记，则当前行属于图片说明区域
+            in_image_desc = after_image
+            if not stripped:
+                after_image = False
+            elif '![' in line:
+                after_image = True
             
             # Skip sections like exercises, references, literature guide and summary
-            if any(keyword in line for keyword in [
-                '思考题', 'Exercises', 
-                '参考文献', 'References',
-                '文献导读', 'Literature Guide', 
-                '小结', 'Summary'
-            ]):
+            if SKIP_SECTION_PATTERN.search(line):
                 skip_section = True
                 stats['removed_sections'] += 1
-                self.logger.info(f"行 {current_line_number}: 开始跳过章节 \"{line.strip()}\" / Line {current_line_number}: Start skipping section \"{line.strip()}\"")
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 开始跳过章节 \"{stripped}\" / Line {current_line_number}: Start skipping section \"{stripped}\"")
                 continue
                 
-            if skip_section and line.strip().startswith('#'):
+            if skip_section and stripped.startswith('#'):
                 skip_section = False
-                self.logger.info(f"行 {current_line_number}: 结束跳过章节")
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 结束跳过章节")
                 
             if skip_section:
-                self.logger.debug(f"行 {current_line_number}: 跳过内容 \"{line.strip()}\"")
+                if log_debug:
+                    self.logger.debug(f"行 {current_line_number}: 跳过内容 \"{stripped}\"")
                 continue
                 
             # 跳过图片及其多行说明文字
             if '![' in line:
                 stats['removed_images'] += 1
-                self.logger.info(f"行 {current_line_number}: 删除图片标签 \"{line.strip()}\"")
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 删除图片标签 \"{stripped}\"")
                 continue
             
             # 检查是否处于图片描述区域
-            if i > 0:
-                # 向上查找最近的非空行
-                j = i - 1
-                in_image_desc = False
-                while j >= 0:
-                    if not lines[j].strip():  # 遇到空行
-                        break
-                    if '![' in lines[j]:  # 找到图片标记
-                        in_image_desc = True
-                        break
-                    j -= 1
-                
-                if in_image_desc and line.strip():  # 如果是图片描述区域且当前行非空
-                    self.logger.info(f"行 {current_line_number}: 删除图片说明文字 \"{line.strip()}\"")
-                    continue
+            if in_image_desc and stripped:  # 如果是图片描述区域且当前行非空
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 删除图片说明文字 \"{stripped}\"")
+                continue
                 
             # Process headers
-            if line.strip().startswith('#') or re.match(r'^\s*(?:第[一二三四五六七八九十]+(?:章|节|部分)|[一二三四五六七八九十]+、|\d+\.|\d+、|\((?:\d+|[一二三四五六七八九十]+)\)|Chapter|Section|Part|\d+\.|[A-Z]\.)', line.strip()):
-                original_line = line
-                header_content = line.lstrip('#').strip() if line.strip().startswith('#') else line.strip()
-                modified = False
-                
-                # Level 1 header: Match complete "Chapter X" format in both languages
-                if re.match(r'^\s*第[一二三四五六七八九十百]+章(?:\s|$)', header_content) or \
-                   re.match(r'^\s*CHAPTER\s+\d+(?:\s|$)', header_content, re.IGNORECASE) or \
-                   re.match(r'^\s*\d+(?:\s|$)', header_content):
-                    line = f"# {header_content}"
-                    table_of_contents.append((1, header_content))
-                    modified = True
-                
-                
-                # Level 2 header: Match "Section X", "Part X", etc. in both languages
-                elif re.match(r'^\s*第[一二三四五六七八九十百]+(?:节|部分)', header_content) or \
-                     re.match(r'^\s*绪论', header_content) or \
-                     re.match(r'^\s*\d+\.\d+(?![\.\d])', header_content) or \
-                     re.match(r'^\s*SECTION\s+\d+(?:\s|$)', header_content, re.IGNORECASE) or \
-                     re.match(r'^\s*PART\s+\d+(?:\s|$)', header_content, re.IGNORECASE) or \
-                     re.match(r'^\s*\d+\.\d+\s*[^\.0-9]', header_content):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                    
-                # 二级标题: X.X格式（紧凑格式）
-                elif re.match(r'^\s*\d+\.\d+(?![\s\.]*\d)\S', header_content) or \
-                   re.match(r'^\s*\d+\.\d+(?![\s\.]*\d)', header_content) or \
-                   re.match(r'^\s*\d+\.\d+[^\.]\S+', header_content):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                    
-                # 二级标题: X. X格式（带空格）
-                elif re.match(r'^\s*\d+\s*\.\s*\d+\s+\S', header_content):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                    
-                # 二级标题: X. X 格式带括号注释
-                elif re.match(r'^\s*\d+\.\s*\d+\s+[^\n]*?\([\w\s]+\)', header_content):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-                    
-                
-                # Level 3 header: Match various formats
-                elif re.match(r'^\s*[一二三四五六七八九十百]+、', header_content) or \
-                     re.match(r'^\s*\d+\.\d+\.\d+(?![\.\d])', header_content) or \
-                     re.match(r'^\s*\d+\.\d+\.\d+\s*[^\.0-9]', header_content) or \
-                     re.match(r'^\s*\d+\.\d+\.\d+\s+[^\n]*', header_content) or \
-                     re.match(r'^\s*\d+、\s*\S', header_content):
-                    line = f"### {header_content}"
-                    table_of_contents.append((3, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改三级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                
-                # 四级标题: 带括号的数字、中文数字或X.X.X.X格式
-                elif re.match(r'^\s*[\(（]\s*(?:\d+|[一二三四五六七八九十百]+)\s*[\)）]', header_content) or \
-                     re.match(r'^\s*\d+\.\d+\.\d+\.\d+', header_content) or \
-                     re.match(r'^\s*\d+\.\d+\.\d+\.\d+\s+[^\n]*?\([\w\s]+\)', header_content) or \
-                     re.match(r'^\s*\d+\.\d+\.\d+\.\d+\s+\S', header_content) or \
-                     re.match(r'^\s*\d+\.\d+\.\d+\.\d+(?![\s\.]*\d)', header_content) or \
-                     re.match(r'^\s*[（\(][一二三四五六七八九十百]+[）\)]\s*\S', header_content) or \
-                     re.match(r'^\s*\d+[\.．]\s*\S', header_content) or \
-                     re.match(r'^\s*\d+\s*\S', header_content) or \
-                     re.match(r'^\s*[A-Z]\.\s+', header_content):
-                    line = f"#### {header_content}"
-                    table_of_contents.append((4, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改四级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                
-                # 如果不符合任何标题格式，设置为三级标题
-                if not modified:
+            # 先按首字符预筛选，绝大多数正文行直接保留，不进入正则匹配
+            first_char = stripped[:1]
+            if first_char not in HEADER_FIRST_CHARS and not first_char.isdecimal():
+                yield line
+                continue
+            
+            # 一次匹配同时得到行首的#和去掉#及首尾空白后的标题内容
+            hashes, header_content = HASH_HEADER_PATTERN.match(line).group(1, 2)
+            header_content = header_content or ''
+            if hashes or header_content.startswith('#') or HEADER_CANDIDATE_PATTERN.match(header_content):
+                # 一次匹配确定标题级别，由命名分组分派
+                match = HEADER_PATTERN.match(header_content)
+                if match:
+                    level = HEADER_LEVELS[match.lastgroup]
+                    line = f"{'#' * level} {header_content}"
+                    table_of_contents.append((level, header_content))
+                    if level > 1 and log_info:
+                        self.logger.info(
+                            f"行 {current_line_number}: 修改{LEVEL_NAMES[level]}级标题\n"
+                            f"  原文: {stripped}\n"
+                            f"  修改后: {line.strip()}"
+                        )
+                else:
+                    # 如果不符合任何标题格式，设置为三级标题
                     line = f"### {header_content}"
                     table_of_contents.append((3, header_content))
                     stats['modified_headers'] += 1
-                    self.logger.info(f"行 {current_line_number}: 将不规范标题设置为三级标题 / Line {current_line_number}: Set non-standard header to level 3")
-                    self.logger.info(f"  原文 / Original: {original_line.strip()}")
-                    self.logger.info(f"  修改后 / Modified: {line.strip()}")
+                    if log_info:
+                        self.logger.info(
+                            f"行 {current_line_number}: 将不规范标题设置为三级标题 / Line {current_line_number}: Set non-standard header to level 3\n"
+                            f"  原文 / Original: {stripped}\n"
+                            f"  修改后 / Modified: {line.strip()}"
+                        )
 
             
-            processed_lines.append(line)
-        
-        # Record statistics
-        self.logger.info("\n处理总结 / Processing Summary:")
-        self.logger.info(f"- 删除图片数量 / Removed images: {stats['removed_images']}")
-        self.logger.info(f"- 删除章节数量 / Removed sections: {stats['removed_sections']}")
-        self.logger.info(f"- 修改标题数量 / Modified headers: {stats['modified_headers']}")
-        self.logger.info(f"- 转换为正文数量 / Converted to text: {stats['converted_to_text']}")
-        
-        # Generate table of contents
-        self.logger.info("\n文档目录结构 / Document Structure:")
-        for level, title in table_of_contents:
-            indent = "  " * (level - 1)
-            self.logger.info(f"{indent}{title}")
-        
-        return '\n'.join(processed_lines)
+            yield line
 
     def process_file(self, input_path, output_path):
         """处理文件的主函数"""
         try:
             # 读取文件
             self.logger.info(f"开始读取文件: {input_path}")
-            with open(input_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            content = Path(input_path).read_text(encoding='utf-8')
             
             # 处理内容
             processed_content = self.process_markdown(content)
             
             # 写入新文件
             self.logger.info(f"写入处理后的文件: {output_path}")
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(processed_content)
+            Path(output_path).write_text(processed_content, encoding='utf-8')
             
             self.logger.info("文件处理完成")
             return True
@@ -285,6 +278,27 @@ class MarkdownProcessor:
             self.logger.error(f"输入路径不存在: {self.input_path}")
             return False
 
+def process_single_file(input_path, output_path):
+    """在子进程中处理单个markdown文件（模块级函数，便于多进程调用）"""
+    processor = MarkdownProcessor(input_path, output_path)
+    filename = os.path.basename(input_path)
+    
+    processor.logger.info(f"\n开始处理文件: {filename}")
+    try:
+        # 读取文件
+        content = Path(input_path).read_text(encoding='utf-8')
+        
+        # 处理内容
+        processed_content = processor.process_markdown(content)
+        
+        # 写入新文件
+        Path(output_path).write_text(processed_content, encoding='utf-8')
+        
+        processor.logger.info(f"成功处理文件: {filename}")
+        
+    except Exception as e:
+        processor.logger.error(f"处理文件 {filename} 时发生错误: {str(e)}")
+
 def main():
     # 设置输入文件路径和输出目录
     input_path = "/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/合并的质量不好/books_processed2"  # 替换为实际的输入目录路径
@@ -4,20 +4,109 @@
 """
 
 import re
+import string
+import array
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 import os
 from datetime import datetime
+from itertools import islice, repeat
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+# 所有标题识别用的正则在模块加载时编译一次，处理每一行时直接调用
+# 可能是标题的行去掉首尾空白后的首字符（数字另用isdecimal判断，与正则中的\d一致）
+HEADER_FIRST_CHARS = frozenset('#第一二三四五六七八九十(' + string.ascii_uppercase)
+# 判断一行是否可能是标题
+HEADER_CANDIDATE_PATTERN = re.compile(r'(?:第[一二三四五六七八九十]+(?:章|节|部分)|[一二三四五六七八九十]+、|\d+\.|\d+、|\((?:\d+|[一二三四五六七八九十]+)\)|Chapter|Section|Part|\d+\.|[A-Z]\.)')
+
+# 需要跳过的章节（思考题、参考文献、文献导读、小结）的关键词，合并成一个正则只扫描一遍
+SKIP_SECTION_PATTERN = re.compile(r'思考题|Exercises|参考文献|References|文献导读|Literature Guide|小结|Summary')
+
+# 各级标题的正则按优先级排列，合并成一个带命名分组的正则，每行只匹配一次
+# Python的re按顺序尝试各分支，所以排在前面的分组优先
+# 能被排在前面的分支覆盖的模式已删去，包括带[^\n]*?惰性匹配、在不匹配的行上会反复回溯的括号注释模式
+# 匹配的是已去掉首尾空白的标题内容，各模式不再以^\s*开头（match本身只从开头匹配）
+HEADER_LEVEL_PATTERNS = (
+    # 一级标题: 中英文的完整"第X章"/"Chapter X"格式
+    ('h1', 1, (
+        r'第[一二三四五六七八九十]+章(?:\s|$)',
+        r'第[一二三四五六七八九十]+章\s+\S+',
+        r'第\d+章(?:\s|$)',
+        r'第\d+章\s+\S+',
+        r'(?i:CHAPTER\s+\d+(?:\s|$))',
+        r'\d+(?:\s|$)',
+    )),
+    # 二级标题: "第X节"、"Section X"、"Part X"等格式
+    ('h2', 2, (
+        r'第[一二三四五六七八九十]+(?:节|部分)',
+        r'绪论',
+        r'\d+\.\d+(?![\.\d])',
+        r'(?i:SECTION\s+\d+(?:\s|$))',
+        r'(?i:PART\s+\d+(?:\s|$))',
+    )),
+    # 二级标题: X.X格式（紧凑格式）
+    ('h2_compact', 2, (
+        r'\d+\.\d+(?![\s\.]*\d)\S',
+        r'\d+\.\d+(?![\s\.]*\d)',
+        r'\d+\.\d+[^\.]\S+',
+    )),
+    # 二级标题: X. X格式（带空格）
+    ('h2_spaced', 2, (
+        r'\d+\s*\.\s*\d+\s+\S',
+    )),
+    # 二级标题: 中文序号加顿号（如"一、"）
+    ('h2_cn', 2, (
+        r'[一二三四五六七八九十]+、',
+    )),
+    # 三级标题
+    ('h3', 3, (
+        r'\d+\.\d+\.\d+(?![\s\.]*\d)',
+        r'\d+\.\d+\.\d+(?![\.\d])',
+        r'\d+、\s*\S',
+    )),
+    # 四级标题: 带括号的数字、中文字或X.X.X.X格式
+    ('h4', 4, (
+        r'[\(（]\s*(?:\d+|[一二三四五六七八九十]+)\s*[\)）]',
+        r'\d+\.\d+\.\d+\.\d+',
+        r'\d+\.\d+\.\d+\.\d+\s+\S',
+        r'\d+\.\d+\.\d+\.\d+(?![\s\.]*\d)',
+        r'[（\(][一二三四五六七八九十]+[）\)]\s*\S',
+        r'\d+[\.．]\s*\S',
+        r'\d+\s*\S',
+        r'[A-Z]\.\s+',
+    )),
+)
+HEADER_PATTERN = re.compile('|'.join(
+    f"(?P<{name}>{'|'.join(patterns)})" for name, _, patterns in HEADER_LEVEL_PATTERNS
+))
+# 分组名 -> 标题级别
+HEADER_LEVELS = {name: level for name, level, _ in HEADER_LEVEL_PATTERNS}
+LEVEL_NAMES = {2: '二', 3: '三', 4: '四'}
+
+# 读写文件时使用1MB缓冲
+IO_BUFFER_SIZE = 1 << 20
+
+def write_lines(f, lines):
+    """按行写出，行间用换行符分隔（与'\n'.join结果相同），不再拼出整篇文本"""
+    if not lines:
+        return
+    f.write(lines[0])
+    f.writelines('\n' + line for line in islice(lines, 1, None))
+
 class MarkdownProcessor:
-    def __init__(self, input_path, output_dir):
+    def __init__(self, input_path, output_dir, timestamp=None):
         """
         初始化处理器
         :param input_path: 输入文件的完整路径
         :param output_dir: 输出目录的路径
+        :param timestamp: 输出文件名和日志文件名中的时间戳，批量处理时由调用方统一传入
         """
         self.input_path = input_path
         self.output_dir = output_dir
+        self.timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
         
         # 设置日志
         self.setup_logging()
@@ -29,35 +118,47 @@ class MarkdownProcessor:
         input_filename = os.path.basename(input_path)
         self.output_path = os.path.join(
             output_dir, 
-            f"processed_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{input_filename}"
+            f"processed_{self.timestamp}_{input_filename}"
         )
 
     def setup_logging(self):
-        """设置日志配置"""
-        log_filename = f"markdown_processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-        log_path = os.path.join(self.output_dir, log_filename)
-        
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_path, encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
+        """
+        设置日志配置
+        文件和终端的写入由后台线程的QueueListener完成，处理线程只把日志记录放入队列
+        """
+        root_logger = logging.getLogger()
+        # 与basicConfig一致：根记录器已有处理器时不再重复配置
+        if not root_logger.handlers:
+            log_filename = f"markdown_processing_{self.timestamp}.log"
+            log_path = os.path.join(self.output_dir, log_filename)
+            
+            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+            file_handler = logging.FileHandler(log_path, encoding='utf-8')
+            stream_handler = logging.StreamHandler()
+            file_handler.setFormatter(formatter)
+            stream_handler.setFormatter(formatter)
+            
+            log_queue = queue.Queue(-1)
+            listener = QueueListener(log_queue, file_handler, stream_handler)
+            listener.start()
+            # 退出前把队列中剩余的日志写完
+            atexit.register(listener.stop)
+            
+            root_logger.setLevel(logging.INFO)
+            root_logger.addHandler(QueueHandler(log_queue))
         self.logger = logging.getLogger(__name__)
 
-    def process_markdown(self, content):
-        """Process markdown content"""
+    def process_markdown(self, lines):
+        """Process markdown lines, return the processed lines"""
         self.logger.info("开始处理markdown文件 / Start processing markdown file")
         
-        lines = content.split('\n')
         processed_lines = []
         skip_section = False
-        current_line_number = 0
         
         # Add table of contents collection list
-        table_of_contents = []
+        # 标题级别和标题文本分开存放，不再为每个标题建一个元组
+        toc_levels = array.array('B')
+        toc_titles = []
         
         stats = {
             'removed_images': 0,
@@ -66,187 +167,131 @@ class MarkdownProcessor:
             'converted_to_text': 0
         }
         
-        for i, line in enumerate(lines):
-            current_line_number += 1
+        # 日志级别在循环外判断一次，级别未开启时不再为每行格式化日志字符串
+        log_info = self.logger.isEnabledFor(logging.INFO)
+        log_debug = self.logger.isEnabledFor(logging.DEBUG)
+        
+        # 循环中每行都要调用的方法先绑定到局部变量，省去逐行的属性查找
+        append_line = processed_lines.append
+        search_skip_section = SKIP_SECTION_PATTERN.search
+        is_header_candidate = HEADER_CANDIDATE_PATTERN.match
+        match_header = HEADER_PATTERN.match
+        
+        # 上一个空行之后是否出现过图片标记，正向遍历时维护，不再逐行向上回溯
+        after_image = False
+        
+        for current_line_number, line in enumerate(lines, 1):
+            
+            # 当前行之前（到最近的空行为止）有图片标记，则当前行属于图片说明区域
+            in_image_desc = after_image
+            # 每行只去一次首尾空白，后面的判断和日志都复用
+            stripped = line.strip()
+            starts_with_hash = stripped.startswith('#')
+            if not stripped:
+                after_image = False
+            elif '![' in line:
+                after_image = True
             
             # Skip sections like exercises, references, literature guide and summary
-            if any(keyword in line for keyword in [
-                '思考题', 'Exercises', 
-                '参考文献', 'References',
-                '文献导读', 'Literature Guide', 
-                '小结', 'Summary'
-            ]):
+            if search_skip_section(line):
                 skip_section = True
                 stats['removed_sections'] += 1
-                self.logger.info(f"行 {current_line_number}: 开始跳过章节 \"{line.strip()}\" / Line {current_line_number}: Start skipping section \"{line.strip()}\"")
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 开始跳过章节 \"{stripped}\" / Line {current_line_number}: Start skipping section \"{stripped}\"")
                 continue
                 
-            if skip_section and line.strip().startswith('#'):
+            if skip_section and starts_with_hash:
                 skip_section = False
-                self.logger.info(f"行 {current_line_number}: 结束跳过章节")
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 结束跳过章节")
                 
             if skip_section:
-                self.logger.debug(f"行 {current_line_number}: 跳过内容 \"{line.strip()}\"")
+                if log_debug:
+                    self.logger.debug(f"行 {current_line_number}: 跳过内容 \"{stripped}\"")
                 continue
                 
             # 跳过图片及其多行说明文字
             if '![' in line:
                 stats['removed_images'] += 1
-                self.logger.info(f"行 {current_line_number}: 删除图片标签 \"{line.strip()}\"")
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 删除图片标签 \"{stripped}\"")
                 continue
             
             # 检查是否处于图片描述区域
-            if i > 0:
-                # 向上查找最近的非空行
-                j = i - 1
-                in_image_desc = False
-                while j >= 0:
-                    if not lines[j].strip():  # 遇到空行
-                        break
-                    if '![' in lines[j]:  # 找到图片标记
-                        in_image_desc = True
-                        break
-                    j -= 1
-                
-                if in_image_desc and line.strip():  # 如果是图片描述区域且当前行非空
-                    self.logger.info(f"行 {current_line_number}: 删除图片说明文字 \"{line.strip()}\"")
-                    continue
+            if in_image_desc and stripped:  # 如果是图片描述区域且当前行非空
+                if log_info:
+                    self.logger.info(f"行 {current_line_number}: 删除图片说明文字 \"{stripped}\"")
+                continue
                 
+            # 先按首字符预筛选，绝大多数正文行直接保留，不进入正则匹配
+            first_char = stripped[:1]
+            if first_char not in HEADER_FIRST_CHARS and not first_char.isdecimal():
+                append_line(line)
+                continue
+            
             # Process headers
-            if line.strip().startswith('#') or re.match(r'^\s*(?:第[一二三四五六七八九十]+(?:章|节|部分)|[一二三四五六七八九十]+、|\d+\.|\d+、|\((?:\d+|[一二三四五六七八九十]+)\)|Chapter|Section|Part|\d+\.|[A-Z]\.)', line.strip()):
-                original_line = line
-                header_content = line.lstrip('#').strip() if line.strip().startswith('#') else line.strip()
-                modified = False
-                
-                # Level 1 header: Match complete "Chapter X" format in both languages
-                if re.match(r'^\s*第[一二三四五六七八九十]+章(?:\s|$)', header_content) or \
-                   re.match(r'^\s*第[一二三四五六七八九十]+章\s+\S+', header_content) or \
-                   re.match(r'^\s*第\d+章(?:\s|$)', header_content) or \
-                   re.match(r'^\s*第\d+章\s+\S+', header_content) or \
-                   re.match(r'^\s*CHAPTER\s+\d+(?:\s|$)', header_content, re.IGNORECASE) or \
-                   re.match(r'^\s*\d+(?:\s|$)', header_content):
-                    line = f"# {header_content}"
-                    table_of_contents.append((1, header_content))
-                    modified = True
-                
-                
-                # Level 2 header: Match "Section X", "Part X", etc. in both languages
-                elif re.match(r'^\s*第[一二三四五六七八九十]+(?:节|部分)', header_content) or \
-                     re.match(r'^\s*绪论', header_content) or \
-                     re.match(r'^\s*\d+\.\d+(?![\.\d])', header_content) or \
-                     re.match(r'^\s*SECTION\s+\d+(?:\s|$)', header_content, re.IGNORECASE) or \
-                     re.match(r'^\s*PART\s+\d+(?:\s|$)', header_content, re.IGNORECASE):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                    
-                # 二级标题: X.X格式（紧凑格式）
-                elif re.match(r'^\s*\d+\.\d+(?![\s\.]*\d)\S', header_content) or \
-                   re.match(r'^\s*\d+\.\d+(?![\s\.]*\d)', header_content) or \
-                   re.match(r'^\s*\d+\.\d+[^\.]\S+', header_content):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                    
-                # 二级标题: X. X格式（带空格）
-                elif re.match(r'^\s*\d+\s*\.\s*\d+\s+\S', header_content):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                    
-                # 二级标题: X. X 格式带括号注释
-                elif re.match(r'^\s*[一二三四五六七八九十]+、', header_content) or \
-                    re.match(r'^\s*\d+\.\s*\d+\s+[^\n]*?\([\w\s]+\)', header_content):
-                    line = f"## {header_content}"
-                    table_of_contents.append((2, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改二级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-                    
-                
-                # Level 3 header: Match various formats
-                elif re.match(r'^\s*\d+\.\d+\.\d+(?![\s\.]*\d)', header_content) or \
-                   re.match(r'^\s*\d+\.\d+\.\d+(?![\.\d])', header_content) or \
-                   re.match(r'^\s*\d+\.\d+\.\d+\s+[^\n]*', header_content) or \
-                   re.match(r'^\s*\d+、\s*\S', header_content):
-                    line = f"### {header_content}"
-                    table_of_contents.append((3, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改三级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
-                
-                # 四级标题: 带括号的数字、中文字或X.X.X.X格式
-                elif re.match(r'^\s*[\(（]\s*(?:\d+|[一二三四五六七八九十]+)\s*[\)）]', header_content) or \
-                   re.match(r'^\s*\d+\.\d+\.\d+\.\d+', header_content) or \
-                   re.match(r'^\s*\d+\.\d+\.\d+\.\d+\s+[^\n]*?\([\w\s]+\)', header_content) or \
-                   re.match(r'^\s*\d+\.\d+\.\d+\.\d+\s+\S', header_content) or \
-                   re.match(r'^\s*\d+\.\d+\.\d+\.\d+(?![\s\.]*\d)', header_content) or \
-                   re.match(r'^\s*[（\(][一二三四五六七八九十]+[）\)]\s*\S', header_content) or \
-                   re.match(r'^\s*\d+[\.．]\s*\S', header_content) or \
-                   re.match(r'^\s*\d+\s*\S', header_content) or \
-                   re.match(r'^\s*[A-Z]\.\s+', header_content):
-                    line = f"#### {header_content}"
-                    table_of_contents.append((4, header_content))
-                    modified = True
-                    self.logger.info(f"行 {current_line_number}: 修改四级标题")
-                    self.logger.info(f"  原文: {original_line.strip()}")
-                    self.logger.info(f"  修改后: {line.strip()}")
-
+            if starts_with_hash or is_header_candidate(stripped):
+                # 行首是'#'时去掉'#'后再去空白，否则与stripped相同（行首有空白时'#'不会被去掉）
+                header_content = stripped.lstrip('#').lstrip() if line.startswith('#') else stripped
                 
-                # 如果不符合任何标题格式，跳过这一行
-                if not modified:
-                    self.logger.info(f"行 {current_line_number}: 删除不规范标题 / Line {current_line_number}: Removing non-standard header")
-                    self.logger.info(f"  删除内容 / Removed content: {original_line.strip()}")
+                # 一次匹配确定标题级别，由命名分组分派
+                match = match_header(header_content)
+                if match:
+                    level = HEADER_LEVELS[match.lastgroup]
+                    line = f"{'#' * level} {header_content}"
+                    toc_levels.append(level)
+                    toc_titles.append(header_content)
+                    if level > 1 and log_info:
+                        self.logger.info(
+                            f"行 {current_line_number}: 修改{LEVEL_NAMES[level]}级标题\n"
+                            f"  原文: {stripped}\n"
+                            f"  修改后: {line.strip()}"
+                        )
+                else:
+                    # 不符合任何标题格式，跳过这一行
+                    if log_info:
+                        self.logger.info(
+                            f"行 {current_line_number}: 删除不规范标题 / Line {current_line_number}: Removing non-standard header\n"
+                            f"  删除内容 / Removed content: {stripped}"
+                        )
                     stats['removed_headers'] = stats.get('removed_headers', 0) + 1
                     continue
 
             
-            processed_lines.append(line)
+            append_line(line)
         
         # Record statistics
-        self.logger.info("\n处理总结 / Processing Summary:")
-        self.logger.info(f"- 删除图片数量 / Removed images: {stats['removed_images']}")
-        self.logger.info(f"- 删除章节数量 / Removed sections: {stats['removed_sections']}")
-        self.logger.info(f"- 修改标题数量 / Modified headers: {stats['modified_headers']}")
-        self.logger.info(f"- 转换为正文数量 / Converted to text: {stats['converted_to_text']}")
+        self.logger.info(
+            "\n处理总结 / Processing Summary:\n"
+            f"- 删除图片数量 / Removed images: {stats['removed_images']}\n"
+            f"- 删除章节数量 / Removed sections: {stats['removed_sections']}\n"
+            f"- 修改标题数量 / Modified headers: {stats['modified_headers']}\n"
+            f"- 转换为正文数量 / Converted to text: {stats['converted_to_text']}"
+        )
         
         # Generate table of contents
-        self.logger.info("\n文档目录结构 / Document Structure:")
-        for level, title in table_of_contents:
-            indent = "  " * (level - 1)
-            self.logger.info(f"{indent}{title}")
+        # 整个目录拼成一条日志输出，不再每个标题调用一次logger.info
+        if log_info:
+            toc_lines = ["\n文档目录结构 / Document Structure:"]
+            toc_lines.extend(f"{'  ' * (level - 1)}{title}" for level, title in zip(toc_levels, toc_titles))
+            self.logger.info('\n'.join(toc_lines))
         
-        return '\n'.join(processed_lines)
+        return processed_lines
     def process_file(self):
         """处理文件的主函数"""
         try:
             # 读取文件
             self.logger.info(f"开始读取文件: {self.input_path}")
-            with open(self.input_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            with open(self.input_path, 'r', encoding='utf-8', buffering=IO_BUFFER_SIZE) as f:
+                lines = f.read().split('\n')
             
             # 处理内容
-            processed_content = self.process_markdown(content)
+            processed_lines = self.process_markdown(lines)
             
             # 写入新文件
             self.logger.info(f"写入处理后的文件: {self.output_path}")
-            with open(self.output_path, 'w', encoding='utf-8') as f:
-                f.write(processed_content)
+            with open(self.output_path, 'w', encoding='utf-8', buffering=IO_BUFFER_SIZE) as f:
+                write_lines(f, processed_lines)
             
             self.logger.info("文件处理完成")
             return True
@@ -255,14 +300,48 @@ class MarkdownProcessor:
             self.logger.error(f"处理过程中发生错误: {str(e)}")
             return False
 
-def process_directory(input_dir, output_dir):
-    """处理目录中的所有markdown文件"""
+def iter_md_files(root_dir):
+    """
+    递归遍历目录，依次返回所有.md文件的路径
+    scandir在读目录时已经拿到文件类型，不必再为每个文件单独stat
+    """
+    try:
+        entries = os.scandir(root_dir)
+    except OSError:
+        # 与os.walk一致，无法读取的目录直接跳过
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_md_files(entry.path)
+            elif entry.name.endswith('.md') and not entry.is_dir():
+                yield entry.path
+
+def init_worker_logging(log_dir, timestamp):
+    """
+    子进程启动时配置日志，每个子进程写自己的日志文件，避免多个进程争用同一个文件
+    子进程直接写文件，退出时不依赖队列线程把日志写完
+    """
+    log_filename = f"markdown_processing_{timestamp}_{os.getpid()}.log"
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(os.path.join(log_dir, log_filename), encoding='utf-8'),
+            logging.StreamHandler()
+        ],
+        force=True
+    )
+
+def process_single_file(md_file, output_subdir, timestamp=None):
+    """在子进程中处理单个markdown文件（模块级函数，便于多进程调用），返回是否成功"""
+    processor = MarkdownProcessor(md_file, output_subdir, timestamp)
+    return processor.process_file()
+
+def process_directory(input_dir, output_dir, max_workers=None):
+    """处理目录中的所有markdown文件，各文件相互独立，用多进程并行处理"""
     # 获取所有.md文件（包括子文件夹中的文件）
-    md_files = []
-    for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith('.md'):
-                md_files.append(os.path.join(root, file))
+    md_files = list(iter_md_files(input_dir))
     
     if not md_files:
         print(f"在目录 {input_dir} 中未找到.md文件")
@@ -273,21 +352,21 @@ def process_directory(input_dir, output_dir):
     # 确保输出目录存在
     os.makedirs(output_dir, exist_ok=True)
     
+    # 保持输入文件的相对路径结构，输出子目录在主进程中先建好
+    output_subdirs = []
+    for md_file in md_files:
+        rel_path = os.path.relpath(md_file, input_dir)
+        output_subdir = os.path.dirname(os.path.join(output_dir, rel_path))
+        os.makedirs(output_subdir, exist_ok=True)
+        output_subdirs.append(output_subdir)
+    
+    # 整批文件共用一个时间戳，不再为每个文件重新取时间并格式化
+    batch_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    
     # 使用tqdm显示处理进度
-    success_count = 0
-    with tqdm(total=len(md_files), desc="处理进度") as pbar:
-        for md_file in md_files:
-            # 保持输入文件的相对路径结构
-            rel_path = os.path.relpath(md_file, input_dir)
-            output_subdir = os.path.dirname(os.path.join(output_dir, rel_path))
-            os.makedirs(output_subdir, exist_ok=True)
-            
-            # 处理文件
-            processor = MarkdownProcessor(md_file, output_subdir)
-            if processor.process_file():
-                success_count += 1
-            
-            pbar.update(1)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker_logging, initargs=(output_dir, batch_timestamp)) as executor:
+        results = executor.map(process_single_file, md_files, output_subdirs, repeat(batch_timestamp), chunksize=8)
+        success_count = sum(tqdm(results, total=len(md_files), desc="处理进度"))
     
     print(f"\n处理完成: 成功 {success_count}/{len(md_files)} 个文件")
 
@@ -9,8 +9,10 @@
 这个英文版本保留了原始prompt的所有关键功能，但调整了表达方式和示例以更好地适应英文书籍的常见格式。
 """
 import os
+import re
 import logging
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+import httpx
 from datetime import datetime
 from dotenv import load_dotenv
 import asyncio
@@ -18,17 +20,267 @@ from typing import List
 import glob
 from tqdm import tqdm
 import argparse
-import aiofiles
+import hashlib
+import random
+import json
+import sqlite3
+from contextlib import asynccontextmanager
+
+try:
+    import uvloop
+except ImportError:  # 未安装uvloop（如在Windows上）时使用asyncio默认的事件循环
+    uvloop = None
+
+# 缓存API响应的SQLite文件名，保存在输出目录中
+RESPONSE_CACHE_FILE = 'response_cache.sqlite3'
+
+# 目录提取的固定规则和示例，作为system消息放在每次请求的最前面
+TOC_SYSTEM_PROMPT = """You are a text processing expert. I will provide you with book content in segments. Your task is to identify the table of contents from the text and convert it into a Markdown format (using # for hierarchy levels).
+Process the text only, without making any evaluations or descriptions.
+Due to input length limitations, the table of contents may be spread across two or more adjacent segments. Please maintain consistency with the previous segment's processing style, don't be lazy!!!
+
+Rules:
+1. Table of Contents Recognition Features:
+   - Paragraphs with dense title numbering
+   - Multiple consecutive chapters, sections, or numerical sequences (1,2,3,4,5)
+   - Multiple consecutive short texts that resemble titles
+   - Lines may contain page numbers (to be removed)
+
+2. Title Hierarchy Rules:
+    Adjacent content with parallel hierarchical structure should be recognized at the same level:
+  The more numbers (like 1, 1.11) or symbols (a,b,c) preceding the text, the lower the title level.
+    Examples:
+    First level:
+   - Chapter X
+   - Part X
+   
+    Second level:
+   - Section X
+   - X.X (like 1.1, 2.1, etc.) 
+   - CONCEPT X.X
+   
+    Special rules:
+   - Maintain chapter continuity and hierarchical relationships
+   - Ensure each title has corresponding level markers
+
+3. Output Requirements:
+  - Output only in Markdown format using # for chapters and ## for sections, remove all other information
+  - Preserve original hierarchical relationships
+  - Remove sections containing "Review Questions", "References", "Exercises", and "Appendix"
+  - Remove all page numbers
+  - Ensure each line has a title level marker
+  - Separate titles with line breaks
+
+4. Output Example:
+    # Chapter One: Introduction
+    ##  Historical Development
+    ##  Main Contents and Applications
+    ##  Study Methods
+
+    # Chapter Two: Structure and Function
+    ##  Basic Components
+
+Here is the text to process:
+"""
+
+# 每次请求合并处理的相邻chunk数量，减少请求次数和重复发送的固定规则
+TOC_BATCH_SIZE = 4
+# 同一本书中同时进行的批量请求数
+MAX_CONCURRENT_BATCHES = 5
+# 批量请求回复的最大token数（gpt-4o-mini的回复上限为16384）
+TOC_BATCH_MAX_TOKENS = 16000
+# 每批chunk的总字符数上限：目录密集的分段回复长度与输入相当，英文约4个字符一个token，这个长度的回复远低于TOC_BATCH_MAX_TOKENS
+TOC_BATCH_MAX_CHARS = 16000
+
+# 一次请求处理多个chunk时追加在规则后面的输出格式说明
+TOC_BATCH_INSTRUCTION = """
+This input contains several adjacent segments, each starting with <<<CHUNK n>>>.
+Process the segments in order and output JSON: {"toc": ["TOC of segment 1", "TOC of segment 2", ...]}
+Use one array entry per segment, and an empty string for a segment without a table of contents.
+"""
+
+# API调用遇到限流、连接错误、超时或服务端错误时的最大尝试次数
+# 创建客户端时关闭SDK自带的重试（max_retries=0），只由这里的重试和退避处理，避免两层重试叠加
+MAX_API_ATTEMPTS = 6
+# 指数退避的初始等待时间（秒），每次重试翻倍
+RETRY_BASE_DELAY = 0.5
+# 可以重试的API错误
+RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# 分块时优先在标题行（markdown标题或Chapter/Part开头的行）之前切开
+CHUNK_BOUNDARY_PATTERN = re.compile(r'^(?=#|chapter\s|part\s)', re.MULTILINE | re.IGNORECASE)
+
+# 所有书合计同时进行的API请求数上限，遇到限流时自动减半，之后逐步恢复
+MAX_CONCURRENT_REQUESTS = 50
+# 连续成功多少次请求后把并发上限加一
+CONCURRENCY_GROW_AFTER = 200
+
+# 所有书共用的HTTP连接池大小，要大于同时进行的请求数（书的并发数 × 每本书的批次并发数）
+HTTP_MAX_CONNECTIONS = 1000
+# 空闲连接的保持时间（秒）
+HTTP_KEEPALIVE_EXPIRY = 60
+
+def group_chunks(chunks):
+    """把相邻的chunk合并成批，每批最多TOC_BATCH_SIZE个，总字符数不超过TOC_BATCH_MAX_CHARS（单个chunk超过时自成一批）"""
+    batches = []
+    batch = []
+    batch_chars = 0
+    for chunk in chunks:
+        if batch and (len(batch) == TOC_BATCH_SIZE or batch_chars + len(chunk) > TOC_BATCH_MAX_CHARS):
+            batches.append(batch)
+            batch = []
+            batch_chars = 0
+        batch.append(chunk)
+        batch_chars += len(chunk)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def split_into_chunks(content, chunk_size):
+    """
+    按标题位置把内容切成若干段，再依次拼成不超过chunk_size个字符的块
+    单段超过chunk_size时接在当前块后面，在最后一个换行处切开，没有换行时才按字符切
+    """
+    chunks = []
+    current = ''
+    for part in CHUNK_BOUNDARY_PATTERN.split(content):
+        if len(current) + len(part) <= chunk_size:
+            current += part
+            continue
+        if len(part) > chunk_size:
+            part = current + part
+        elif current:
+            chunks.append(current)
+        while len(part) > chunk_size:
+            cut = part.rfind('\n', 0, chunk_size) + 1 or chunk_size
+            chunks.append(part[:cut])
+            part = part[cut:]
+        current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+def read_text(path, limit):
+    """读取文本文件的前limit个字符"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read(limit)
+
+def write_text(path, text):
+    """把文本一次写入文件"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def retry_delay(error, attempt):
+    """
+    计算第attempt次失败后的等待时间
+    限流响应带有retry-after时按它等待，否则指数退避并加上随机抖动，避免并发请求同时重试
+    """
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, RETRY_BASE_DELAY / 2)
+
+class ConcurrencyLimiter:
+    """
+    自适应的API并发限制，所有书共用
+    遇到限流错误时把并发上限减半，之后每连续成功grow_after次加一，直到max_limit
+    同一批并发请求同时被限流时只减半一次：只有在上次减半之后才开始的请求被限流，才会再次减半
+    """
+    def __init__(self, max_limit, grow_after=CONCURRENCY_GROW_AFTER):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.grow_after = grow_after
+        self.active = 0
+        self.successes = 0
+        # 并发上限每减半一次加一，用来判断请求是否在上次减半之后开始
+        self.epoch = 0
+        self.condition = asyncio.Condition()
+        self.logger = logging.getLogger(__name__)
+    
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个并发名额直到请求结束，请求被限流时调低并发上限"""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+            started_epoch = self.epoch
+        rate_limited = False
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        except RateLimitError:
+            rate_limited = True
+            raise
+        finally:
+            async with self.condition:
+                self.active -= 1
+                if rate_limited:
+                    self.successes = 0
+                    if self.limit > 1 and started_epoch == self.epoch:
+                        self.epoch += 1
+                        self.limit //= 2
+                        self.logger.warning(f"请求被限流，并发上限降为{self.limit}")
+                elif succeeded:
+                    self.successes += 1
+                    if self.successes >= self.grow_after and self.limit < self.max_limit:
+                        self.successes = 0
+                        self.limit += 1
+                        self.logger.info(f"并发上限恢复为{self.limit}")
+                self.condition.notify_all()
+
+class ResponseCache:
+    """
+    按(模型, 参数, 消息)的SHA-256哈希把API响应缓存在SQLite文件中
+    重新运行或不同的书出现相同的分段时，直接返回保存的结果，不再调用API
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT)')
+        self.conn.commit()
+    
+    @staticmethod
+    def make_key(model, temperature, messages):
+        """
+        根据模型、温度和消息列表生成缓存键
+        消息中的连续空白先合并成一个空格，只有换行、缩进不同的重复分段也能命中缓存
+        """
+        normalized_messages = '|'.join(
+            f"{message['role']}:{' '.join(message['content'].split())}" for message in messages
+        )
+        return hashlib.sha256(f"{model}|{temperature}|{normalized_messages}".encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """查询缓存，未命中时返回None"""
+        row = self.conn.execute('SELECT response FROM cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key, response):
+        """保存一条响应，相同的键已存在时覆盖（替换无法解析的旧结果）"""
+        self.conn.execute('INSERT OR REPLACE INTO cache (key, response) VALUES (?, ?)', (key, response))
+        self.conn.commit()
 
 class TOCExtractor:
-    def __init__(self, input_path, output_dir, api_key):
+    def __init__(self, input_path, output_dir, api_key, response_cache=None, client=None, concurrency_limiter=None):
         self.input_path = input_path
         self.output_dir = output_dir
-        self.client = AsyncOpenAI(api_key=api_key)
+        # 优先使用传入的共享客户端，复用已建立的连接
+        self.client = client if client is not None else AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.response_cache = response_cache
+        # 没有传入共享的并发限制时单独创建一个
+        self.concurrency_limiter = (concurrency_limiter if concurrency_limiter is not None 
+                                    else ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS))
         self.setup_logging()
         
     def setup_logging(self):
-        """设置日志"""
+        """设置日志，每本书各建一个TOCExtractor，日志处理器只在第一次时创建，之后的书共用"""
+        self.logger = logging.getLogger(__name__)
+        if logging.getLogger().handlers:
+            return
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         log_file = os.path.join(self.output_dir, f'toc_extraction_{timestamp}.log')
         
@@ -40,91 +292,122 @@ class TOCExtractor:
                 logging.StreamHandler()
             ]
         )
-        self.logger = logging.getLogger(__name__)
         
-    async def generate_response(self, prompt):
-        """异步调用GPT-4生成响应"""
+    async def generate_response(self, messages, response_format=None, parse=None, max_tokens=None):
+        """
+        异步调用GPT-4生成响应，相同的请求优先从缓存返回
+        传入parse时返回parse(回复)，只有能解析的回复才写入缓存，解析失败时抛出异常，重新运行时会重新请求
+        """
+        model = "gpt-4o-mini"
+        temperature = 0.3
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(model, temperature, messages)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                try:
+                    return parse(cached) if parse else cached
+                except Exception:
+                    # 之前缓存的回复无法解析，重新请求
+                    pass
+        # 只有需要JSON输出或限制回复长度时才传对应参数
+        extra_options = {"response_format": response_format} if response_format else {}
+        if max_tokens is not None:
+            extra_options["max_tokens"] = max_tokens
+        # 限流和临时错误按指数退避重试，不直接放弃这部分内容
+        for attempt in range(MAX_API_ATTEMPTS):
+            try:
+                async with self.concurrency_limiter.slot():
+                    response = await self.client.chat.completions.create(
+                        model=model,     
+                        messages=messages,
+                        temperature=temperature,
+                        top_p=1.0,
+                        frequency_penalty=0.0,
+                        presence_penalty=0.0,
+                        **extra_options
+                    )
+                content = response.choices[0].message.content
+                break
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    raise Exception(f"API调用失败，已重试{attempt}次: {str(e)}")
+                delay = retry_delay(e, attempt)
+                self.logger.warning(f"API调用失败，{delay:.1f}秒后重试: {str(e)}")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                raise Exception(f"API调用失败: {str(e)}")
+        result = parse(content) if parse else content
+        if cache_key is not None:
+            self.response_cache.set(cache_key, content)
+        return result
+            
+    async def extract_toc_chunk(self, chunk):
+        """单独处理一个chunk，返回识别出的目录，失败时返回None"""
         try:
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",     
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
-            return response.choices[0].message.content
+            # 固定的规则放在最前面的system消息中，每次请求的前缀相同，可以命中OpenAI的提示缓存
+            messages = [
+                {"role": "system", "content": TOC_SYSTEM_PROMPT},
+                {"role": "user", "content": chunk}
+            ]
+            response = await self.generate_response(messages)
+            return response.strip()
         except Exception as e:
-            raise Exception(f"API调用失败: {str(e)}")
-            
+            self.logger.error(f"目录提取失败: {str(e)}")
+            return None
+    
+    async def extract_toc_batch(self, batch):
+        """
+        一次请求处理多个相邻的chunk，按顺序返回各chunk的目录
+        模型返回的JSON无法解析（如回复被截断）或分段数不一致时，退回逐个chunk请求
+        """
+        def parse_batch(response):
+            parts = json.loads(response)["toc"]
+            if not (isinstance(parts, list) and len(parts) == len(batch) and all(isinstance(part, str) for part in parts)):
+                raise ValueError(f"返回的格式不正确或分段数不一致（期望{len(batch)}个）")
+            return [part.strip() for part in parts]
+        
+        if len(batch) > 1:
+            messages = [
+                {"role": "system", "content": TOC_SYSTEM_PROMPT + TOC_BATCH_INSTRUCTION},
+                {"role": "user", "content": "\n".join(
+                    f"<<<CHUNK {n}>>>\n{chunk}" for n, chunk in enumerate(batch, 1)
+                )}
+            ]
+            try:
+                return await self.generate_response(messages, response_format={"type": "json_object"}, 
+                                                    parse=parse_batch, max_tokens=TOC_BATCH_MAX_TOKENS)
+            except Exception as e:
+                self.logger.warning(f"批量目录提取失败，改为逐个处理: {str(e)}")
+        
+        toc_parts = []
+        for chunk in batch:
+            toc = await self.extract_toc_chunk(chunk)
+            if toc is not None:
+                toc_parts.append(toc)
+        return toc_parts
+    
     async def extract_toc(self, content):
         """从文档中提取目录"""
-        words = content.split()
-        chunk_size = 4000
-        toc_parts = []
-        chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+        # 在标题和换行处分块，避免把一行目录切成两半
+        chunks = split_into_chunks(content, 4000)
+        # 每次请求合并最多TOC_BATCH_SIZE个相邻的chunk
+        batches = group_chunks(chunks)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
         
         # 使用tqdm显示chunk处理进度
         with tqdm(total=len(chunks), desc=f"处理 {os.path.basename(self.input_path)}", 
                  position=1, leave=False) as pbar:
-            # 按顺序处理每个chunk
-            for chunk in chunks:
-                prompt = """
-                You are a text processing expert. I will provide you with book content in segments. Your task is to identify the table of contents from the text and convert it into a Markdown format (using # for hierarchy levels).
-                Process the text only, without making any evaluations or descriptions.
-                Due to input length limitations, the table of contents may be spread across two or more adjacent segments. Please maintain consistency with the previous segment's processing style, don't be lazy!!!
-
-                Rules:
-                1. Table of Contents Recognition Features:
-                   - Paragraphs with dense title numbering
-                   - Multiple consecutive chapters, sections, or numerical sequences (1,2,3,4,5)
-                   - Multiple consecutive short texts that resemble titles
-                   - Lines may contain page numbers (to be removed)
-                
-                2. Title Hierarchy Rules:
-                    Adjacent content with parallel hierarchical structure should be recognized at the same level:
-                  The more numbers (like 1, 1.11) or symbols (a,b,c) preceding the text, the lower the title level.
-                    Examples:
-                    First level:
-                   - Chapter X
-                   - Part X
-                   
-                    Second level:
-                   - Section X
-                   - X.X (like 1.1, 2.1, etc.) 
-                   - CONCEPT X.X
-                   
-                    Special rules:
-                   - Maintain chapter continuity and hierarchical relationships
-                   - Ensure each title has corresponding level markers
-                
-                3. Output Requirements:
-                  - Output only in Markdown format using # for chapters and ## for sections, remove all other information
-                  - Preserve original hierarchical relationships
-                  - Remove sections containing "Review Questions", "References", "Exercises", and "Appendix"
-                  - Remove all page numbers
-                  - Ensure each line has a title level marker
-                  - Separate titles with line breaks
-                
-                4. Output Example:
-                    # Chapter One: Introduction
-                    ##  Historical Development
-                    ##  Main Contents and Applications
-                    ##  Study Methods
-
-                    # Chapter Two: Structure and Function
-                    ##  Basic Components
-
-                Here is the text to process:
-                """ + chunk
-                try:
-                    response = await self.generate_response(prompt)
-                    toc_parts.append(response.strip())
-                except Exception as e:
-                    self.logger.error(f"目录提取失败: {str(e)}")
-                finally:
-                    pbar.update(1)
+            async def process_batch(batch):
+                async with semaphore:
+                    parts = await self.extract_toc_batch(batch)
+                pbar.update(len(batch))
+                return parts
+            
+            # 各批次同时请求，gather按传入顺序返回结果，目录保持chunk的顺序
+            results = await asyncio.gather(*(process_batch(batch) for batch in batches))
         
+        toc_parts = [part for parts in results for part in parts]
         full_toc = '\n'.join(toc_parts)
         return full_toc
             
@@ -132,9 +415,8 @@ class TOCExtractor:
         """异步处理单个文件"""
         try:
             self.logger.info(f"开始读取文件: {self.input_path}")
-            async with aiofiles.open(self.input_path, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                content = content[:40000]  # 限制处理长度
+            # 单次读写直接放到线程中完成，不需要aiofiles逐次调用的线程切换
+            content = await asyncio.to_thread(read_text, self.input_path, 40000)  # 限制处理长度
             
             self.logger.info("开始提取目录")
             toc = await self.extract_toc(content)
@@ -147,8 +429,7 @@ class TOCExtractor:
                     f'toc_{timestamp}_{filename}'
                 )
                 
-                async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
-                    await f.write(toc)
+                await asyncio.to_thread(write_text, output_path, toc)
                     
                 self.logger.info(f"目录已保存到: {output_path}")
             else:
@@ -168,22 +449,41 @@ async def process_books(input_dir: str, output_dir: str, api_key: str, max_concu
     # 创建信号量来限制并发数
     semaphore = asyncio.Semaphore(max_concurrent)
     
-    async def process_with_semaphore(book_path):
-        async with semaphore:
-            extractor = TOCExtractor(book_path, output_dir, api_key)
-            await extractor.process_file()
+    # 所有书共用一个响应缓存
+    response_cache = ResponseCache(os.path.join(output_dir, RESPONSE_CACHE_FILE))
+    
+    # 所有书共用一个自适应的并发限制，按是否被限流调整同时进行的请求数
+    concurrency_limiter = ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS)
     
-    # 创建总进度条
-    with tqdm(total=len(book_files), desc="总体进度", position=0) as pbar:
-        # 创建所有任务
-        tasks = []
-        for book_path in book_files:
-            task = asyncio.create_task(process_with_semaphore(book_path))
-            task.add_done_callback(lambda _: pbar.update(1))
-            tasks.append(task)
+    # 所有书共用一个客户端和连接池，连接数上限按并发请求数放大，避免请求排队等待连接
+    http_client = httpx.AsyncClient(limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    ))
+    async with AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0) as client:
+        async def process_with_semaphore(book_path):
+            async with semaphore:
+                extractor = TOCExtractor(book_path, output_dir, api_key, response_cache, client, 
+                                         concurrency_limiter)
+                await extractor.process_file()
         
-        # 等待所有任务完成
-        await asyncio.gather(*tasks)
+        # 创建总进度条
+        with tqdm(total=len(book_files), desc="总体进度", position=0) as pbar:
+            # 创建所有任务
+            tasks = []
+            for book_path in book_files:
+                task = asyncio.create_task(process_with_semaphore(book_path))
+                tasks.append(task)
+            
+            # 按完成顺序逐本处理，每本书完成后立即更新进度，一本书出错不影响其他书
+            for finished in asyncio.as_completed(tasks):
+                try:
+                    await finished
+                except Exception as e:
+                    logging.getLogger(__name__).error(f"处理失败: {str(e)}")
+                finally:
+                    pbar.update(1)
 
 if __name__ == "__main__":
     # 设置命令行参数
@@ -203,7 +503,9 @@ if __name__ == "__main__":
     load_dotenv()
     api_key = os.getenv("OPENAI_API_KEY")
     
-    # 运行异步处理
+    # 运行异步处理，安装了uvloop时换用更快的事件循环
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(process_books(
         args.input_dir,
         args.output_dir,
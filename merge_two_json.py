@@ -12,10 +12,11 @@
 这种方式可以帮助模型在相邻的内容区域内进行匹配，提高匹配的准确性。
 """
 import json
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Sequence, Tuple
 import sys
 import os
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+import httpx
 from dotenv import load_dotenv
 import asyncio
 import logging
@@ -23,6 +24,200 @@ from datetime import datetime
 import argparse
 from tqdm import tqdm
 import time
+import hashlib
+import random
+import sqlite3
+from contextlib import asynccontextmanager
+
+try:
+    import uvloop
+except ImportError:  # 未安装uvloop（如在Windows上）时使用asyncio默认的事件循环
+    uvloop = None
+
+try:
+    import tiktoken
+except ImportError:  # 未安装tiktoken时按字符数截取正文
+    tiktoken = None
+
+try:
+    import orjson
+    loads_json = orjson.loads
+    
+    def dumps_json(obj) -> bytes:
+        """以2空格缩进序列化为UTF-8字节"""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:  # 未安装 orjson 时退回标准库 json，json.loads 同样可以直接解析UTF-8字节
+    loads_json = json.loads
+    
+    def dumps_json(obj) -> bytes:
+        """以2空格缩进序列化为UTF-8字节"""
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+# 缓存API响应的SQLite文件名，保存在输出目录中
+RESPONSE_CACHE_FILE = 'response_cache.sqlite3'
+
+# 内容匹配的固定说明，作为system消息放在每次请求的最前面
+MATCH_SYSTEM_PROMPT = """你是一个文本分类专家。请根据给定的内容，从以下目录选项中选择最合适的一个。
+只需返回选项的序号（如：1），不要有任何其他解释。
+
+请注意：
+请重点关注chapter,section,subsection之前的标识符，他们是有规律的。比如subsection2.2.2代表第2章，2.2节。
+请主要按照section与（content和subsection）的相似度来判断，如果相似度很高，则返回section的序号。
+如果内容能够匹配多个章节，就给出所有选择中的第二个结果。
+如果你认为内容无法匹配任何一个章节，给出所有选择中的第二个结果。
+针对你对内容的理解以及内容中的关键词来做判断。
+"""
+
+# 批量匹配时追加在system消息后的格式说明
+MATCH_BATCH_INSTRUCTION = """
+本次输入包含多个相邻的内容，每个内容以<<<CONTENT n>>>开头，它们共用同一组目录选项。
+请按顺序分别为每个内容选择目录选项，以JSON格式输出：{"matches": [第1个内容的序号, 第2个内容的序号, ...]}
+数组中每个内容对应一个整数序号，不要有任何其他解释。
+"""
+
+# API调用遇到限流、连接错误、超时或服务端错误时的最大尝试次数
+# 创建客户端时关闭SDK自带的重试（max_retries=0），只由这里的重试和退避处理，避免两层重试叠加
+MAX_API_ATTEMPTS = 6
+# 指数退避的初始等待时间（秒），每次重试翻倍
+RETRY_BASE_DELAY = 0.5
+# 可以重试的API错误
+RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# 匹配时每个内容块的正文最多保留的token数，中英文正文的长度都按实际token数控制
+CONTENT_TOKEN_BUDGET = 400
+# 未安装tiktoken时正文最多保留的字符数
+CONTENT_CHAR_BUDGET = 300
+
+# 所有书合计每分钟最多发出的API请求数
+MAX_REQUESTS_PER_MINUTE = 500
+
+# 所有书合计同时进行的API请求数上限，遇到限流时自动减半，之后逐步恢复
+MAX_CONCURRENT_REQUESTS = 50
+# 连续成功多少次请求后把并发上限加一
+CONCURRENCY_GROW_AFTER = 200
+
+# 所有书共用的HTTP连接池大小，要大于同时进行的请求数（书的并发数 × 每本书预取的批次数）
+HTTP_MAX_CONNECTIONS = 1000
+# 空闲连接的保持时间（秒）
+HTTP_KEEPALIVE_EXPIRY = 60
+
+def retry_delay(error, attempt):
+    """
+    计算第attempt次失败后的等待时间
+    限流响应带有retry-after时按它等待，否则指数退避并加上随机抖动，避免并发请求同时重试
+    """
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, RETRY_BASE_DELAY / 2)
+
+class RateLimiter:
+    """
+    令牌桶限流：桶中最多有max_rate个令牌，按每time_period秒max_rate个的速度补充，每次请求消耗一个
+    没有超出额度时请求直接发出，额度用完后才按速度排队
+    """
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.refill_rate = max_rate / time_period
+        self.tokens = max_rate
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """取得一个令牌，令牌不足时等待补充"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.max_rate, self.tokens + (now - self.last_refill) * self.refill_rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.refill_rate)
+
+class ConcurrencyLimiter:
+    """
+    自适应的API并发限制，所有书共用
+    遇到限流错误时把并发上限减半，之后每连续成功grow_after次加一，直到max_limit
+    同一批并发请求同时被限流时只减半一次：只有在上次减半之后才开始的请求被限流，才会再次减半
+    """
+    def __init__(self, max_limit, grow_after=CONCURRENCY_GROW_AFTER):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.grow_after = grow_after
+        self.active = 0
+        self.successes = 0
+        # 并发上限每减半一次加一，用来判断请求是否在上次减半之后开始
+        self.epoch = 0
+        self.condition = asyncio.Condition()
+        self.logger = logging.getLogger(__name__)
+    
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个并发名额直到请求结束，请求被限流时调低并发上限"""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+            started_epoch = self.epoch
+        rate_limited = False
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        except RateLimitError:
+            rate_limited = True
+            raise
+        finally:
+            async with self.condition:
+                self.active -= 1
+                if rate_limited:
+                    self.successes = 0
+                    if self.limit > 1 and started_epoch == self.epoch:
+                        self.epoch += 1
+                        self.limit //= 2
+                        self.logger.warning(f"请求被限流，并发上限降为{self.limit}")
+                elif succeeded:
+                    self.successes += 1
+                    if self.successes >= self.grow_after and self.limit < self.max_limit:
+                        self.successes = 0
+                        self.limit += 1
+                        self.logger.info(f"并发上限恢复为{self.limit}")
+                self.condition.notify_all()
+
+class ResponseCache:
+    """
+    按(模型, 参数, 消息)的SHA-256哈希把API响应缓存在SQLite文件中
+    重新运行或不同的书出现相同的分段时，直接返回保存的结果，不再调用API
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT)')
+        self.conn.commit()
+    
+    @staticmethod
+    def make_key(model, temperature, messages):
+        """
+        根据模型、温度和消息列表生成缓存键
+        消息中的连续空白先合并成一个空格，只有换行、缩进不同的重复分段也能命中缓存
+        """
+        normalized_messages = '|'.join(
+            f"{message['role']}:{' '.join(message['content'].split())}" for message in messages
+        )
+        return hashlib.sha256(f"{model}|{temperature}|{normalized_messages}".encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """查询缓存，未命中时返回None"""
+        row = self.conn.execute('SELECT response FROM cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key, response):
+        """保存一条响应，相同的键已存在时保留原有结果"""
+        self.conn.execute('INSERT OR IGNORE INTO cache (key, response) VALUES (?, ?)', (key, response))
+        self.conn.commit()
 
 class TocChunk:
     def __init__(self, chapter: str, section: str):
@@ -38,8 +233,8 @@ class ContentChunk:
         self.content = content
 
 def load_toc(file_path: str) -> List[TocChunk]:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with open(file_path, 'rb') as f:
+        data = loads_json(f.read())
         print(f"TOC data type: {type(data)}")
         
         # 检查数据结构
@@ -50,8 +245,6 @@ def load_toc(file_path: str) -> List[TocChunk]:
             
         chunks = []
         for section in sections:
-            # 添加调试信息
-            print(f"Processing TOC section: {section}")
             chapter = section.get('Chapter', '')
             section_title = section.get('Section', '')
             chunks.append(TocChunk(chapter, section_title))
@@ -60,8 +253,8 @@ def load_toc(file_path: str) -> List[TocChunk]:
         return chunks
 
 def load_content(file_path: str) -> List[ContentChunk]:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with open(file_path, 'rb') as f:
+        data = loads_json(f.read())
         print(f"Content data type: {type(data)}")
         
         # 检查数据结构并统一处理为列表
@@ -87,18 +280,32 @@ def load_content(file_path: str) -> List[ContentChunk]:
         return chunks
 
 ### 这个地方实际调节了误差的范围，只有前后n个标题会被输送给gpt。
-def get_toc_window(toc_chunks: List[TocChunk], current_index: int, window_size: int = 9) -> List[TocChunk]:
+def get_toc_window(toc_chunks: Sequence, current_index: int, window_size: int = 9) -> Tuple[int, Sequence]:
     """
     Get a window of TOC chunks centered around the current index.
     Window includes [current_index-1, current_index, current_index+1, ..., current_index+4]
+    同时返回窗口起点，窗口内的序号加上起点就是TOC中的位置
     """
     start_idx = max(0, current_index - 1)  # 从当前位置前一个开始
     end_idx = min(len(toc_chunks), start_idx + window_size)  # 向后取6个位置
-    return toc_chunks[start_idx:end_idx]
+    return start_idx, toc_chunks[start_idx:end_idx]
+
+# 每次请求一起匹配的相邻内容块数量
+MATCH_BATCH_SIZE = 10
+# 上一批结束时TOC位置没有改变时，预先发出匹配请求的批次数量（包括当前批次）
+# 位置改变后预取的请求都会作废，所以位置刚改变时只发出当前批次
+PREFETCH_DEPTH = 2
 
 class ContentMatcher:
-    def __init__(self, api_key):
-        self.client = AsyncOpenAI(api_key=api_key)
+    def __init__(self, api_key, response_cache=None, client=None, rate_limiter=None, concurrency_limiter=None):
+        # 优先使用传入的共享客户端，复用已建立的连接
+        self.client = client if client is not None else AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        # 没有传入共享的并发限制时单独创建一个
+        self.concurrency_limiter = (concurrency_limiter if concurrency_limiter is not None 
+                                    else ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS))
+        self.encoding = tiktoken.encoding_for_model("gpt-4o-mini") if tiktoken is not None else None
         self.setup_logging()
     
     def setup_logging(self):
@@ -120,57 +327,129 @@ class ContentMatcher:
         )
         self.logger = logging.getLogger(__name__)
 
-    async def match_content_to_toc(self, content: ContentChunk, toc_options: List[TocChunk]) -> TocChunk:
-        """使用GPT-4o-mini匹配内容到最合适的TOC条目"""
+    def truncate_content(self, text: str) -> str:
+        """
+        截取正文开头的CONTENT_TOKEN_BUDGET个token，避免prompt过长
+        只对足够长的前缀编码（每个token很少超过8个字符），不必编码整段正文；未安装tiktoken时按字符截取
+        """
+        if self.encoding is None:
+            return text[:CONTENT_CHAR_BUDGET]
+        tokens = self.encoding.encode_ordinary(text[:CONTENT_TOKEN_BUDGET * 8])
+        if len(tokens) <= CONTENT_TOKEN_BUDGET:
+            return text[:CONTENT_TOKEN_BUDGET * 8]
+        # 在token边界截断时可能切开一个多字节字符，去掉解码出的替换字符
+        return self.encoding.decode(tokens[:CONTENT_TOKEN_BUDGET]).rstrip('\ufffd')
+
+    async def generate_response(self, messages, max_tokens, response_format=None):
+        """调用GPT-4o-mini，相同的请求优先从缓存返回"""
+        model = "gpt-4o-mini"
+        temperature = 0.3
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(model, temperature, messages)
+            reply = self.response_cache.get(cache_key)
+            if reply is not None:
+                return reply
+        
+        params = dict(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=1.0,
+            frequency_penalty=0.0,
+            presence_penalty=0.0
+        )
+        if response_format is not None:
+            params['response_format'] = response_format
+        # 限流和临时错误按指数退避重试，不直接退回默认选项
+        for attempt in range(MAX_API_ATTEMPTS):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            try:
+                async with self.concurrency_limiter.slot():
+                    response = await self.client.chat.completions.create(**params)
+                break
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    raise
+                delay = retry_delay(e, attempt)
+                self.logger.warning(f"API调用失败，{delay:.1f}秒后重试: {str(e)}")
+                await asyncio.sleep(delay)
+        reply = response.choices[0].message.content
+        if cache_key is not None:
+            self.response_cache.set(cache_key, reply)
+        return reply
+
+    async def match_content_to_toc(self, content: ContentChunk, toc_options: Sequence[str]) -> int:
+        """
+        使用GPT-4o-mini匹配内容到最合适的TOC条目，返回该条目在toc_options中的位置
+        toc_options是已经渲染好的"chapter - section"字符串
+        """
         try:
             # 构建TOC选项字符串
-            toc_options_str = "\n".join([f"{i}. {toc.chapter} - {toc.section}" 
-                                       for i, toc in enumerate(toc_options, 1)])
+            toc_options_str = "\n".join([f"{i}. {toc}" for i, toc in enumerate(toc_options, 1)])
             
-            prompt = f"""你是一个文本分类专家。请根据给定的内容，从以下目录选项中选择最合适的一个。
-只需返回选项的序号（如：1），不要有任何其他解释。
-
-请注意：
-请重点关注chapter,section,subsection之前的标识符，他们是有规律的。比如subsection2.2.2代表第2章，2.2节。
-请主要按照section与（content和subsection）的相似度来判断，如果相似度很高，则返回section的序号。
-如果内容能够匹配多个章节，就给出所有选择中的第二个结果。
-如果你认为内容无法匹配任何一个章节，给出所有选择中的第二个结果。
-针对你对内容的理解以及内容中的关键词来做判断。
-
-目录选项：
+            # 固定的分类说明放在system消息中，每次请求只有user消息中的目录选项和内容不同
+            user_prompt = f"""目录选项：
 {toc_options_str}
 
 内容：
 标题：{content.subsection}
-正文：{content.content[:300]}...  # 截取前500字符避免token过多
+正文：{self.truncate_content(content.content)}...
 """
-
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                max_tokens=10,  # 只需要返回数字
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
+            messages = [
+                {"role": "system", "content": MATCH_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ]
+            reply = await self.generate_response(messages, max_tokens=10)  # 只需要返回数字
             
             # 获取返回的序号
             try:
-                selected_index = int(response.choices[0].message.content.strip()) - 1
+                selected_index = int(reply.strip()) - 1
                 if 0 <= selected_index < len(toc_options):
-                    return toc_options[selected_index]
+                    return selected_index
                 else:
                     raise ValueError("Invalid index returned")
             except ValueError:
                 self.logger.error("GPT返回了无效的序号")
-                return toc_options[0]  # 默认返回第一个选项
+                return 0  # 默认返回第一个选项
                 
         except Exception as e:
             self.logger.error(f"API调用失败: {str(e)}")
-            return toc_options[0]  # 出错时返回第一个选项
+            return 0  # 出错时返回第一个选项
 
-async def process_single_book(toc_path: str, content_path: str, output_dir: str):
+    async def match_batch(self, contents: List[ContentChunk], toc_options: Sequence[str]) -> List[int]:
+        """
+        一次请求把多个相邻的内容块匹配到同一组TOC选项，按顺序返回各内容块所选条目在toc_options中的位置
+        模型返回的JSON无法解析或数量不对时，退回逐个内容块请求
+        """
+        if len(contents) > 1:
+            toc_options_str = "\n".join([f"{i}. {toc}" for i, toc in enumerate(toc_options, 1)])
+            contents_str = "\n".join(
+                f"<<<CONTENT {n}>>>\n标题：{content.subsection}\n正文：{self.truncate_content(content.content)}..."
+                for n, content in enumerate(contents, 1)
+            )
+            messages = [
+                {"role": "system", "content": MATCH_SYSTEM_PROMPT + MATCH_BATCH_INSTRUCTION},
+                {"role": "user", "content": f"目录选项：\n{toc_options_str}\n\n内容：\n{contents_str}\n"}
+            ]
+            try:
+                # 每个序号只占几个token，按内容块数量留出余量
+                reply = await self.generate_response(messages, max_tokens=5 * len(contents) + 20,
+                                                     response_format={"type": "json_object"})
+                selected = json.loads(reply)["matches"]
+                if (isinstance(selected, list) and len(selected) == len(contents)
+                        and all(isinstance(index, int) and 1 <= index <= len(toc_options) for index in selected)):
+                    return [index - 1 for index in selected]
+                self.logger.warning("批量匹配返回的格式不正确，改为逐个匹配")
+            except Exception as e:
+                self.logger.warning(f"批量匹配失败，改为逐个匹配: {str(e)}")
+        
+        return [await self.match_content_to_toc(content, toc_options) for content in contents]
+
+async def process_single_book(toc_path: str, content_path: str, output_dir: str, 
+                              matcher: Optional[ContentMatcher] = None):
     """
     处理单本书的合并任务
     """
@@ -182,47 +461,100 @@ async def process_single_book(toc_path: str, content_path: str, output_dir: str)
         toc_chunks = load_toc(toc_path)
         content_chunks = load_content(content_path)
         
-        # 创建 matcher 实例
-        api_key = os.getenv("OPENAI_API_KEY")
-        matcher = ContentMatcher(api_key)
+        # 没有传入共享的 matcher 时才单独创建
+        if matcher is None:
+            matcher = ContentMatcher(os.getenv("OPENAI_API_KEY"))
         
-        merged_results = []
         current_toc_index = 0
         
-        # 处理每个内容块
-        for content_chunk in tqdm(content_chunks, 
-                                desc=f"Processing {os.path.basename(content_path)}", 
-                                unit="chunks"):
-            # 获取相关的 TOC 选项窗口
-            toc_window = get_toc_window(toc_chunks, current_toc_index)
-            
-            # 使用 GPT 匹配最合适的 TOC 条目
-            matched_toc = await matcher.match_content_to_toc(content_chunk, toc_window)
-            
-            # 更新当前TOC索引
-            matched_index = toc_chunks.index(matched_toc)
-            current_toc_index = matched_index
-            
-            # 创建合并后的数据结构
-            merged_chunk = {
-                "Chapter": matched_toc.chapter,
-                "Section": matched_toc.section,
-                "Subsection": content_chunk.subsection,
-                "Content": content_chunk.content
-            }
-            merged_results.append(merged_chunk)
-            
-            # 添加小延迟以避免API限制
-            await asyncio.sleep(0.1)
+        # TOC条目的选项文字只渲染一次，每个窗口直接切片
+        toc_labels = tuple(str(toc) for toc in toc_chunks)
+        
+        # 相邻的MATCH_BATCH_SIZE个内容块共用当前位置的TOC窗口，一次请求一起匹配
+        # 上一批没有改变位置时，后面几个批次的请求提前发出，窗口按当前的TOC位置预测；位置改变时作废这些请求并按新位置重新发出
+        pending = {}
+        prefetch_depth = 1
         
         # 生成输出文件名
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_filename = f"merged_{timestamp}_{os.path.basename(toc_path)}"
         output_path = os.path.join(output_dir, output_filename)
         
+        # 合并结果边匹配边写入临时文件，不在内存中保留整本书，整本书完成后再改成正式文件名
+        # 写出的格式与json.dump(..., indent=2)相同
+        partial_path = output_path + '.part'
+        out = open(partial_path, 'wb')
+        written = 0
+        
+        def schedule(batch_start):
+            window_start, toc_window = get_toc_window(toc_labels, current_toc_index)
+            batch = content_chunks[batch_start:batch_start + MATCH_BATCH_SIZE]
+            pending[batch_start] = (window_start, toc_window, 
+                                    asyncio.create_task(matcher.match_batch(batch, toc_window)))
+        
+        try:
+            with tqdm(total=len(content_chunks), 
+                      desc=f"Processing {os.path.basename(content_path)}", 
+                      unit="chunks") as pbar:
+                batch_start = 0
+                while batch_start < len(content_chunks):
+                    for j in range(batch_start, 
+                                   min(batch_start + prefetch_depth * MATCH_BATCH_SIZE, len(content_chunks)), 
+                                   MATCH_BATCH_SIZE):
+                        if j not in pending:
+                            schedule(j)
+                    
+                    # 使用 GPT 匹配最合适的 TOC 条目（请求的窗口与当前位置一致）
+                    window_start, toc_window, task = pending.pop(batch_start)
+                    positions = await task
+                    
+                    # 匹配到窗口最后一个条目的内容可能已超出窗口，从这个内容块起按前一块的位置重新匹配
+                    # 位置比前一块靠前时同样从这个内容块起重新匹配，保证写出的章节顺序不后退
+                    # 批次的第一个内容块用的窗口与逐块匹配时相同，直接采用
+                    accepted = len(positions)
+                    last_position = len(toc_window) - 1
+                    window_reaches_end = window_start + last_position >= len(toc_chunks) - 1
+                    for k in range(1, len(positions)):
+                        if positions[k] < positions[k - 1] or (positions[k] == last_position and not window_reaches_end):
+                            accepted = k
+                            break
+                    
+                    # 创建合并后的数据结构
+                    batch = content_chunks[batch_start:batch_start + accepted]
+                    for content_chunk, position in zip(batch, positions):
+                        matched_toc = toc_chunks[window_start + position]
+                        merged_chunk = {
+                            "Chapter": matched_toc.chapter,
+                            "Section": matched_toc.section,
+                            "Subsection": content_chunk.subsection,
+                            "Content": content_chunk.content
+                        }
+                        out.write((b',\n  ' if written else b'[\n  ') + dumps_json(merged_chunk).replace(b'\n', b'\n  '))
+                        written += 1
+                    batch_start += accepted
+                    pbar.update(accepted)
+                    
+                    # 更新当前TOC索引，由窗口起点和窗口内的位置直接得到，不需要在TOC中查找
+                    matched_index = window_start + positions[accepted - 1]
+                    if matched_index != current_toc_index or accepted < len(positions):
+                        current_toc_index = matched_index
+                        # 已发出的请求用的是旧位置的窗口或旧的批次划分，全部作废后重新发出
+                        for _, _, pending_task in pending.values():
+                            pending_task.cancel()
+                        pending.clear()
+                        prefetch_depth = 1
+                    else:
+                        prefetch_depth = PREFETCH_DEPTH
+            
+            out.write(b'\n]' if written else b'[]')
+        finally:
+            # 出错退出时取消还没完成的预取请求
+            for _, _, task in pending.values():
+                task.cancel()
+            out.close()
+        
         # 保存结果
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(merged_results, f, ensure_ascii=False, indent=2)
+        os.replace(partial_path, output_path)
         
         elapsed_time = time.time() - start_time
         print(f"Completed {os.path.basename(toc_path)} in {elapsed_time:.2f} seconds")
@@ -247,22 +579,43 @@ async def process_all_books(toc_dir: str, content_dir: str, output_dir: str):
     # 创建信号量限制并发数
     semaphore = asyncio.Semaphore(10)
     
-    async def process_with_semaphore(toc_path, content_path):
-        async with semaphore:
-            return await process_single_book(toc_path, content_path, output_dir)
+    # 所有书共用一个响应缓存
+    response_cache = ResponseCache(os.path.join(output_dir, RESPONSE_CACHE_FILE))
     
-    # 创建所有书籍的任务
-    tasks = []
-    for toc_path, content_path in file_pairs:
-        task = process_with_semaphore(toc_path, content_path)
-        tasks.append(task)
+    # 所有书共用一个限流器，按总的请求速率排队，不再在每个内容块之后固定等待
+    rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
+    # 所有书共用一个自适应的并发限制，按是否被限流调整同时进行的请求数
+    concurrency_limiter = ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS)
     
-    # 并行执行所有任务
-    results = await asyncio.gather(*tasks)
+    # 所有书共用一个客户端和连接池，连接数上限按并发请求数放大，避免请求排队等待连接
+    http_client = httpx.AsyncClient(limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    ))
+    api_key = os.getenv("OPENAI_API_KEY")
+    async with AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0) as client:
+        # 所有书共用一个 matcher，日志只设置一次
+        matcher = ContentMatcher(api_key, response_cache, client, rate_limiter, concurrency_limiter)
+        
+        async def process_with_semaphore(toc_path, content_path):
+            async with semaphore:
+                return await process_single_book(toc_path, content_path, output_dir, matcher)
+        
+        # 创建所有书籍的任务
+        tasks = []
+        for toc_path, content_path in file_pairs:
+            task = asyncio.create_task(process_with_semaphore(toc_path, content_path))
+            tasks.append(task)
+        
+        # 并行执行所有任务，按完成顺序统计结果，不必等所有书完成后再汇总
+        successful = 0
+        for finished in asyncio.as_completed(tasks):
+            if await finished is not None:
+                successful += 1
     
     # 统计处理结果
-    successful = len([r for r in results if r is not None])
-    failed = len(results) - successful
+    failed = len(tasks) - successful
     
     print(f"\nProcessing completed:")
     print(f"Successfully processed: {successful} books")
@@ -322,7 +675,9 @@ def main():
     print(f"Output Directory: {output_dir}")
     
     try:
-        # 使用 asyncio 运行异步函数
+        # 使用 asyncio 运行异步函数，安装了uvloop时换用更快的事件循环
+        if uvloop is not None:
+            uvloop.install()
         asyncio.run(process_all_books(toc_dir, content_dir, output_dir))
     except Exception as e:
         print(f"Error during processing: {str(e)}")
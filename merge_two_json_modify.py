@@ -12,10 +12,11 @@
 这种方式可以帮助模型在相邻的内容区域内进行匹配，提高匹配的准确性。
 """
 import json
+import re
 from typing import List, Dict, Optional
 import sys
 import os
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 from dotenv import load_dotenv
 import asyncio
 import logging
@@ -23,8 +24,75 @@ from datetime import datetime
 import argparse
 from tqdm import tqdm
 import time
+import numpy as np
+import httpx
+import hashlib
+import random
+import sqlite3
+from bisect import bisect_left
+
+try:
+    import orjson
+    loads_json = orjson.loads
+    
+    def dumps_json(obj) -> bytes:
+        """以2空格缩进序列化为UTF-8字节"""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:  # 未安装 orjson 时退回标准库 json，json.loads 同样可以直接解析UTF-8字节
+    loads_json = json.loads
+    
+    def dumps_json(obj) -> bytes:
+        """以2空格缩进序列化为UTF-8字节"""
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+try:
+    import h2  # httpx 的 HTTP/2 支持依赖 h2
+except ImportError:  # 未安装 h2 时使用 HTTP/1.1
+    h2 = None
+
+try:
+    import ijson
+except ImportError:  # 未安装 ijson 时整体读取文件
+    ijson = None
+
+# 缓存API响应的SQLite文件名，保存在输出目录中
+RESPONSE_CACHE_FILE = 'response_cache.sqlite3'
+
+class ResponseCache:
+    """
+    按(模型, 参数, prompt)的SHA-256哈希把API响应缓存在SQLite文件中
+    重新运行或不同的书出现相同的分段时，直接返回保存的结果，不再调用API
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT)')
+        self.conn.commit()
+    
+    @staticmethod
+    def make_key(model, temperature, messages):
+        """
+        根据模型、温度和消息列表生成缓存键
+        消息中的连续空白先合并成一个空格，只有换行、缩进不同的重复分段也能命中缓存
+        """
+        normalized_messages = '|'.join(
+            f"{message['role']}:{' '.join(message['content'].split())}" for message in messages
+        )
+        return hashlib.sha256(f"{model}|{temperature}|{normalized_messages}".encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """查询缓存，未命中时返回None"""
+        row = self.conn.execute('SELECT response FROM cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key, response):
+        """保存一条响应，相同的键已存在时保留原有结果"""
+        self.conn.execute('INSERT OR IGNORE INTO cache (key, response) VALUES (?, ?)', (key, response))
+        self.conn.commit()
 
 class TocChunk:
+    # 长书有上万个条目，用__slots__省去每个对象的__dict__
+    __slots__ = ("chapter", "section")
+    
     def __init__(self, chapter: str, section: str):
         self.chapter = chapter
         self.section = section
@@ -33,58 +101,82 @@ class TocChunk:
         return f"{self.chapter} - {self.section}"
 
 class ContentChunk:
+    __slots__ = ("subsection", "content")
+    
     def __init__(self, subsection: str, content: str):
         self.subsection = subsection
         self.content = content
 
+def iter_json_records(file_path: str, key: str, select_records):
+    """
+    逐个返回JSON文件中的记录：根节点是数组时返回数组元素，是对象时返回key下的数组元素
+    安装了ijson时流式解析，不把整个文档读入内存；
+    没有ijson，或根对象中没有key下的记录时，整体读取文件，由select_records从根节点取出记录列表
+    """
+    if ijson is not None:
+        with open(file_path, 'rb') as f:
+            root_event = next(ijson.basic_parse(f), (None, None))[0]
+        prefix = 'item' if root_event == 'start_array' else f'{key}.item'
+        streamed = False
+        with open(file_path, 'rb') as f:
+            for record in ijson.items(f, prefix, use_float=True):
+                streamed = True
+                yield record
+        if streamed or root_event == 'start_array':
+            return
+    
+    with open(file_path, 'rb') as f:
+        data = loads_json(f.read())
+    yield from select_records(data)
+
+def select_toc_sections(data):
+    # 检查数据结构
+    if isinstance(data, dict) and 'sections' in data:
+        return data['sections']
+    return data
+
 def load_toc(file_path: str) -> List[TocChunk]:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        print(f"TOC data type: {type(data)}")
-        
-        # 检查数据结构
-        if isinstance(data, dict) and 'sections' in data:
-            sections = data['sections']
+    logger = logging.getLogger(__name__)
+    # 每个条目的详细信息只在DEBUG级别输出，正常运行时不逐条格式化和打印
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    chunks = []
+    for section in iter_json_records(file_path, 'sections', select_toc_sections):
+        if debug_enabled:
+            logger.debug(f"Processing TOC section: {section}")
+        chapter = section.get('Chapter', '')
+        section_title = section.get('Section', '')
+        chunks.append(TocChunk(chapter, section_title))
+    
+    print(f"Loaded {len(chunks)} TOC chunks")
+    return chunks
+
+def select_content_sections(data):
+    # 检查数据结构并统一处理为列表
+    if isinstance(data, dict):
+        if 'Subsections' in data:  # 处理包含 Subsections 的情况
+            return data['Subsections']
+        elif 'sections' in data:
+            return data['sections']
         else:
-            sections = data
-            
-        chunks = []
-        for section in sections:
-            # 添加调试信息
-            print(f"Processing TOC section: {section}")
-            chapter = section.get('Chapter', '')
-            section_title = section.get('Section', '')
-            chunks.append(TocChunk(chapter, section_title))
-        
-        print(f"Loaded {len(chunks)} TOC chunks")
-        return chunks
+            return [data]
+    return data
 
 def load_content(file_path: str) -> List[ContentChunk]:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        print(f"Content data type: {type(data)}")
-        
-        # 检查数据结构并统一处理为列表
-        if isinstance(data, dict):
-            if 'Subsections' in data:  # 处理包含 Subsections 的情况
-                sections = data['Subsections']
-            elif 'sections' in data:
-                sections = data['sections']
-            else:
-                sections = [data]
-        else:
-            sections = data
-            
-        chunks = []
-        for item in sections:
-            if isinstance(item, dict):
-                subsection = item.get('Subsection')
-                content = item.get('Content')
-                if subsection and content:  # 确保两个字段都不为空
-                    chunks.append(ContentChunk(subsection, content))
-                    
-        print(f"Loaded {len(chunks)} content chunks")
-        return chunks
+    chunks = []
+    for item in iter_json_records(file_path, 'Subsections', select_content_sections):
+        if isinstance(item, dict):
+            subsection = item.get('Subsection')
+            content = item.get('Content')
+            if subsection and content:  # 确保两个字段都不为空
+                chunks.append(ContentChunk(subsection, content))
+                
+    print(f"Loaded {len(chunks)} content chunks")
+    return chunks
+
+def render_toc_options(toc_options: List[TocChunk]) -> str:
+    """把窗口内的TOC条目渲染成带序号的选项列表"""
+    return "\n".join([f"{i}. {toc.chapter} - {toc.section}" 
+                      for i, toc in enumerate(toc_options, 1)])
 
 ### 这个地方实际调节了误差的范围，只有前后n个标题会被输送给gpt。
 def get_toc_window(toc_chunks: List[TocChunk], current_index: int, window_size: int = 8) -> List[TocChunk]:
@@ -96,13 +188,104 @@ def get_toc_window(toc_chunks: List[TocChunk], current_index: int, window_size:
     end_idx = min(len(toc_chunks), start_idx + window_size)  # 向后取6个位置
     return toc_chunks[start_idx:end_idx]
 
+# 计算TOC条目和内容块嵌入向量的模型，以及每次请求的文本数量
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256
+# 窗口内最相似的两个TOC条目的余弦相似度至少相差这么多时直接采用，否则交给GPT判断
+EMBEDDING_MARGIN = 0.05
+
+# 小节标题开头的章节编号，如"2.2.2 细胞膜"取出(2, 2)；TOC的节标题按同样的方式取出编号
+SECTION_NUMBER_PATTERN = re.compile(r'^\s*(\d+)\.(\d+)')
+
+# 匹配请求中固定不变的说明，作为system消息放在最前面
+MATCH_SYSTEM_PROMPT = """你是一个文本分类专家。请为给定的每个文本块分别从目录选项中选择最合适的一个。
+请按顺序返回每个块对应的选项序号，以JSON格式输出：{"indices": [第1个块的序号, 第2个块的序号, ...]}，如：{"indices": [1, 1, 2]}。不要有任何解释。
+
+请注意：
+chapter,section,subsection之前的标识符，他们是有规律的。比如subsection2.2.2代表第2章，2.2节。
+请主要按照section与（content和subsection）的相似度来判断，如果相似度很高，则返回section的序号。
+请注意，这些文本块是存在先后顺序的，后一个块的chapter,section的序号必须大于或等于前一个块的序号。举例：1,2或者3,3是允许的。
+请注意，相邻两个文本块的chapter,section的序号间隔不要太大，比如1,4或者2,5是不允许的。
+如果某个文本块内容能够匹配多个章节，就给出所有选择中的第二个结果。
+如果你认为文本块内容无法匹配任何一个章节，给出所有选择中的第二个结果。
+"""
+
+# 每个匹配请求包含的相邻内容块数量，目录选项每批只发送一次
+MATCH_BATCH_SIZE = 8
+# 上一批结束时TOC位置没有改变时，预先发出匹配请求的批数（包括当前批），也是每本书同时进行的请求数上限
+# 位置改变后预取的请求都会作废，所以位置刚改变时只发出当前批
+PREFETCH_DEPTH = 2
+
+# 所有书共用的HTTP连接池大小，要大于同时进行的请求数（书的并发数 × 每本书预取的批次数）
+HTTP_MAX_CONNECTIONS = 200
+# 空闲连接的保持时间（秒）
+HTTP_KEEPALIVE_EXPIRY = 60
+
+# 每本书每处理完多少个内容块输出一次进度
+PROGRESS_INTERVAL = 100
+
+# API调用遇到限流、连接错误、超时或服务端错误时的最大尝试次数
+# 创建客户端时关闭SDK自带的重试（max_retries=0），只由这里的重试和退避处理，避免两层重试叠加
+MAX_API_ATTEMPTS = 6
+# 指数退避的初始等待时间（秒），每次重试翻倍
+RETRY_BASE_DELAY = 0.5
+# 可以重试的API错误
+RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# 所有书合计每分钟最多发出的API请求数，按账号的速率限制设置
+MAX_REQUESTS_PER_MINUTE = 500
+
+def retry_delay(error, attempt):
+    """
+    计算第attempt次失败后的等待时间
+    限流响应带有retry-after时按它等待，否则指数退避并加上随机抖动，避免并发请求同时重试
+    """
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, RETRY_BASE_DELAY / 2)
+
+class RateLimiter:
+    """
+    令牌桶限流：桶中最多有max_rate个令牌，按每time_period秒max_rate个的速度补充，每次请求消耗一个
+    没有超出额度时请求直接发出，额度用完后才按速度排队
+    """
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.refill_rate = max_rate / time_period
+        self.tokens = max_rate
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """取得一个令牌，令牌不足时等待补充"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.max_rate, self.tokens + (now - self.last_refill) * self.refill_rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.refill_rate)
+
 class ContentMatcher:
-    def __init__(self, api_key):
-        self.client = AsyncOpenAI(api_key=api_key)
+    def __init__(self, api_key, response_cache=None, client=None, rate_limiter=None):
+        # 优先使用传入的共享客户端，复用已建立的连接
+        self.client = client if client is not None else AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
         self.setup_logging()
     
     def setup_logging(self):
-        """设置日志"""
+        """设置日志，日志处理器只在第一次创建 matcher 时创建，之后共用"""
+        self.logger = logging.getLogger(__name__)
+        if logging.getLogger().handlers:
+            return
         # Create logs directory if it doesn't exist
         log_dir = '/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/logs'
         os.makedirs(log_dir, exist_ok=True)
@@ -118,76 +301,134 @@ class ContentMatcher:
                 logging.StreamHandler()
             ]
         )
-        self.logger = logging.getLogger(__name__)
 
-    async def match_content_to_toc(self, content: ContentChunk, content_list: List[ContentChunk], current_index: int, toc_options: List[TocChunk]) -> List[TocChunk]:
+    async def call_api(self, create, **params):
+        """发出一次API请求，先从限流器取得令牌，限流和临时错误按指数退避重试"""
+        for attempt in range(MAX_API_ATTEMPTS):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            try:
+                return await create(**params)
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    raise
+                delay = retry_delay(e, attempt)
+                self.logger.warning(f"API调用失败，{delay:.1f}秒后重试: {str(e)}")
+                await asyncio.sleep(delay)
+
+    async def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """按EMBEDDING_BATCH_SIZE分批计算文本的嵌入向量，返回按行归一化的矩阵"""
+        batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+        responses = await asyncio.gather(*(
+            self.call_api(self.client.embeddings.create, model=EMBEDDING_MODEL, input=batch) for batch in batches
+        ))
+        vectors = np.array([item.embedding for response in responses for item in response.data], dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    async def match_batch(self, chunks: List[ContentChunk], toc_options: List[TocChunk], 
+                          toc_embeddings: Optional[np.ndarray] = None, 
+                          chunk_embeddings: Optional[np.ndarray] = None, 
+                          numbered_tocs: Optional[List[Optional[TocChunk]]] = None, 
+                          toc_options_str: Optional[str] = None) -> List[TocChunk]:
         """
-        匹配内容到目录项，使用三个相邻的文本块进行验证
-        返回三个文本块对应的TOC条目列表
+        匹配一批连续的内容块，返回每个块对应的TOC条目
+        numbered_tocs中已经按小节编号确定的块直接采用；其余的先在窗口内按嵌入向量的余弦相似度选择，
+        最相似的两个条目差距小于EMBEDDING_MARGIN，或者没有嵌入向量时，把这些块合并成一个请求交给GPT判断
         """
-        # 获取相邻的三个文本块，每个块限制300字符
-        chunks = []
-        chunk_texts = []  # 存储文本块的标题和内容
+        results = list(numbered_tocs) if numbered_tocs is not None else [None] * len(chunks)
+        if toc_embeddings is not None and chunk_embeddings is not None:
+            if len(toc_options) == 1:
+                return [toc or toc_options[0] for toc in results]
+            similarities = chunk_embeddings @ toc_embeddings.T
+            ranked = np.argsort(similarities, axis=1)
+            for k, (second, best) in enumerate(ranked[:, -2:]):
+                if results[k] is None and similarities[k, best] - similarities[k, second] >= EMBEDDING_MARGIN:
+                    results[k] = toc_options[best]
         
-            
-        # 添加当前块
-        chunks.append(content)
-        chunk_texts.append(f"以下是第一个文本块：{content.subsection}\n内容：{content.content[:200]}")
-        
-        # 添加后一个块（如果存在）
-        if current_index < len(content_list) - 1:
-            chunks.append(content_list[current_index + 1])
-            chunk_texts.append(f"第一块结束，以下是第二个文本块：{content_list[current_index + 1].subsection}\n内容：{content_list[current_index + 1].content[:200]}")
+        undecided = [k for k, toc in enumerate(results) if toc is None]
+        if undecided:
+            matched_tocs = await self.match_content_to_toc([chunks[k] for k in undecided], toc_options, toc_options_str)
+            for k, toc in zip(undecided, matched_tocs):
+                results[k] = toc
+        return results
+
+    async def match_content_to_toc(self, chunks: List[ContentChunk], toc_options: List[TocChunk], 
+                                   toc_options_str: Optional[str] = None) -> List[TocChunk]:
+        """
+        在一个请求中匹配多个相邻的文本块，目录选项只发送一次
+        toc_options_str是已经渲染好的目录选项，没有传入时按toc_options生成
+        返回每个文本块对应的TOC条目列表
+        """
+        # 每个块按顺序编号，内容限制200字符
+        chunk_texts = [f"[{k}] {chunk.subsection}\n内容：{chunk.content[:200]}" 
+                       for k, chunk in enumerate(chunks, 1)]
             
         # 构建TOC选项字符串
-        toc_options_str = "\n".join([f"{i}. {toc.chapter} - {toc.section}" 
-                                   for i, toc in enumerate(toc_options, 1)])
+        if toc_options_str is None:
+            toc_options_str = render_toc_options(toc_options)
         
-        prompt = "你是一个文本分类专家。请为以下两个文本块从目录选项中选择最合适的一个。\n" + \
-                 "请按顺序返回两个块对应的选项序号，用逗号分隔（如：1,2）。不要有任何解释。\n\n" + \
-                 "请注意：\n" + \
-                 "chapter,section,subsection之前的标识符，他们是有规律的。比如subsection2.2.2代表第2章，2.2节。\n" + \
-                 "请主要按照section与（content和subsection）的相似度来判断，如果相似度很高，则返回section的序号。\n" + \
-                 "请注意，这2个文本块是存在先后顺序的，第二个块的chapter,section的序号必须大于或等于第一个块的序号。举例：1,2或者3,3是允许的。\n" + \
-                 "请注意，两个文本块的chapter,section的序号间隔不要太大，比如1,4或者2,5是不允许的。\n" + \
-                 "如果某个文本块内容能够匹配多个章节，就给出所有选择中的第二个结果。\n" + \
-                 "如果你认为文本块内容无法匹配任何一个章节，给出所有选择中的第二个结果。\n\n" + \
-                 "目录选项：\n" + \
-                 toc_options_str + "\n\n" + \
-                 "文本块：\n" + \
-                 "\n\n".join(chunk_texts) + "\n\n" + \
-                 "请返回每个块对应的选项序号（用逗号分隔）："
+        # 固定的说明放在system消息中，每次请求只有user消息中的目录选项和文本块不同，
+        # 相同的前缀可以命中OpenAI的提示缓存
+        messages = [
+            {"role": "system", "content": MATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": "目录选项：\n" + toc_options_str + "\n\n" + 
+                                        f"文本块（共{len(chunks)}个）：\n" + "\n\n".join(chunk_texts) + "\n\n" + 
+                                        f"请以JSON格式返回这{len(chunks)}个块对应的选项序号："}
+        ]
 
         try:
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                max_tokens=15,
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
+            model = "gpt-4o-mini"
+            # 分类任务不需要随机性，温度为0时同一prompt的结果稳定，缓存的结果才等同于重新请求
+            temperature = 0.0
+            # 相同的文本块和目录选项优先从缓存返回
+            cache_key = None
+            reply = None
+            if self.response_cache is not None:
+                cache_key = ResponseCache.make_key(model, temperature, messages)
+                reply = self.response_cache.get(cache_key)
+            if reply is None:
+                response = await self.call_api(
+                    self.client.chat.completions.create,
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    # 每个序号和逗号约占几个token，另外留出JSON括号和键名的余量
+                    max_tokens=4 * len(chunks) + 10,
+                    # JSON模式保证返回可以解析的JSON，不会夹带解释文字
+                    response_format={"type": "json_object"}
+                )
+                reply = response.choices[0].message.content
+                if cache_key is not None:
+                    self.response_cache.set(cache_key, reply)
             
             # 处理返回的序号列表
             try:
-                indices = [int(idx.strip()) - 1 for idx in response.choices[0].message.content.strip().split(',')]
+                indices = [int(idx) - 1 for idx in loads_json(reply)["indices"]]
+                if len(indices) != len(chunks):
+                    self.logger.error(f"GPT返回了{len(indices)}个序号，应为{len(chunks)}个")
+                    return [toc_options[0]] * len(chunks)
                 results = []
+                previous = 0
                 for idx in indices:
-                    if 0 <= idx < len(toc_options):
-                        results.append(toc_options[idx])
-                    else:
-                        results.append(toc_options[0])  # 对于无效索引使用第一个选项
+                    if not 0 <= idx < len(toc_options):
+                        idx = 0  # 对于无效索引使用第一个选项
+                    if idx < previous:
+                        # 文本块按顺序排列，序号不能比前一个块小
+                        self.logger.warning(f"GPT返回的序号不是递增的: {reply}")
+                        idx = previous
+                    results.append(toc_options[idx])
+                    previous = idx
                 return results
-            except ValueError:
-                self.logger.error("GPT返回了无效的序号格式")
+            except (ValueError, KeyError, TypeError):
+                self.logger.error(f"GPT返回了无效的序号格式: {reply}")
                 return [toc_options[0]] * len(chunks)  # 返回相同数量的默认选项
                 
         except Exception as e:
             self.logger.error(f"API调用失败: {str(e)}")
             return [toc_options[0]] * len(chunks)  # 返回相同数量的默认选项
 
-async def process_single_book(toc_path: str, content_path: str, output_dir: str):
+async def process_single_book(toc_path: str, content_path: str, output_dir: str, 
+                              matcher: Optional[ContentMatcher] = None):
     """
     处理单本书的合并任务
     """
@@ -195,80 +436,178 @@ async def process_single_book(toc_path: str, content_path: str, output_dir: str)
         print(f"\nProcessing book: {os.path.basename(toc_path)}")
         start_time = time.time()
         
-        # 加载文档
-        toc_chunks = load_toc(toc_path)
+        # 加载文档，两个文件在线程中同时读取和解析，不阻塞其他书的请求
+        toc_chunks, content_chunks = await asyncio.gather(
+            asyncio.to_thread(load_toc, toc_path),
+            asyncio.to_thread(load_content, content_path)
+        )
         if not toc_chunks:
             raise ValueError(f"No TOC chunks loaded from {toc_path}")
             
-        content_chunks = load_content(content_path)
         if not content_chunks:
             raise ValueError(f"No content chunks loaded from {content_path}")
         
-        # 创建 matcher 实例
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY not found in environment variables")
-            
-        matcher = ContentMatcher(api_key)
+        # 没有传入共享的 matcher 时才单独创建
+        if matcher is None:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OPENAI_API_KEY not found in environment variables")
+                
+            matcher = ContentMatcher(api_key)
         
-        merged_results = []
         current_toc_index = 0
+        # 匹配结果就是toc_chunks中的对象，按对象id查出它的位置，不必每次线性查找
+        toc_index_map = {id(toc): index for index, toc in enumerate(toc_chunks)}
         
-        # 处理每个内容块
-        for i, content_chunk in enumerate(tqdm(content_chunks, 
-                                desc=f"Processing {os.path.basename(content_path)}", 
-                                unit="chunks")):
-            try:
-                # 获取相关的 TOC 选项窗口
-                toc_window = get_toc_window(toc_chunks, current_toc_index)
-                if not toc_window:
-                    raise ValueError(f"Empty TOC window at index {current_toc_index}")
-                
-                # 使用 GPT 匹配最合适的 TOC 条目
-                matched_tocs = await matcher.match_content_to_toc(content_chunk, content_chunks, i, toc_window)
-                if not matched_tocs:
-                    raise ValueError("No matching TOC entries returned from GPT")
-                
-                matched_toc = matched_tocs[0]  # 使用第一个匹配结果
+        # 小节标题带有"章.节"编号、且TOC中有相同编号的节时，直接定位到该节，不必计算相似度或调用GPT
+        # 各部分重新编号时同一个编号会出现多次，记下每个编号的所有位置，只采用不在当前窗口之前的那一个，保证位置不会后退
+        toc_positions_by_number = {}
+        for index, toc in enumerate(toc_chunks):
+            number_match = SECTION_NUMBER_PATTERN.match(toc.section or '')
+            if number_match:
+                toc_positions_by_number.setdefault((int(number_match.group(1)), int(number_match.group(2))), []).append(index)
+        chunk_numbers = []
+        for chunk in content_chunks:
+            number_match = SECTION_NUMBER_PATTERN.match(chunk.subsection)
+            chunk_numbers.append((int(number_match.group(1)), int(number_match.group(2))) if number_match else None)
+        numbered_count = 0
+        
+        def numbered_toc(number, window_start):
+            """编号为number、位置不在window_start之前的第一个TOC条目，没有时返回None"""
+            positions = toc_positions_by_number.get(number)
+            if not positions:
+                return None
+            k = bisect_left(positions, window_start)
+            return toc_chunks[positions[k]] if k < len(positions) else None
+        
+        # 所有TOC条目和内容块的嵌入向量各计算一次，大部分内容块直接按相似度匹配，不必调用GPT
+        try:
+            toc_embeddings, content_embeddings = await asyncio.gather(
+                matcher.embed_texts([str(toc) for toc in toc_chunks]),
+                matcher.embed_texts([f"{chunk.subsection}\n{chunk.content[:200]}" for chunk in content_chunks])
+            )
+        except Exception as e:
+            print(f"Warning: Could not compute embeddings, matching every chunk with GPT: {str(e)}")
+            toc_embeddings = content_embeddings = None
+        
+        # 上一批没有改变位置时，后面几批内容块的匹配请求提前发出，窗口按当前的TOC位置预测
+        # 位置改变时作废这些请求并按新位置重新发出，之后只发出当前批，直到位置再次保持不变
+        pending = {}
+        prefetch_depth = 1
+        # 窗口起点 → 渲染好的目录选项
+        window_options = {}
+        
+        # 生成输出文件名
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_filename = f"merged_{timestamp}_{os.path.basename(toc_path)}"
+        output_path = os.path.join(output_dir, output_filename)
+        
+        # 合并结果边匹配边写入临时文件，不在内存中保留整本书，整本书完成后再改成正式文件名
+        # 写出的格式与json.dump(..., indent=2)相同
+        partial_path = output_path + '.part'
+        out = open(partial_path, 'wb')
+        written = 0
+        
+        def schedule(start):
+            end = min(start + MATCH_BATCH_SIZE, len(content_chunks))
+            toc_window = get_toc_window(toc_chunks, current_toc_index)
+            # 同一个窗口的选项文字只渲染一次
+            window_start = toc_index_map[id(toc_window[0])]
+            toc_options_str = window_options.get(window_start)
+            if toc_options_str is None:
+                toc_options_str = window_options[window_start] = render_toc_options(toc_window)
+            if toc_embeddings is not None:
+                # 窗口的取法对向量矩阵同样适用
+                window_embeddings = get_toc_window(toc_embeddings, current_toc_index)
+                batch_embeddings = content_embeddings[start:end]
+            else:
+                window_embeddings = batch_embeddings = None
+            batch_numbered = [numbered_toc(number, window_start) if number else None for number in chunk_numbers[start:end]]
+            task = asyncio.create_task(
+                matcher.match_batch(content_chunks[start:end], toc_window, window_embeddings, batch_embeddings, 
+                                    batch_numbered, toc_options_str)
+            )
+            pending[start] = (task, toc_window, batch_numbered)
+        
+        try:
+            i = 0
+            # 每次处理从第i个内容块开始的一批
+            while i < len(content_chunks):
+                for start in range(i, min(i + prefetch_depth * MATCH_BATCH_SIZE, len(content_chunks)), MATCH_BATCH_SIZE):
+                    if start not in pending:
+                        schedule(start)
                 
-                # 更新当前TOC索引
+                task, toc_window, batch_numbered = pending.pop(i)
+                batch_size = min(MATCH_BATCH_SIZE, len(content_chunks) - i)
                 try:
-                    matched_index = toc_chunks.index(matched_toc)
-                    current_toc_index = matched_index
-                except ValueError as e:
-                    print(f"Warning: Could not find matched TOC in chunks: {str(e)}")
-                    continue
-                
-                # 创建合并后的数据结构
-                merged_chunk = {
-                    "Chapter": matched_toc.chapter,
-                    "Section": matched_toc.section,
-                    "Subsection": content_chunk.subsection,
-                    "Content": content_chunk.content
-                }
-                merged_results.append(merged_chunk)
+                    # 使用 GPT 匹配最合适的 TOC 条目（请求的窗口与当前位置一致）
+                    matched_tocs = await task
+                    if not matched_tocs:
+                        raise ValueError("No matching TOC entries returned from GPT")
+                    
+                    # 后面的块匹配到窗口最后一个条目时，实际位置可能已经超出窗口，从这个块开始按新位置重新匹配
+                    # 按编号直接定位到窗口之外的块采用后，同样从下一个块开始按新位置重新匹配
+                    window_first = toc_index_map[id(toc_window[0])]
+                    window_last = toc_index_map[id(toc_window[-1])]
+                    accepted = len(matched_tocs)
+                    for k, matched_toc in enumerate(matched_tocs):
+                        if not window_first <= toc_index_map[id(matched_toc)] <= window_last:
+                            accepted = k + 1
+                            break
+                        if k >= 1 and matched_toc is toc_window[-1] and toc_window[-1] is not toc_chunks[-1]:
+                            accepted = k
+                            break
+                    
+                    for content_chunk, matched_toc in zip(content_chunks[i:i + accepted], matched_tocs):
+                        # 创建合并后的数据结构
+                        merged_chunk = {
+                            "Chapter": matched_toc.chapter,
+                            "Section": matched_toc.section,
+                            "Subsection": content_chunk.subsection,
+                            "Content": content_chunk.content
+                        }
+                        out.write((b',\n  ' if written else b'[\n  ') + dumps_json(merged_chunk).replace(b'\n', b'\n  '))
+                        written += 1
+                    
+                    numbered_count += sum(toc is not None for toc in batch_numbered[:accepted])
+                    # 更新当前TOC索引
+                    matched_index = toc_index_map[id(matched_tocs[accepted - 1])]
+                except Exception as chunk_error:
+                    print(f"Error processing chunks {i}-{i + batch_size - 1}: {str(chunk_error)}")
+                    accepted = batch_size
+                    matched_index = current_toc_index
                 
-            except Exception as chunk_error:
-                print(f"Error processing chunk {i}: {str(chunk_error)}")
-                continue
+                i += accepted
+                # 每处理完PROGRESS_INTERVAL个内容块输出一次进度
+                if i // PROGRESS_INTERVAL > (i - accepted) // PROGRESS_INTERVAL or i == len(content_chunks):
+                    print(f"{os.path.basename(content_path)}: {i}/{len(content_chunks)} chunks")
+                if matched_index != current_toc_index or accepted < batch_size:
+                    current_toc_index = matched_index
+                    # 已发出的请求用的是旧位置的窗口或旧的分批，全部作废后重新发出
+                    for task, _, _ in pending.values():
+                        task.cancel()
+                    pending.clear()
+                    prefetch_depth = 1
+                else:
+                    prefetch_depth = PREFETCH_DEPTH
             
-            # 添加小延迟以避免API限制
-            await asyncio.sleep(0.1)
+            out.write(b'\n]' if written else b'[]')
+        finally:
+            # 出错退出时取消还没完成的预取请求
+            for task, _, _ in pending.values():
+                task.cancel()
+            out.close()
         
-        if not merged_results:
+        if not written:
+            os.remove(partial_path)
             raise ValueError("No results were successfully merged")
-            
-        # 生成输出文件名
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"merged_{timestamp}_{os.path.basename(toc_path)}"
-        output_path = os.path.join(output_dir, output_filename)
         
         # 保存结果
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(merged_results, f, ensure_ascii=False, indent=2)
+        os.replace(partial_path, output_path)
         
         elapsed_time = time.time() - start_time
-        print(f"Completed {os.path.basename(toc_path)} in {elapsed_time:.2f} seconds")
+        print(f"Completed {os.path.basename(toc_path)} in {elapsed_time:.2f} seconds "
+              f"({numbered_count}/{len(content_chunks)} chunks matched by section number)")
         
         return output_path
         
@@ -296,18 +635,42 @@ async def process_all_books(toc_dir: str, content_dir: str, output_dir: str):
         # 创建信号量限制并发数
         semaphore = asyncio.Semaphore(20)
         
-        async def process_with_semaphore(toc_path, content_path):
-            async with semaphore:
-                return await process_single_book(toc_path, content_path, output_dir)
+        # 所有书共用一个响应缓存
+        response_cache = ResponseCache(os.path.join(output_dir, RESPONSE_CACHE_FILE))
+        # 所有书共用一个限流器，按总的请求速率排队，信号量只限制同时打开的书的数量
+        rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
         
-        # 创建所有书籍的任务
-        tasks = []
-        for toc_path, content_path in file_pairs:
-            task = process_with_semaphore(toc_path, content_path)
-            tasks.append(task)
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY not found in environment variables")
         
-        # 并行执行所有任务
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # 所有书共用一个客户端和连接池，不再每本书各建一个；安装了h2时用HTTP/2在少量连接上并发请求
+        http_client = httpx.AsyncClient(http2=h2 is not None, limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ))
+        async with AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0) as client:
+            # 所有书共用一个 matcher，日志只设置一次
+            matcher = ContentMatcher(api_key, response_cache, client, rate_limiter)
+            
+            # 进度条只按书更新，每本书内部的进度定期输出一行
+            with tqdm(total=total_files, desc="Books", unit="book") as pbar:
+                async def process_with_semaphore(toc_path, content_path):
+                    async with semaphore:
+                        try:
+                            return await process_single_book(toc_path, content_path, output_dir, matcher)
+                        finally:
+                            pbar.update(1)
+                
+                # 创建所有书籍的任务
+                tasks = []
+                for toc_path, content_path in file_pairs:
+                    task = process_with_semaphore(toc_path, content_path)
+                    tasks.append(task)
+                
+                # 并行执行所有任务
+                results = await asyncio.gather(*tasks, return_exceptions=True)
         
         # 统计处理结果并输出详细信息
         successful = 0
@@ -337,19 +700,15 @@ def get_matching_files(toc_dir: str, content_dir: str) -> List[tuple]:
     获取匹配的TOC和content文件对
     返回格式: [(toc_path, content_path), ...]
     """
-    toc_files = {os.path.splitext(f)[0]: os.path.join(toc_dir, f) 
-                 for f in os.listdir(toc_dir) 
-                 if f.endswith('.json')}
-    
-    content_files = {os.path.splitext(f)[0]: os.path.join(content_dir, f) 
-                    for f in os.listdir(content_dir) 
-                    if f.endswith('.json')}
-    
-    # 找到共同的文件名（不包含扩展名）
-    common_names = set(toc_files.keys()) & set(content_files.keys())
+    # 只为TOC目录建立 文件名（不包含扩展名）→ 路径 的字典，扫描content目录时直接查找共同的文件名
+    with os.scandir(toc_dir) as entries:
+        toc_files = {entry.name[:-5]: entry.path for entry in entries 
+                     if entry.name.endswith('.json') and entry.is_file()}
     
     # 创建匹配的文件对
-    file_pairs = [(toc_files[name], content_files[name]) for name in common_names]
+    with os.scandir(content_dir) as entries:
+        file_pairs = [(toc_files[entry.name[:-5]], entry.path) for entry in entries 
+                      if entry.name.endswith('.json') and entry.name[:-5] in toc_files and entry.is_file()]
     
     return file_pairs
 
@@ -18,10 +18,11 @@
 4. 在验证和调整时使用当段落的目录子集
 """
 import json
+import re
 from typing import List, Dict, Optional
 import sys
 import os
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 from dotenv import load_dotenv
 import asyncio
 import logging
@@ -29,6 +30,69 @@ from datetime import datetime
 import argparse
 from tqdm import tqdm
 import time
+import httpx
+import hashlib
+import random
+import sqlite3
+from difflib import SequenceMatcher
+
+try:
+    import orjson
+    loads_json = orjson.loads
+    
+    def dumps_json(obj) -> bytes:
+        """以2空格缩进序列化为UTF-8字节"""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:  # 未安装 orjson 时退回标准库 json，json.loads 同样可以直接解析UTF-8字节
+    loads_json = json.loads
+    
+    def dumps_json(obj) -> bytes:
+        """以2空格缩进序列化为UTF-8字节"""
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # 未安装 rapidfuzz 时直接用 SequenceMatcher 的快速上界筛选
+    fuzz = process = None
+
+try:
+    import tiktoken
+except ImportError:  # 未安装 tiktoken 时不限制模型输出的token
+    tiktoken = None
+
+# 缓存API响应的SQLite文件名，保存在输出目录中
+RESPONSE_CACHE_FILE = 'response_cache.sqlite3'
+
+class ResponseCache:
+    """
+    按(模型, 参数, 消息)的SHA-256哈希把API响应缓存在SQLite文件中
+    重新运行或中途失败后重跑时，已经匹配过的批次直接返回保存的结果，不再调用API
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT)')
+        self.conn.commit()
+    
+    @staticmethod
+    def make_key(model, temperature, messages):
+        """
+        根据模型、温度和消息列表生成缓存键
+        消息中的连续空白先合并成一个空格，只有换行、缩进不同的重复分段也能命中缓存
+        """
+        normalized_messages = '|'.join(
+            f"{message['role']}:{' '.join(message['content'].split())}" for message in messages
+        )
+        return hashlib.sha256(f"{model}|{temperature}|{normalized_messages}".encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """查询缓存，未命中时返回None"""
+        row = self.conn.execute('SELECT response FROM cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key, response):
+        """保存一条响应，相同的键已存在时保留原有结果"""
+        self.conn.execute('INSERT OR IGNORE INTO cache (key, response) VALUES (?, ?)', (key, response))
+        self.conn.commit()
 
 class TocChunk:
     def __init__(self, chapter: str, section: str):
@@ -58,8 +122,8 @@ class ContentChunk:
         }
 
 def load_toc(file_path: str) -> List[TocChunk]:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with open(file_path, 'rb') as f:
+        data = loads_json(f.read())
         print(f"TOC data type: {type(data)}")
         
         # 检查数据结构
@@ -80,8 +144,8 @@ def load_toc(file_path: str) -> List[TocChunk]:
         return chunks
 
 def load_content(file_path: str) -> List[ContentChunk]:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with open(file_path, 'rb') as f:
+        data = loads_json(f.read())
         print(f"Content data type: {type(data)}")
         
         # 检查数据结构并统一处理为列表
@@ -106,19 +170,114 @@ def load_content(file_path: str) -> List[ContentChunk]:
         print(f"Loaded {len(chunks)} content chunks")
         return chunks
 
+# 每个匹配请求包含的相邻内容块数量，目录选项每批只发送一次
+MATCH_BATCH_SIZE = 10
+# 每本书同时处理的段落数上限
+MAX_CONCURRENT_SEGMENTS = 20
+
+# 匹配目录使用的模型
+MATCH_MODEL = "gpt-4o-mini"
+# 匹配目录的固定说明，每个请求都相同
+MATCH_SYSTEM_PROMPT = """You are master in biology. Please select the most appropriate title from the table of contents for each of the given text blocks.
+Return the option numbers for the blocks in order, separated by commas (e.g., 1,2,3). Do not provide any explanations.
+
+Please note:
+- Please select the section and chapter combination that best summarizes the subsection and content as the output.
+- The text blocks are sequential. The chapter and section number of each block must be greater than or equal to that of its previous block. For example, 3,3,4 is allowed but 3,2,4 is not allowed.
+- Matches with high-information titles (such as 'cell division') should be prioritized over matches with general terms (such as 'introduction', 'summary', etc.).
+- Ensure that the chapter and section numbers of consecutive blocks are close. For instance, 0,4,6 is not allowed, but 1,2,3 is good.
+- If a text block can match multiple sections, select the second result among the choices.
+- If you think a text block does not match any section, select the second result among the choices.
+"""
+
+# 回复中的序号
+INDEX_PATTERN = re.compile(r'\d+')
+
+def build_index_logit_bias(model: str) -> Optional[Dict[str, int]]:
+    """
+    把数字和逗号对应的token的logit调到最大，模型只能输出以逗号分隔的序号
+    未安装 tiktoken 时返回None
+    """
+    if tiktoken is None:
+        return None
+    encoding = tiktoken.encoding_for_model(model)
+    return {str(token): 100 for char in '0123456789,' for token in encoding.encode(char)}
+
+def toc_window_start(current_index: int) -> int:
+    """TOC窗口在toc_chunks中的起始位置"""
+    return max(0, current_index - 2)  # 从当前位置前一个开始
+
 ### 这个地方实际调节了误差的范围，只有前后n个标题会被输送给gpt。
 def get_toc_window(toc_chunks: List[TocChunk], current_index: int, window_size: int = 7) -> List[TocChunk]:
     """
     Get a window of TOC chunks centered around the current index.
     Window includes [current_index-1, current_index, current_index+1, ..., current_index+4]
     """
-    start_idx = max(0, current_index - 2)  # 从当前位置前一个开始
+    start_idx = toc_window_start(current_index)
     end_idx = min(len(toc_chunks), start_idx + window_size)  # 向后取6个位置
     return toc_chunks[start_idx:end_idx]
 
+# 所有书共用的每分钟请求数上限
+MAX_REQUESTS_PER_MINUTE = 500
+
+# 所有书共用的HTTP连接池大小
+HTTP_MAX_CONNECTIONS = 100
+
+# API调用遇到限流、连接错误、超时或服务端错误时的最大尝试次数
+# 创建客户端时关闭SDK自带的重试（max_retries=0），只由这里的重试和退避处理，避免两层重试叠加
+MAX_API_ATTEMPTS = 6
+# 指数退避的初始等待时间（秒），每次重试翻倍
+RETRY_BASE_DELAY = 1
+# 单次等待时间的上限（秒）
+RETRY_MAX_DELAY = 30
+# 可以重试的API错误
+RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+def retry_delay(error, attempt):
+    """
+    计算第attempt次失败后的等待时间
+    限流响应带有retry-after时按它等待，否则指数退避并加上随机抖动，避免并发请求同时重试
+    """
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, RETRY_BASE_DELAY)
+
+class RateLimiter:
+    """
+    令牌桶限流：桶中最多有max_rate个令牌，按每time_period秒max_rate个的速度补充，每次请求消耗一个
+    没有超出额度时请求直接发出，额度用完后才按速度排队
+    """
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.refill_rate = max_rate / time_period
+        self.tokens = max_rate
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """取得一个令牌，令牌不足时等待补充"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.max_rate, self.tokens + (now - self.last_refill) * self.refill_rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.refill_rate)
+
 class ContentMatcher:
-    def __init__(self, api_key):
-        self.client = AsyncOpenAI(api_key=api_key)
+    def __init__(self, api_key, response_cache=None, client=None, rate_limiter=None):
+        # 优先使用传入的共享客户端，复用已建立的连接
+        self.client = client if client is not None else AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        self.logit_bias = build_index_logit_bias(MATCH_MODEL)
         self.setup_logging()
     
     def setup_logging(self):
@@ -140,73 +299,94 @@ class ContentMatcher:
         )
         self.logger = logging.getLogger(__name__)
 
-    async def match_content_to_toc(self, content: ContentChunk, content_list: List[ContentChunk], current_index: int, toc_options: List[TocChunk]) -> List[TocChunk]:
+    async def call_api(self, **params):
+        """发出一次API请求，先从限流器取得令牌，限流和临时错误按指数退避重试"""
+        for attempt in range(MAX_API_ATTEMPTS):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            try:
+                return await self.client.chat.completions.create(**params)
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    raise
+                delay = retry_delay(e, attempt)
+                self.logger.warning(f"API调用失败，{delay:.1f}秒后重试: {str(e)}")
+                await asyncio.sleep(delay)
+
+    async def match_content_to_toc(self, chunks: List[ContentChunk], toc_options: List[TocChunk]) -> List[TocChunk]:
         """
-        匹配内容到目录项，使用三个相邻的文本块进行验证
-        返回三个文本块对应的TOC条目列表
+        在一个请求中匹配多个相邻的文本块，目录选项只发送一次
+        返回每个文本块对应的TOC条目列表
         """
-        # 获取相邻的三个文本块，每个块限制300字符
-        chunks = []
-        chunk_texts = []  # 存储文本块的标题和内容
-        
-        # 添加当前块
-        chunks.append(content)
-        chunk_texts.append(f"以下是第一个文本块：\n subsection：{content.subsection}\n内容：{content.content[:300]}")
-        
-        # 添加后一个块（如果存在）
-        if current_index < len(content_list) - 1:
-            chunks.append(content_list[current_index + 1])
-            chunk_texts.append(f"第一块结束，以下是第二个文本块：\n subsection: {content_list[current_index + 1].subsection}\n内容：{content_list[current_index + 1].content[:300]}")
-        
-        # 添加后两个块（如果存在）
-        if current_index < len(content_list) - 2:
-            chunks.append(content_list[current_index + 2])
-            chunk_texts.append(f"第二块结束，以下是第三个文本块：\n subsection: {content_list[current_index + 2].subsection}\n内容：{content_list[current_index + 2].content[:300]}")
+        # 每个块按顺序编号，内容限制300字符
+        chunk_texts = [f"Text block {k}:\n subsection: {chunk.subsection}\n内容：{chunk.content[:300]}" 
+                       for k, chunk in enumerate(chunks, 1)]
+        blocks_str = "\n".join(chunk_texts)
         
         # 构建TOC选项字符串
         toc_options_str = "\n".join([f"{i}. {toc.chapter} - {toc.section}" 
                                    for i, toc in enumerate(toc_options, 1)])
         
-        prompt = f"""You are master in biology. Please select the most appropriate title from the table of contents for the following three text blocks.
-Return the option numbers for the three blocks in order, separated by commas (e.g., 1,2,3). Do not provide any explanations.
-
-Please note:
-- Please select the section and chapter combination that best summarizes the subsection and content as the output.
-- The three text blocks are sequential. The chapter and section number of each block must be greater than or equal to that of its previous block. For example, 3,3,4 is allowed but 3,2,4 is not allowed.
-- Matches with high-information titles (such as 'cell division') should be prioritized over matches with general terms (such as 'introduction', 'summary', etc.).
-- Ensure that the chapter and section numbers of consecutive blocks are close. For instance, 0,4,6 is not allowed, but 1,2,3 is good.
-- If a text block can match multiple sections, select the second result among the choices.
-- If you think a text block does not match any section, select the second result among the choices.
-
-Table of Contents Options:
+        # 固定的说明放在前面的system消息中，只有目录选项和文本块随请求变化
+        messages = [
+            {"role": "system", "content": MATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": f"""Table of Contents Options:
 {toc_options_str}
 
-Text Blocks:
-{' '.join(chunk_texts)}
-
-Please return the corresponding option numbers for each block, separated by commas:"""
+Text Blocks ({len(chunks)} in total):
+{blocks_str}
 
+Please return the corresponding option numbers for each of the {len(chunks)} blocks, separated by commas:"""}
+        ]
 
         try:
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                max_tokens=15,
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
+            model = MATCH_MODEL
+            temperature = 0.3
+            # 相同的文本块和目录选项优先从缓存返回
+            cache_key = None
+            reply = None
+            if self.response_cache is not None:
+                cache_key = ResponseCache.make_key(model, temperature, messages)
+                reply = self.response_cache.get(cache_key)
+            if reply is None:
+                params = {}
+                if self.logit_bias is not None:
+                    # 只能输出数字和逗号，窗口内的选项都是一位数，K个序号加K-1个逗号正好是回复的全部token
+                    params['logit_bias'] = self.logit_bias
+                    params['max_tokens'] = 2 * len(chunks) - 1
+                else:
+                    # 每个序号和逗号约占几个token
+                    params['max_tokens'] = max(15, 4 * len(chunks))
+                response = await self.call_api(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=1.0,
+                    frequency_penalty=0.0,
+                    presence_penalty=0.0,
+                    **params
+                )
+                reply = response.choices[0].message.content
+                if cache_key is not None:
+                    self.response_cache.set(cache_key, reply)
             
             # 处理返回的序号列表
             try:
-                indices = [int(idx.strip()) - 1 for idx in response.choices[0].message.content.strip().split(',')]
+                indices = [int(idx) - 1 for idx in INDEX_PATTERN.findall(reply)]
+                if len(indices) != len(chunks):
+                    self.logger.error(f"GPT返回了{len(indices)}个序号，应为{len(chunks)}个")
+                    return [toc_options[0]] * len(chunks)
                 results = []
+                previous = 0
                 for idx in indices:
-                    if 0 <= idx < len(toc_options):
-                        results.append(toc_options[idx])
-                    else:
-                        results.append(toc_options[0])  # 对于无效索引使用第一个选项
+                    if not 0 <= idx < len(toc_options):
+                        idx = 0  # 对于无效索引使用第一个选项
+                    if idx < previous:
+                        # 文本块按顺序排列，序号不能比前一个块小
+                        self.logger.warning(f"GPT返回的序号不是递增的: {indices}")
+                        idx = previous
+                    results.append(toc_options[idx])
+                    previous = idx
                 return results
             except ValueError:
                 self.logger.error("GPT返回了无效的序号格式")
@@ -216,7 +396,8 @@ Please return the corresponding option numbers for each block, separated by comm
             self.logger.error(f"API调用失败: {str(e)}")
             return [toc_options[0]] * len(chunks)  # 返回相同数量的默认选项
 
-async def process_single_book(toc_path: str, content_path: str, output_dir: str):
+async def process_single_book(toc_path: str, content_path: str, output_dir: str, 
+                              matcher: Optional[ContentMatcher] = None):
     """
     处理单本书的合并任务
     """
@@ -224,21 +405,24 @@ async def process_single_book(toc_path: str, content_path: str, output_dir: str)
         print(f"\nProcessing book: {os.path.basename(toc_path)}")
         start_time = time.time()
         
-        # 加载文档
-        toc_chunks = load_toc(toc_path)
+        # 加载文档，目录和内容两个文件在线程中同时读取
+        toc_chunks, content_chunks = await asyncio.gather(
+            asyncio.to_thread(load_toc, toc_path),
+            asyncio.to_thread(load_content, content_path)
+        )
         if not toc_chunks:
             raise ValueError(f"No TOC chunks loaded from {toc_path}")
             
-        content_chunks = load_content(content_path)
         if not content_chunks:
             raise ValueError(f"No content chunks loaded from {content_path}")
         
-        # 创建 matcher 实例
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY not found in environment variables")
+        # 没有传入共享的 matcher 时才单独创建
+        if matcher is None:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OPENAI_API_KEY not found in environment variables")
             
-        matcher = ContentMatcher(api_key)
+            matcher = ContentMatcher(api_key)
         
         # 修改为每次处理一个chunk
         merged_results = await process_book_in_segments(
@@ -246,9 +430,6 @@ async def process_single_book(toc_path: str, content_path: str, output_dir: str)
             content_chunks,
             matcher
         )
-             
-            # 添加小延迟以避免API限制
-        await asyncio.sleep(0.05)
         
         if not merged_results:
             raise ValueError("No results were successfully merged")
@@ -259,8 +440,8 @@ async def process_single_book(toc_path: str, content_path: str, output_dir: str)
         output_path = os.path.join(output_dir, output_filename)
         
         # 保存结果
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(merged_results, f, ensure_ascii=False, indent=2)
+        with open(output_path, "wb") as f:
+            f.write(dumps_json(merged_results))
         
         elapsed_time = time.time() - start_time
         print(f"Completed {os.path.basename(toc_path)} in {elapsed_time:.2f} seconds")
@@ -291,18 +472,36 @@ async def process_all_books(toc_dir: str, content_dir: str, output_dir: str):
         # 创建信号量限制并发数
         semaphore = asyncio.Semaphore(20)
         
-        async def process_with_semaphore(toc_path, content_path):
-            async with semaphore:
-                return await process_single_book(toc_path, content_path, output_dir)
+        # 所有书共用一个响应缓存
+        response_cache = ResponseCache(os.path.join(output_dir, RESPONSE_CACHE_FILE))
+        # 所有书共用一个限流器，按API的总额度发送请求
+        rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
         
-        # 创建所有书籍的任务
-        tasks = []
-        for toc_path, content_path in file_pairs:
-            task = process_with_semaphore(toc_path, content_path)
-            tasks.append(task)
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY not found in environment variables")
         
-        # 并行执行所有任务
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # 所有书共用一个客户端和连接池，不再每本书各建一个
+        http_client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS
+        ))
+        async with AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0) as client:
+            # 所有书共用一个 matcher，日志只设置一次
+            matcher = ContentMatcher(api_key, response_cache, client, rate_limiter)
+            
+            async def process_with_semaphore(toc_path, content_path):
+                async with semaphore:
+                    return await process_single_book(toc_path, content_path, output_dir, matcher)
+            
+            # 创建所有书籍的任务
+            tasks = []
+            for toc_path, content_path in file_pairs:
+                task = process_with_semaphore(toc_path, content_path)
+                tasks.append(task)
+            
+            # 并行执行所有任务
+            results = await asyncio.gather(*tasks, return_exceptions=True)
         
         # 统计处理结果并输出详细信息
         successful = 0
@@ -332,19 +531,15 @@ def get_matching_files(toc_dir: str, content_dir: str) -> List[tuple]:
     获取匹配的TOC和content文件对
     返回格式: [(toc_path, content_path), ...]
     """
-    toc_files = {os.path.splitext(f)[0]: os.path.join(toc_dir, f) 
-                 for f in os.listdir(toc_dir) 
-                 if f.endswith('.json')}
-    
-    content_files = {os.path.splitext(f)[0]: os.path.join(content_dir, f) 
-                    for f in os.listdir(content_dir) 
-                    if f.endswith('.json')}
-    
-    # 找到共同的文件名（不包含扩展名）
-    common_names = set(toc_files.keys()) & set(content_files.keys())
+    # 只为TOC目录建立 文件名（不包含扩展名）→ 路径 的字典，扫描content目录时直接查找共同的文件名
+    with os.scandir(toc_dir) as entries:
+        toc_files = {entry.name[:-5]: entry.path for entry in entries 
+                     if entry.name.endswith('.json') and entry.is_file()}
     
     # 创建匹配的文件对
-    file_pairs = [(toc_files[name], content_files[name]) for name in common_names]
+    with os.scandir(content_dir) as entries:
+        file_pairs = [(toc_files[entry.name[:-5]], entry.path) for entry in entries 
+                      if entry.name.endswith('.json') and entry.name[:-5] in toc_files and entry.is_file()]
     
     return file_pairs
 
@@ -354,34 +549,54 @@ def find_alignment_points(toc_chunks: List[TocChunk], content_chunks: List[Conte
     返回content_chunks中的索引位置列表
     排除只有单个单词的标题匹配，这些很有可能是introduction或者summery之类的广义词
     """
+    # 检查标题是否只有一个单词，只保留多个单词的标题，统一转为小写
+    toc_sections = [toc.section.lower() for toc in toc_chunks if len(toc.section.split()) > 1]
+    exact_sections = set(toc_sections)
+    
     alignment_points = []
     
     for i, content in enumerate(content_chunks):
-        for toc in toc_chunks:
-            # 检查标题是否只有一个单词
-            if len(toc.section.split()) <= 1:
-                continue
-                
-            # 使用相似度比较而不是完全匹配
-            if similar_text(toc.section, content.subsection) > 0.9:  # 80%相似度
-                alignment_points.append(i)
-                break
+        subsection = content.subsection.lower()
+        # 完全相同的标题直接查集合，不必逐个比较
+        if subsection in exact_sections or find_similar_section(subsection, toc_sections, 0.9) is not None:
+            alignment_points.append(i)
                 
     return alignment_points
 
+def find_similar_section(subsection: str, sections: List[str], threshold: float, start: int = 0) -> Optional[int]:
+    """
+    从sections的start位置开始，找出第一个与subsection的相似度（同similar_text，输入均已转为小写）超过threshold的标题
+    返回它在sections中的位置，没有时返回None
+    先筛出可能超过threshold的候选，只对候选计算SequenceMatcher的相似度
+    """
+    if process is not None:
+        # rapidfuzz按最长公共子序列计算的相似度不低于SequenceMatcher的结果，先用它批量筛出候选
+        candidates = sorted(match[2] + start for match in process.extract(subsection, sections[start:], scorer=fuzz.ratio, 
+                                                                          score_cutoff=threshold * 100, limit=None))
+    else:
+        candidates = range(start, len(sections))
+    
+    # subsection作为第二个序列只预处理一次；real_quick_ratio和quick_ratio是ratio的上界，大部分候选在这两步就被排除
+    matcher = SequenceMatcher(None)
+    matcher.set_seq2(subsection)
+    for index in candidates:
+        matcher.set_seq1(sections[index])
+        if matcher.real_quick_ratio() > threshold and matcher.quick_ratio() > threshold and matcher.ratio() > threshold:
+            return index
+    return None
+
 def similar_text(text1: str, text2: str) -> float:
     """
     计算两个文本的相似度（可以使用Levenshtein距离或其他算法）
     返回0-1之间的相似度值
     """
-    from difflib import SequenceMatcher
     return SequenceMatcher(None, text1.lower(), text2.lower()).ratio()
 
 async def process_book_in_segments(toc_chunks: List[TocChunk], 
                                  content_chunks: List[ContentChunk], 
                                  matcher: ContentMatcher) -> List[dict]:
     """
-    将书本分段处理，每次发送三个chunk但只更新第一个
+    将书本分段处理，每次把一批相邻的chunk放在一个请求中匹配
     """
     # 首先找出对齐点
     alignment_points = find_alignment_points(toc_chunks, content_chunks)
@@ -399,66 +614,84 @@ async def process_book_in_segments(toc_chunks: List[TocChunk],
     toc_segments = []
     start = 0
     current_toc_start = 0
+    # 所有目录标题只转一次小写
+    toc_sections = [toc.section.lower() for toc in toc_chunks]
     
     for point in alignment_points:
         # 找到对应的目录位置
-        for i, toc in enumerate(toc_chunks[current_toc_start:], current_toc_start):
-            if similar_text(toc.section, content_chunks[point].subsection) > 0.8:
-                # 添加内容段落
-                content_segments.append((start, point))
-                # 添加对应的目录段落
-                toc_segments.append(toc_chunks[current_toc_start:i+1])
-                start = point
-                current_toc_start = i
-                break
+        i = find_similar_section(content_chunks[point].subsection.lower(), toc_sections, 0.8, current_toc_start)
+        if i is not None:
+            # 添加内容段落
+            content_segments.append((start, point))
+            # 添加对应的目录段落
+            toc_segments.append(toc_chunks[current_toc_start:i+1])
+            start = point
+            current_toc_start = i
     
     # 添加最后一个段落
     content_segments.append((start, len(content_chunks)))
     toc_segments.append(toc_chunks[current_toc_start:])
     
-    final_results = []  # 创建新的列表存储最终结果
+    # 各段落的目录子集和起始位置互相独立，段落之间并行处理，段落内按顺序逐批匹配
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEGMENTS)
     
-    # 处理每个段落
-    for (start, end), toc_segment in zip(content_segments, toc_segments):
-        segment_content = content_chunks[start:end]
-        current_toc_index = 0  # 在每个段落内重置TOC索引
-        
-        # 每次处理一个chunk，但发送三个chunk给模型
-        for i in range(len(segment_content)):
-            # 获取当前TOC窗口
-            toc_window = get_toc_window(toc_segment, current_toc_index)
-            content_chunk = segment_content[i]
-            
-            # 获取匹配结果（发送三个chunk给模型）
-            matched_tocs = await matcher.match_content_to_toc(
-                content_chunk, 
-                segment_content, 
-                i, 
-                toc_window
-            )
+    async def process_segment(start, end, toc_segment):
+        async with semaphore:
+            segment_content = content_chunks[start:end]
+            segment_results = []
+            current_toc_index = 0  # 在每个段落内重置TOC索引
+            window_index = None
             
-            # 只使用第一个chunk的匹配结果
-            if matched_tocs:
-                matched_toc = matched_tocs[0]  # 只取第一个匹配结果
+            # 每次把从第i个开始的MATCH_BATCH_SIZE个chunk放在一个请求中发送给模型
+            i = 0
+            while i < len(segment_content):
+                # 获取当前TOC窗口，TOC索引没有变化时沿用上一批的窗口
+                if current_toc_index != window_index:
+                    toc_window = get_toc_window(toc_segment, current_toc_index)
+                    window_start = toc_window_start(current_toc_index)
+                    window_index = current_toc_index
+                batch = segment_content[i:i + MATCH_BATCH_SIZE]
                 
-                # 创建新的合并chunk
-                merged_chunk = {
-                    "Chapter": str(matched_toc.chapter),
-                    "Section": str(matched_toc.section),
-                    "Subsection": str(content_chunk.subsection),
-                    "Content": str(content_chunk.content)
-                }
-                final_results.append(merged_chunk)
+                # 获取这一批chunk的匹配结果
+                matched_tocs = await matcher.match_content_to_toc(batch, toc_window)
+                
+                if matched_tocs:
+                    # 后面的块匹配到窗口最后一个条目时，实际位置可能已经超出窗口，从这个块开始按新位置重新匹配
+                    accepted = len(matched_tocs)
+                    if toc_window[-1] is not toc_segment[-1]:
+                        for k in range(1, len(matched_tocs)):
+                            if matched_tocs[k] is toc_window[-1]:
+                                accepted = k
+                                break
+                    
+                    for content_chunk, matched_toc in zip(batch[:accepted], matched_tocs):
+                        # 创建新的合并chunk
+                        merged_chunk = {
+                            "Chapter": str(matched_toc.chapter),
+                            "Section": str(matched_toc.section),
+                            "Subsection": str(content_chunk.subsection),
+                            "Content": str(content_chunk.content)
+                        }
+                        segment_results.append(merged_chunk)
+                    
+                    # 更新TOC索引，匹配结果都来自窗口，只在窗口内查找位置
+                    try:
+                        current_toc_index = window_start + toc_window.index(matched_tocs[accepted - 1])
+                    except ValueError:
+                        pass
+                else:
+                    accepted = len(batch)
                 
-                # 更新TOC索引
-                try:
-                    matched_index = toc_segment.index(matched_toc)
-                    current_toc_index = matched_index
-                except ValueError:
-                    pass
+                i += accepted
             
-            # 添加小延迟以避免API限制
-            await asyncio.sleep(0.05)
+            return segment_results
+
+    # 处理每个段落，结果按段落顺序拼接
+    segment_results = await asyncio.gather(*(
+        process_segment(start, end, toc_segment)
+        for (start, end), toc_segment in zip(content_segments, toc_segments)
+    ))
+    final_results = [merged_chunk for results in segment_results for merged_chunk in results]
     
     return final_results
 
@@ -479,30 +712,14 @@ def adjust_segment_results(last_result: dict,
     return segment_results
 
 def save_json(data, output_file):
+    """写入合并结果，process_book_in_segments生成的字典各字段已经是字符串，直接序列化"""
     try:
-        # 确保数据是可序列化的
-        clean_data = [{
-            "Chapter": str(item.get("Chapter", "")),
-            "Section": str(item.get("Section", "")),
-            "Subsection": str(item.get("Subsection", "")),
-            "Content": str(item.get("Content", ""))
-        } for item in data]
-        
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(clean_data, f, ensure_ascii=False, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(dumps_json(data))
     except Exception as e:
         print(f"Error saving JSON: {str(e)}")
         raise
 
-def remove_circular_refs(data):
-    # 创建一个新的字典来存储处理后的数据
-    if isinstance(data, dict):
-        return {k: remove_circular_refs(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [remove_circular_refs(x) for x in data]
-    else:
-        return data
-
 def main():
     # 确保在开始时加载环境变量
     load_dotenv()
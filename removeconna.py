@@ -1,7 +1,63 @@
 import os
 import json
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import repeat
+
+# 同时处理的文件数，每个文件的工作主要是磁盘读写，用线程重叠等待
+MAX_WORKERS = 32
+
+def fix_json_file(file_path, backup_dir=None):
+    """
+    处理单个JSON文件的末尾格式（模块级函数，便于线程池调用）
+    返回 True 表示文件被修改，False 表示不需要修改或被跳过；出错时抛出异常
+    """
+    filename = os.path.basename(file_path)
+    print(f"处理文件: {filename}")
+    
+    # 创建备份
+    if backup_dir is not None:
+        backup_path = os.path.join(backup_dir, filename)
+        shutil.copy2(file_path, backup_path)
+    
+    # 读取文件内容
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    
+    # 检查文件格式
+    if not content.startswith('['):
+        print(f"警告: 文件 {filename} 不是以 '[' 开始")
+        return False
+    
+    # 如果文件末尾有逗号，删除它并添加换行和方括号
+    if content.endswith(','):
+        # 删除末尾的逗号
+        content = content[:-1].rstrip() + '\n]'
+        
+        # 验证JSON格式
+        try:
+            json.loads(content)
+        except json.JSONDecodeError:
+            print(f"错误: 修改后的 {filename} 不是有效的JSON格式")
+            return False
+        
+        # 写回文件
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        print(f"成功修改: {filename}")
+        return True
+    else:
+        print(f"文件 {filename} 不需要修改")
+        return False
+
+def try_fix_json_file(file_path, backup_dir=None):
+    """调用 fix_json_file，出错时输出错误并返回 None"""
+    try:
+        return fix_json_file(file_path, backup_dir)
+    except Exception as e:
+        print(f"处理文件 {os.path.basename(file_path)} 时出错: {str(e)}")
+        return None
 
 def fix_json_files(directory_path, create_backup=True):
     """
@@ -17,62 +73,25 @@ def fix_json_files(directory_path, create_backup=True):
         return
 
     # 创建备份目录
+    backup_dir = None
     if create_backup:
         backup_dir = os.path.join(directory_path, f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
         os.makedirs(backup_dir, exist_ok=True)
 
     # 获取所有JSON文件
-    json_files = [f for f in os.listdir(directory_path) if f.endswith('.json')]
+    with os.scandir(directory_path) as entries:
+        file_paths = [entry.path for entry in entries if entry.name.endswith('.json') and entry.is_file()]
     
-    modified_count = 0
-    error_count = 0
+    # 各文件相互独立，用线程池并行处理
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(try_fix_json_file, file_paths, repeat(backup_dir)))
     
-    for filename in json_files:
-        file_path = os.path.join(directory_path, filename)
-        print(f"处理文件: {filename}")
-        
-        try:
-            # 创建备份
-            if create_backup:
-                backup_path = os.path.join(backup_dir, filename)
-                shutil.copy2(file_path, backup_path)
-            
-            # 读取文件内容
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-            
-            # 检查文件格式
-            if not content.startswith('['):
-                print(f"警告: 文件 {filename} 不是以 '[' 开始")
-                continue
-            
-            # 如果文件末尾有逗号，删除它并添加换行和方括号
-            if content.endswith(','):
-                # 删除末尾的逗号
-                content = content[:-1].rstrip() + '\n]'
-                
-                # 验证JSON格式
-                try:
-                    json.loads(content)
-                except json.JSONDecodeError:
-                    print(f"错误: 修改后的 {filename} 不是有效的JSON格式")
-                    continue
-                
-                # 写回文件
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(content)
-                print(f"成功修改: {filename}")
-                modified_count += 1
-            else:
-                print(f"文件 {filename} 不需要修改")
-                
-        except Exception as e:
-            print(f"处理文件 {filename} 时出错: {str(e)}")
-            error_count += 1
+    modified_count = sum(1 for result in results if result)
+    error_count = sum(1 for result in results if result is None)
     
     # 输出统计信息
     print("\n处理完成:")
-    print(f"总文件数: {len(json_files)}")
+    print(f"总文件数: {len(file_paths)}")
     print(f"修改文件数: {modified_count}")
     print(f"错误文件数: {error_count}")
     if create_backup:
@@ -81,4 +100,4 @@ def fix_json_files(directory_path, create_backup=True):
 if __name__ == "__main__":
     # 指定要处理的目录路径
     directory = "/home/azureuser/md_processing/github_code/CrossModalRetrieval-RAG/all_books/english_book/test_merge8"  # 替换为你的实际目录路径
-    fix_json_files(directory, create_backup=True)
\ No newline at end of file
+    fix_json_files(directory, create_backup=True)
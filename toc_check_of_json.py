@@ -1,83 +1,137 @@
+import io
 import json
 from deep_translator import GoogleTranslator
-import time
 import os
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime
 
-def process_single_book(json_file: str, folder_path: str, output_file, samples_per_file=5, chunks_per_sample=5):
-    """处理单本书籍"""
+# 同时读取JSON文件的线程数
+READ_WORKERS = 16
+# 同时发出的翻译请求数
+TRANSLATE_WORKERS = 8
+# 缓存的译文条数上限
+TRANSLATION_CACHE_SIZE = 50000
+# 输出文件的写缓冲区大小（字节）
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+def load_toc_entries(file_path: str):
+    """读取JSON文件，返回去重排序后的(Chapter, Section, Subsection)目录列表"""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        data = json.loads(file.read())
+    
+    # 创建目录列表
+    toc = []
+    for item in data:
+        if all(key in item for key in ['Chapter', 'Section', 'Subsection']):
+            toc.append((item['Chapter'], item['Section'], item['Subsection']))
+    
+    # 排序目录
+    return sorted(list(set(toc)))
+
+@lru_cache(maxsize=TRANSLATION_CACHE_SIZE)
+def translate_text(text: str) -> str:
+    """
+    翻译单条文本，GoogleTranslator 在请求之间保存参数，不能在线程间共用，每次新建一个
+    不同的书有大量相同的标题，译文按原文缓存，出错时不缓存
+    """
+    return GoogleTranslator(source='en', target='zh-CN').translate(text)
+
+def translate_texts(texts, executor):
+    """在线程池中并行翻译所有文本，返回 原文 -> 译文 的字典，翻译失败的文本对应抛出的异常"""
+    futures = {text: executor.submit(translate_text, text) for text in texts}
+    translations = {}
+    for text, future in futures.items():
+        try:
+            translations[text] = future.result()
+        except Exception as e:
+            translations[text] = e
+    return translations
+
+def get_translation(translations, text: str) -> str:
+    """取出文本的译文，空文本返回空字符串，翻译失败时重新抛出异常"""
+    if not text:
+        return ""
+    translation = translations[text]
+    if isinstance(translation, Exception):
+        raise translation
+    return translation
+
+def process_single_book(json_file: str, toc_future, translate_executor, 
+                        samples_per_file=5, chunks_per_sample=5) -> str:
+    """
+    处理单本书籍，toc_future是线程池中读取该文件目录列表（load_toc_entries）的任务
+    所有采样条目的文本先去重后一起在translate_executor中并行翻译，再按顺序写入
+    整本书的结果先写入内存缓冲区，返回生成的markdown文本，由调用者一次写入输出文件
+    """
+    buf = io.StringIO()
     try:
-        file_path = os.path.join(folder_path, json_file)
-        output_file.write(f"\n# {json_file}\n\n")
-        
-        # 读取JSON文件
-        with open(file_path, 'r', encoding='utf-8') as file:
-            data = json.loads(file.read())
+        buf.write(f"\n# {json_file}\n\n")
         
-        # 创建目录列表
-        toc = []
-        for item in data:
-            if all(key in item for key in ['Chapter', 'Section', 'Subsection']):
-                toc.append((item['Chapter'], item['Section'], item['Subsection']))
-        
-        # 排序目录
-        toc = sorted(list(set(toc)))
+        # 等待JSON文件读取完成
+        toc = toc_future.result()
         
         if len(toc) == 0:
-            output_file.write("该文件没有有效的目录结构\n\n")
-            return
-        
-        translator = GoogleTranslator(source='en', target='zh-CN')
+            buf.write("该文件没有有效的目录结构\n\n")
+            return buf.getvalue()
         
         # 随机选择起始点
         max_start = max(0, len(toc) - chunks_per_sample)
         start_points = sorted(random.sample(range(max_start + 1), min(samples_per_file, max_start + 1)))
         
+        # 一次翻译所有采样条目中不重复的章节标题
+        texts = {text 
+                 for start_point in start_points 
+                 for entry in toc[start_point:start_point + chunks_per_sample] 
+                 for text in entry if text}
+        translations = translate_texts(texts, translate_executor)
+        
         # 处理每个采样点
         for sample_idx, start_point in enumerate(start_points, 1):
-            output_file.write(f"## 采样 {sample_idx}\n")
-            output_file.write(f"起始索引: {start_point}\n\n")
+            buf.write(f"## 采样 {sample_idx}\n")
+            buf.write(f"起始索引: {start_point}\n\n")
             
             # 处理这个采样点后的chunks_per_sample个条目
             end_point = min(start_point + chunks_per_sample, len(toc))
             for i in range(start_point, end_point):
                 chapter, section, subsection = toc[i]
                 try:
-                    output_file.write(f"### 条目 {i-start_point+1}\n")
+                    buf.write(f"### 条目 {i-start_point+1}\n")
                     
                     # 写入原文
-                    output_file.write("原文：\n")
-                    output_file.write(f"{chapter}\n")
+                    buf.write("原文：\n")
+                    buf.write(f"{chapter}\n")
                     if section:
-                        output_file.write(f"  └─{section}\n")
+                        buf.write(f"  └─{section}\n")
                     if subsection:
-                        output_file.write(f"    └─{subsection}\n")
-                    output_file.write("\n")
+                        buf.write(f"    └─{subsection}\n")
+                    buf.write("\n")
                     
-                    # 翻译并写入译文
-                    chapter_zh = translator.translate(chapter) if chapter else ""
-                    section_zh = translator.translate(section) if section else ""
-                    subsection_zh = translator.translate(subsection) if subsection else ""
+                    # 写入译文
+                    chapter_zh = get_translation(translations, chapter)
+                    section_zh = get_translation(translations, section)
+                    subsection_zh = get_translation(translations, subsection)
                     
-                    output_file.write("翻译：\n")
-                    output_file.write(f"{chapter_zh}\n")
+                    buf.write("翻译：\n")
+                    buf.write(f"{chapter_zh}\n")
                     if section_zh:
-                        output_file.write(f"  └─{section_zh}\n")
+                        buf.write(f"  └─{section_zh}\n")
                     if subsection_zh:
-                        output_file.write(f"    └─{subsection_zh}\n")
-                    output_file.write("\n")
-                    
-                    # 延迟以避免触发API限制
-                    time.sleep(0.1)
+                        buf.write(f"    └─{subsection_zh}\n")
+                    buf.write("\n")
                     
                 except Exception as e:
                     print(f"翻译出错: {e}")
             
-            output_file.write("---\n\n")  # 添加分隔线
+            buf.write("---\n\n")  # 添加分隔线
                     
     except Exception as e:
         print(f"处理文件 {json_file} 时发生错误: {e}")
+    
+    return buf.getvalue()
 
 def extract_and_translate_toc_samples(folder_path: str, output_md_path: str, samples_per_file=5, chunks_per_sample=5):
     """主函数 - 同步处理所有书籍"""
@@ -89,14 +143,29 @@ def extract_and_translate_toc_samples(folder_path: str, output_md_path: str, sam
             print("错误：未找到JSON文件！")
             return
             
-        with open(output_md_path, 'w', encoding='utf-8') as output_file:
+        with open(output_md_path, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE) as output_file:
             # 写入头部信息
             output_file.write(f"# 目录翻译采样结果\n\n")
             output_file.write(f"生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
             
-            # 顺序处理每个文件
-            for json_file in json_files:
-                process_single_book(json_file, folder_path, output_file, samples_per_file, chunks_per_sample)
+            # 文件的读取和解析提前提交到线程池，翻译前面的书时后面的文件已经在读取
+            # 最多提前读取READ_WORKERS个文件，处理完一本再提交下一本，已处理的目录不再留在内存中
+            with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor, \
+                    ThreadPoolExecutor(max_workers=TRANSLATE_WORKERS) as translate_executor:
+                pending_files = iter(json_files)
+                toc_futures = deque(
+                    (json_file, executor.submit(load_toc_entries, os.path.join(folder_path, json_file)))
+                    for json_file in islice(pending_files, READ_WORKERS)
+                )
+                
+                # 顺序处理每个文件
+                while toc_futures:
+                    json_file, toc_future = toc_futures.popleft()
+                    next_file = next(pending_files, None)
+                    if next_file is not None:
+                        toc_futures.append((next_file, executor.submit(load_toc_entries, os.path.join(folder_path, next_file))))
+                    output_file.write(process_single_book(json_file, toc_future, translate_executor, 
+                                                          samples_per_file, chunks_per_sample))
                 
         print(f"\n处理完成! 输出文件已保存到: {output_md_path}")
                 
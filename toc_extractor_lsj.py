@@ -1,29 +1,261 @@
 import asyncio
-import aiofiles
 from typing import List
-import glob
 from dotenv import load_dotenv
 import os
+import re
 import logging
 from datetime import datetime
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+import hashlib
+import random
+import time
+import sqlite3
 
+try:
+    import uvloop
+except ImportError:  # 未安装uvloop（如在Windows上）时使用asyncio默认的事件循环
+    uvloop = None
+
+try:
+    import tiktoken
+except ImportError:  # 未安装 tiktoken 时按固定的字符数分块
+    tiktoken = None
+
+# 缓存API响应的SQLite文件名，保存在输出目录中
+RESPONSE_CACHE_FILE = 'response_cache.sqlite3'
+
+# 目录提取的固定规则和示例，作为system消息放在每次请求的最前面
+TOC_SYSTEM_PROMPT = """你是一个文本处理专家，我将分段给你输入一本书的内容，从以下文本中识别目录部分，并将其转换为Markdown格式（用#表示层级）的目录。
+你只是处理文本，不要做任何评价或者描述。
+因为输入长度限制，目录可能分布在两次或者多次相邻输入的分段中，请记住上一段的处理方式，保持一致，不要偷懒！！！
+英文书籍的目录请不要翻译成中文
+
+规则：
+1. 目录识别特征：
+   - 标题编号密集出现的段落
+   - 连续多个X章,X节,或者数字编号12345一二三四五的短文本
+   - 每行都是类似标题的短文本或者连续多个短文本
+   - 句子中可能带有页码（需要删除）
+
+2. 标题层级判断规则：
+   目录部分相邻多个具有并列层级结构的内容需要被识别为同一层级：
+ 文字前用于表示章节限定的数字（如1，1.1，1.1.1）或者符号（a,b,c）越多，则标题的级别越低。
+   举例：
+   第一级：
+   - 第X章
+   - 第X部分
+
+   第二级：
+   - 第X节
+   - X.X（如1.1、2.1等）
+
+   第三级：
+   - X.X.X（如1.1.1、2.1.1等）
+   - 一、二、三等中文数字编号
+   - 1、2、3等阿拉伯数字编号
+
+   第四级：
+   - (一)、(二)、(三)等带括号的中文数字
+   - (1)、(2)、(3)等带括号的阿拉伯数字
+   - A、B、C等字母编号
+
+   第五级：
+   - a)、b)、c)等小写字母编号
+   - 1)、2)、3)等带括号的数字
+
+   特殊规则：
+   - 删除Box、图、表、注解等特殊内容
+   - 保持章节的连续性和层级关系
+   - 确保每个标题都有对应的层级标记
+
+3. 输出要求：
+   - 只输出Markdown格式的目录（只用#的多少来标注层级）
+   - 保持原有的层级关系
+   - 删除包含"思考题"、"参考文献"、"练习题"和"附录"的部分
+   - 删除所有页码
+   - 确保每一行都有标题层级标记
+   - 标题之间用换行分隔
+
+4. 输出的示例
+    # 第一篇 结构生物化学
+    ## 第一章 绪论
+    ### 第一节 生物化学发展简史
+    ### 第二节 生物化学的主要内容及其应用
+    ### 第三节 生物化学学习方法
+
+    ## 第二章 蛋白质的结构与功能
+    ### 第一节 氨基酸
+    #### 一 氨基酸的结构和分类
+    #### 二 氨基酸的性质
+    #### 三 氨基酸的功能
+
+以下是要处理的文本内容：
+"""
+
+# 同一本书中同时进行的chunk请求数
+MAX_CONCURRENT_CHUNKS = 5
+
+# 提取目录使用的模型
+TOC_MODEL = "gpt-4o-mini"
+# 每个chunk的字符数，未安装tiktoken时使用，也是按token换算时的下限
+CHUNK_CHARS = 4000
+# 每个chunk的token数，安装了tiktoken时按这本书平均每个token的字符数换算成字符数
+CHUNK_TOKENS = 8000
+
+# 每完成多少本书输出一次进度
+PROGRESS_INTERVAL = 25
+
+# 所有书合计每分钟最多发出的API请求数，按账号的速率限制设置
+MAX_REQUESTS_PER_MINUTE = 500
+
+# API调用遇到限流、连接错误、超时或服务端错误时的最大尝试次数
+# 创建客户端时关闭SDK自带的重试（max_retries=0），只由这里的重试和退避处理，避免两层重试叠加
+MAX_API_ATTEMPTS = 6
+# 指数退避的初始等待时间（秒），每次重试翻倍
+RETRY_BASE_DELAY = 0.5
+# 可以重试的API错误
+RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# 分块时优先在标题行（markdown标题或“第X章/节/部/篇”）之前切开
+CHUNK_BOUNDARY_PATTERN = re.compile(r'^(?=#|第[一二三四五六七八九十百千\d]+[章节部篇])', re.MULTILINE)
+
+def split_into_chunks(content, chunk_size):
+    """
+    按标题位置把内容切成若干段，再依次拼成不超过chunk_size个字符的块
+    单段超过chunk_size时接在当前块后面，在最后一个换行处切开，没有换行时才按字符切
+    """
+    chunks = []
+    current = ''
+    for part in CHUNK_BOUNDARY_PATTERN.split(content):
+        if len(current) + len(part) <= chunk_size:
+            current += part
+            continue
+        if len(part) > chunk_size:
+            part = current + part
+        elif current:
+            chunks.append(current)
+        while len(part) > chunk_size:
+            cut = part.rfind('\n', 0, chunk_size) + 1 or chunk_size
+            chunks.append(part[:cut])
+            part = part[cut:]
+        current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+def chunk_char_limit(content):
+    """
+    计算这本书每个chunk的字符数上限
+    中文每个字约占一个多token，英文一个token约有四个字符，按字符数分块时英文书的chunk远小于模型能处理的长度
+    安装了tiktoken时按整本书的token数换算，使每个chunk约有CHUNK_TOKENS个token
+    """
+    if tiktoken is None or not content:
+        return CHUNK_CHARS
+    token_count = len(tiktoken.encoding_for_model(TOC_MODEL).encode_ordinary(content))
+    return max(CHUNK_CHARS, CHUNK_TOKENS * len(content) // token_count)
+
+def read_text(path, limit):
+    """读取文本文件的前limit个字符"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read(limit)
+
+def write_text(path, text):
+    """把文本一次写入文件"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def retry_delay(error, attempt):
+    """
+    计算第attempt次失败后的等待时间
+    限流响应带有retry-after时按它等待，否则指数退避并加上随机抖动，避免并发请求同时重试
+    """
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, RETRY_BASE_DELAY / 2)
+
+class RateLimiter:
+    """
+    令牌桶限流：桶中最多有max_rate个令牌，按每time_period秒max_rate个的速度补充，每次请求消耗一个
+    没有超出额度时请求直接发出，额度用完后才按速度排队
+    """
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.refill_rate = max_rate / time_period
+        self.tokens = max_rate
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """取得一个令牌，令牌不足时等待补充"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.max_rate, self.tokens + (now - self.last_refill) * self.refill_rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.refill_rate)
+
+class ResponseCache:
+    """
+    按(模型, 参数, 消息)的SHA-256哈希把API响应缓存在SQLite文件中
+    重新运行或不同的书出现相同的分段时，直接返回保存的结果，不再调用API
+    提示词规则修改后消息内容随之变化，旧的缓存自然不会再命中
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT)')
+        self.conn.commit()
+    
+    @staticmethod
+    def make_key(model, temperature, messages):
+        """
+        根据模型、温度和消息列表生成缓存键
+        消息中的连续空白先合并成一个空格，只有换行、缩进不同的重复分段也能命中缓存
+        """
+        normalized_messages = '|'.join(
+            f"{message['role']}:{' '.join(message['content'].split())}" for message in messages
+        )
+        return hashlib.sha256(f"{model}|{temperature}|{normalized_messages}".encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """查询缓存，未命中时返回None"""
+        row = self.conn.execute('SELECT response FROM cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key, response):
+        """保存一条响应，相同的键已存在时保留原有结果"""
+        self.conn.execute('INSERT OR IGNORE INTO cache (key, response) VALUES (?, ?)', (key, response))
+        self.conn.commit()
 
 class TOCExtractor:
-    def __init__(self, input_path, output_dir, api_key):
+    def __init__(self, input_path, output_dir, api_key, response_cache=None, rate_limiter=None, toc_tasks=None):
         self.input_path = input_path
         self.output_dir = output_dir
-        self.client = OpenAI(api_key=api_key)
+        self.client = AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        # 所有书共用的 内容哈希 -> 提取目录的任务 字典
+        self.toc_tasks = toc_tasks
         
-        # Create logs directory if it doesn't exist
         self.logs_dir = os.path.join(os.path.dirname(output_dir), 'logs')
-        os.makedirs(self.logs_dir, exist_ok=True)
         
         # 设置日志
         self.setup_logging()
         
     def setup_logging(self):
-        """设置日志"""
+        """设置日志，每本书各建一个TOCExtractor，日志处理器只在第一次时创建，之后的书共用"""
+        self.logger = logging.getLogger(__name__)
+        if logging.getLogger().handlers:
+            return
+        # Create logs directory if it doesn't exist
+        os.makedirs(self.logs_dir, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         log_file = os.path.join(self.logs_dir, f'toc_extraction_{timestamp}.log')
         
@@ -35,126 +267,103 @@ class TOCExtractor:
                 logging.StreamHandler()
             ]
         )
-        self.logger = logging.getLogger(__name__)
         
-    def generate_response(self, prompt):
+    async def generate_response(self, messages):
         """
-        调用GPT-4生成响应
+        异步调用GPT-4生成响应
         这个地方是整本书的框架，所以对识别要求要高一些，而且一共就20000字符，所以用gpt-4也不会有很高的成本
+        相同的请求优先从缓存返回
         """
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",     
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            raise Exception(f"API调用失败: {str(e)}")
+        model = TOC_MODEL
+        # 温度为0时同一prompt的结果稳定，缓存的结果才等同于重新请求
+        temperature = 0.0
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(model, temperature, messages)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        # 先从限流器取得令牌，限流和临时错误按指数退避重试，不直接放弃这部分内容
+        for attempt in range(MAX_API_ATTEMPTS):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=model,     
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=1.0,
+                    frequency_penalty=0.0,
+                    presence_penalty=0.0
+                )
+                content = response.choices[0].message.content
+                break
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    raise Exception(f"API调用失败，已重试{attempt}次: {str(e)}")
+                delay = retry_delay(e, attempt)
+                self.logger.warning(f"API调用失败，{delay:.1f}秒后重试: {str(e)}")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                raise Exception(f"API调用失败: {str(e)}")
+        if cache_key is not None:
+            self.response_cache.set(cache_key, content)
+        return content
             
-    def extract_toc(self, content):
+    async def extract_toc(self, content):
         """从文档中提取目录并转换为Markdown格式"""
-        words = content.split()
-        chunk_size = 4000   ## 分成2000字符一个chunk，避免达到输入和输出的限制
-        toc_parts = []
+        # 分成不超过chunk_char_limit个字符的chunk，避免达到输入和输出的限制；在标题和换行处切开，不会把一行目录切成两半
+        chunks = split_into_chunks(content, chunk_char_limit(content))
         
-        # 按字符长度分割
-        for i in range(0, len(content), chunk_size):
-            chunk = content[i:i + chunk_size]
-            prompt = """
-            你是一个文本处理专家，我将分段给你输入一本书的内容，从以下文本中识别目录部分，并将其转换为Markdown格式（用#表示层级）的目录。
-            你只是处理文本，不要做任何评价或者描述。
-            因为输入长度限制，目录可能分布在两次或者多次相邻输入的分段中，请记住上一段的处理方式，保持一致，不要偷懒！！！
-            英文书籍的目录请不要翻译成中文
-            
-            规则：
-            1. 目录识别特征：
-               - 标题编号密集出现的段落
-               - 连续多个X章,X节,或者数字编号12345一二三四五的短文本
-               - 每行都是类似标题的短文本或者连续多个短文本
-               - 句子中可能带有页码（需要删除）
-            
-            2. 标题层级判断规则：
-               目录部分相邻多个具有并列层级结构的内容需要被识别为同一层级：
-             文字前用于表示章节限定的数字（如1，1.1，1.1.1）或者符号（a,b,c）越多，则标题的级别越低。
-               举例：
-               第一级：
-               - 第X章
-               - 第X部分
-               
-               第二级：
-               - 第X节
-               - X.X（如1.1、2.1等）
-               
-               第三级：
-               - X.X.X（如1.1.1、2.1.1等）
-               - 一、二、三等中文数字编号
-               - 1、2、3等阿拉伯数字编号
-               
-               第四级：
-               - (一)、(二)、(三)等带括号的中文数字
-               - (1)、(2)、(3)等带括号的阿拉伯数字
-               - A、B、C等字母编号
-               
-               第五级：
-               - a)、b)、c)等小写字母编号
-               - 1)、2)、3)等带括号的数字
-               
-               特殊规则：
-               - 删除Box、图、表、注解等特殊内容
-               - 保持章节的连续性和层级关系
-               - 确保每个标题都有对应的层级标记
-            
-            3. 输出要求：
-               - 只输出Markdown格式的目录（只用#的多少来标注层级）
-               - 保持原有的层级关系
-               - 删除包含"思考题"、"参考文献"、"练习题"和"附录"的部分
-               - 删除所有页码
-               - 确保每一行都有标题层级标记
-               - 标题之间用换行分隔
-            
-            4. 输出的示例
-                # 第一篇 结构生物化学
-                ## 第一章 绪论
-                ### 第一节 生物化学发展简史
-                ### 第二节 生物化学的主要内容及其应用
-                ### 第三节 生物化学学习方法
-
-                ## 第二章 蛋白质的结构与功能
-                ### 第一节 氨基酸
-                #### 一 氨基酸的结构和分类
-                #### 二 氨基酸的性质
-                #### 三 氨基酸的功能
-            
-            以下是要处理的文本内容：
-            """ + chunk
-            """以上是要处理的文本内容"""
-            try:
-                response = self.generate_response(prompt)
-                toc_parts.append(response.strip())
-            except Exception as e:
-                self.logger.error(f"目录提取失败: {str(e)}")
-                continue
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHUNKS)
+        
+        async def process_chunk(chunk):
+            """处理一个chunk，失败时返回None"""
+            # 固定的规则放在最前面的system消息中，每次请求的前缀相同，可以命中OpenAI的提示缓存
+            messages = [
+                {"role": "system", "content": TOC_SYSTEM_PROMPT},
+                {"role": "user", "content": chunk}
+            ]
+            async with semaphore:
+                try:
+                    response = await self.generate_response(messages)
+                    return response.strip()
+                except Exception as e:
+                    self.logger.error(f"目录提取失败: {str(e)}")
+                    return None
+        
+        # 各chunk同时请求，gather按传入顺序返回结果，目录保持chunk的顺序
+        results = await asyncio.gather(*(process_chunk(chunk) for chunk in chunks))
+        toc_parts = [part for part in results if part is not None]
         
         # 合并所有部分
         full_toc = '\n'.join(toc_parts)
         return full_toc
     
+    async def extract_toc_once(self, content):
+        """相同内容的书只提取一次目录，其余的书等待同一个任务的结果"""
+        if self.toc_tasks is None:
+            return await self.extract_toc(content)
+        key = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        task = self.toc_tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.extract_toc(content))
+            self.toc_tasks[key] = task
+        else:
+            self.logger.info(f"文件内容与之前的书相同，复用其目录: {self.input_path}")
+        return await task
+    
     async def process_file(self):
         """异步处理文件并保存目录"""
         try:
             # 读取输入文件
             self.logger.info(f"开始读取文件: {self.input_path}")
-            async with aiofiles.open(self.input_path, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                content = content[:20000]  # 只处理前20000字符
+            # 单次读写直接放到线程中完成，不需要aiofiles逐次调用的线程切换
+            content = await asyncio.to_thread(read_text, self.input_path, 20000)  # 只处理前20000字符
             
             # 提取目录
             self.logger.info("开始提取目录")
-            toc = self.extract_toc(content)
+            toc = await self.extract_toc_once(content)
             
             # 保存目录
             if toc:
@@ -165,8 +374,7 @@ class TOCExtractor:
                     f'toc_{timestamp}_{filename}'
                 )
                 
-                async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
-                    await f.write(toc)
+                await asyncio.to_thread(write_text, output_path, toc)
                     
                 self.logger.info(f"目录已保存到: {output_path}")
             else:
@@ -174,10 +382,11 @@ class TOCExtractor:
                 
         except Exception as e:
             self.logger.error(f"处理失败: {str(e)}")
-async def process_book(input_path: str, output_dir: str, api_key: str) -> None:
+async def process_book(input_path: str, output_dir: str, api_key: str, response_cache=None, 
+                       rate_limiter=None, toc_tasks=None) -> None:
     """异步处理单本书籍"""
     try:
-        extractor = TOCExtractor(input_path, output_dir, api_key)
+        extractor = TOCExtractor(input_path, output_dir, api_key, response_cache, rate_limiter, toc_tasks)
         await extractor.process_file()  # 注意：需要将 process_file 方法改为异步
     except Exception as e:
         logging.error(f"处理文件 {input_path} 时出错: {str(e)}")
@@ -193,34 +402,41 @@ async def process_books_directory(input_dir: str, output_dir: str, api_key: str,
     # 确保输出目录存在
     os.makedirs(output_dir, exist_ok=True)
     
-    # 获取所有.md文件
-    md_files = glob.glob(os.path.join(input_dir, "*.md"))
+    # 获取所有.md文件（与glob的*.md一样跳过隐藏文件）
+    with os.scandir(input_dir) as entries:
+        md_files = [entry.path for entry in entries 
+                    if entry.name.endswith('.md') and not entry.name.startswith('.') and entry.is_file()]
     
     if not md_files:
         logging.warning(f"在目录 {input_dir} 中未找到.md文件")
         return
     
-    # 创建信号量来限制并发数
-    semaphore = asyncio.Semaphore(max_concurrent)
-    
-    async def process_with_semaphore(file_path: str) -> None:
-        async with semaphore:
-            await process_book(file_path, output_dir, api_key)
+    # 所有书共用一个响应缓存
+    response_cache = ResponseCache(os.path.join(output_dir, RESPONSE_CACHE_FILE))
+    # 所有书共用一个限流器，按API的总额度发送请求
+    rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
+    # 前20000字符相同的书（重复上传等）只调用一次API，共用提取的目录
+    toc_tasks = {}
     
-    # 创建所有任务
-    tasks = [process_with_semaphore(file_path) for file_path in md_files]
-    
-    # 使用进度条显示处理进度
     total_files = len(md_files)
     completed = 0
+    # 所有worker共用一个迭代器，每个worker处理完一本书再取下一本
+    pending_files = iter(md_files)
     
-    for task in asyncio.as_completed(tasks):
-        try:
-            await task
+    async def worker() -> None:
+        nonlocal completed
+        for file_path in pending_files:
+            try:
+                await process_book(file_path, output_dir, api_key, response_cache, rate_limiter, toc_tasks)
+            except Exception as e:
+                logging.error(f"任务执行失败: {str(e)}")
+            # 失败的任务也计入进度，每完成PROGRESS_INTERVAL本书和全部完成时才输出一行
             completed += 1
-            print(f"进度: {completed}/{total_files} ({(completed/total_files)*100:.2f}%)")
-        except Exception as e:
-            logging.error(f"任务执行失败: {str(e)}")
+            if completed % PROGRESS_INTERVAL == 0 or completed == total_files:
+                print(f"进度: {completed}/{total_files} ({(completed/total_files)*100:.2f}%)")
+    
+    # 只创建max_concurrent个worker限制并发数，不再为每本书预先创建一个任务
+    await asyncio.gather(*(worker() for _ in range(min(max_concurrent, total_files))))
 
 if __name__ == "__main__":
     load_dotenv()  # 加载 .env 文件中的环境变量
@@ -245,7 +461,9 @@ if __name__ == "__main__":
         ]
     )
     
-    # 运行异步处理
+    # 运行异步处理，安装了uvloop时换用更快的事件循环
+    if uvloop is not None:
+        uvloop.install()
     try:
         asyncio.run(process_books_directory(input_dir, output_dir, api_key))
         print("所有文件处理完成！")
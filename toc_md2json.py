@@ -4,8 +4,18 @@
 import re
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+# 章节（# 标题）和小节（## 标题）所在的行，行首可以有空白
+HEADER_PATTERN = re.compile(r'^\s*(#{1,2}) (.+)$', re.MULTILINE)
+
 def parse_md_to_json(md_file_path):
     with open(md_file_path, 'r', encoding='utf-8') as file:
         content = file.read()
@@ -20,24 +30,19 @@ def parse_md_to_json(md_file_path):
     current_chapter = ""
     current_section = ""
     
-    # 按行分割内容
-    lines = content.split('\n')
-    
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        # 匹配章节（以单个#开头）
-        chapter_match = re.match(r'^# (.+)$', line)
-        if chapter_match:
-            current_chapter = chapter_match.group(1)
+    # 只扫描标题行，不再逐行处理正文
+    for header_match in HEADER_PATTERN.finditer(content):
+        # 去掉行尾空白后标题为空的行不是标题
+        title = header_match.group(2).rstrip()
+        if not title:
             continue
-            
-        # 匹配小节（以##开头）
-        section_match = re.match(r'^## (.+)$', line)
-        if section_match:
-            current_section = section_match.group(1)
+        
+        if len(header_match.group(1)) == 1:
+            # 匹配章节（以单个#开头）
+            current_chapter = title
+        else:
+            # 匹配小节（以##开头）
+            current_section = title
             # 如果没有子节，则在这里添加记录
             result["sections"].append({
                 "Chapter": current_chapter,
@@ -48,23 +53,35 @@ def parse_md_to_json(md_file_path):
     
     return result
 
-def process_folder(input_folder, output_folder):
+def save_json_file(data, file_path):
+    """以2空格缩进写入JSON文件，优先使用 orjson 序列化（直接输出UTF-8字节），一次写入整个文件"""
+    if orjson is not None:
+        Path(file_path).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        return
+    Path(file_path).write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding='utf-8')
+
+def process_file(file_path, output_folder):
+    """解析单个md文件并保存JSON（模块级函数，便于多进程调用），返回输出文件路径"""
+    # 解析MD文件
+    result = parse_md_to_json(file_path)
+    
+    # 生成输出文件名
+    output_file = Path(output_folder) / f"{file_path.stem}.json"
+    
+    # 保存JSON文件
+    save_json_file(result, output_file)
+    
+    return output_file
+
+def process_folder(input_folder, output_folder, max_workers=None):
     # 创建输出文件夹（如果不存在）
     Path(output_folder).mkdir(parents=True, exist_ok=True)
     
-    # 处理输入文件夹中的所有md文件
-    for file_path in Path(input_folder).glob('*.md'):
-        # 解析MD文件
-        result = parse_md_to_json(file_path)
-        
-        # 生成输出文件名
-        output_file = Path(output_folder) / f"{file_path.stem}.json"
-        
-        # 保存JSON文件
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
-        
-        print(f"Processed {file_path.name} -> {output_file.name}")
+    # 处理输入文件夹中的所有md文件，各文件相互独立，用多进程并行处理
+    md_files = list(Path(input_folder).glob('*.md'))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for file_path, output_file in zip(md_files, executor.map(process_file, md_files, repeat(output_folder))):
+            print(f"Processed {file_path.name} -> {output_file.name}")
 
 if __name__ == "__main__":
     # 设置输入和输出文件夹路径
@@ -1,58 +1,88 @@
 import json
+import os
 import tiktoken
 import numpy as np
-from typing import Dict, List
+from array import array
+from itertools import islice
+from typing import Dict, Iterable, Iterator, Tuple
 from collections import Counter
 
-def analyze_content_distribution(json_data: str) -> Dict:
-    """分析内容的字符数和token数分布
-    
-    Args:
-        json_data: JSON格式的输入数据
-    
-    Returns:
-        包含统计信息的字典
-    """
-    # 加载tiktoken编码器
-    enc = tiktoken.get_encoding("cl100k_base")  # 使用GPT-4的编码器
-    
-    char_lengths = []
-    token_lengths = []
-    
-    # 解析JSON数据
-    data = json.loads(json_data)
-    
-    # 收集所有内容的长度信息
+try:
+    import orjson
+    loads_json = orjson.loads
+except ImportError:  # 未安装 orjson 时退回标准库 json，json.loads 同样可以直接解析UTF-8字节
+    loads_json = json.loads
+
+try:
+    import ijson
+except ImportError:  # 未安装 ijson 时整体读取文件
+    ijson = None
+
+# 每次交给tiktoken编码的内容条数
+ENCODE_BATCH_SIZE = 512
+# 使用的tiktoken编码
+ENCODING_NAME = "cl100k_base"  # GPT-4的编码器
+
+# tiktoken默认把下载的BPE文件缓存在临时目录中，临时目录被清理后要重新下载，改为缓存在用户目录下
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tiktoken"))
+
+def iter_file_contents(file_path: str) -> Iterator[str]:
+    """逐个返回JSON文件中各条目的content，安装了ijson时流式解析，不把整个文件读入内存"""
+    if ijson is not None:
+        with open(file_path, 'rb') as f:
+            yield from ijson.items(f, 'item.content')
+        return
+    with open(file_path, 'rb') as f:
+        data = loads_json(f.read())
     for item in data:
         if 'content' in item:
-            content = item['content']
-            char_len = len(content)
-            token_len = len(enc.encode(content))
-            
-            char_lengths.append(char_len)
-            token_lengths.append(token_len)
+            yield item['content']
+
+def measure_lengths(contents: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    计算每条内容的字符数和token数
+    内容按ENCODE_BATCH_SIZE条一批交给tiktoken多线程编码，内容都是普通文本，用encode_ordinary，不检查特殊token
+    """
+    # 加载tiktoken编码器，tiktoken在进程内缓存已加载的编码器，重复调用不会重新加载
+    enc = tiktoken.get_encoding(ENCODING_NAME)
     
+    char_lengths = array('q')
+    token_lengths = array('q')
+    contents = iter(contents)
+    while True:
+        batch = list(islice(contents, ENCODE_BATCH_SIZE))
+        if not batch:
+            break
+        char_lengths.extend(map(len, batch))
+        token_lengths.extend(map(len, enc.encode_ordinary_batch(batch, num_threads=os.cpu_count())))
+    return np.frombuffer(char_lengths, dtype=np.int64), np.frombuffer(token_lengths, dtype=np.int64)
+
+def summarize_lengths(char_lengths: np.ndarray, token_lengths: np.ndarray) -> Dict:
+    """根据字符数和token数数组计算统计信息和分布"""
     # 计算统计信息
     stats = {
         'characters': {
-            'min': min(char_lengths),
-            'max': max(char_lengths),
-            'mean': np.mean(char_lengths),
+            'min': int(char_lengths.min()),
+            'max': int(char_lengths.max()),
+            'mean': char_lengths.mean(),
             'median': np.median(char_lengths),
-            'total': sum(char_lengths)
+            'total': int(char_lengths.sum())
         },
         'tokens': {
-            'min': min(token_lengths),
-            'max': max(token_lengths),
-            'mean': np.mean(token_lengths),
+            'min': int(token_lengths.min()),
+            'max': int(token_lengths.max()),
+            'mean': token_lengths.mean(),
             'median': np.median(token_lengths),
-            'total': sum(token_lengths)
+            'total': int(token_lengths.sum())
         }
     }
     
     # 生成分布报告
-    def generate_distribution(lengths: List[int], num_bins: int = 10) -> Dict:
-        hist, bins = np.histogram(lengths, bins=num_bins)
+    def generate_distribution(lengths: np.ndarray, num_bins: int = 10) -> Dict:
+        # 区间边界与np.histogram相同；长度都是整数，按内部边界查找区间号后用bincount计数
+        # side='right'使等于边界的值落在右侧区间，最大值落在最后一个区间，与np.histogram一致
+        bins = np.histogram_bin_edges(lengths, bins=num_bins)
+        hist = np.bincount(np.searchsorted(bins[1:-1], lengths, side='right'), minlength=num_bins)
         return {
             'histogram': hist.tolist(),
             'bin_edges': bins.tolist()
@@ -63,6 +93,33 @@ def analyze_content_distribution(json_data: str) -> Dict:
     
     return stats
 
+def analyze_content_distribution(json_data: str) -> Dict:
+    """分析内容的字符数和token数分布
+    
+    Args:
+        json_data: JSON格式的输入数据
+    
+    Returns:
+        包含统计信息的字典
+    """
+    # 解析JSON数据
+    data = loads_json(json_data)
+    
+    # 收集所有内容的长度信息
+    contents = (item['content'] for item in data if 'content' in item)
+    return summarize_lengths(*measure_lengths(contents))
+
+def analyze_content_file(file_path: str) -> Dict:
+    """分析JSON文件中内容的字符数和token数分布，逐条读取内容，内存占用与文件大小无关
+    
+    Args:
+        file_path: JSON文件路径
+    
+    Returns:
+        包含统计信息的字典
+    """
+    return summarize_lengths(*measure_lengths(iter_file_contents(file_path)))
+
 def print_report(stats: Dict) -> None:
     """打印统计报告
     
@@ -98,9 +155,6 @@ def print_report(stats: Dict) -> None:
         print(f"{edge:.0f}-{next_edge:.0f}: {count}")
 
 if __name__ == "__main__":
-    # 使用示例
-    with open('/root/RAG-test/CrossModalRetrieval-RAG/assets/images_debug_6 细胞生物学（5）_figures_description_20241111_223031.json', 'r', encoding='utf-8') as f:
-        json_data = f.read()
-    
-    stats = analyze_content_distribution(json_data)
+    # 使用示例，逐条读取文件中的内容
+    stats = analyze_content_file('/root/RAG-test/CrossModalRetrieval-RAG/assets/images_debug_6 细胞生物学（5）_figures_description_20241111_223031.json')
     print_report(stats)